@@ -3,6 +3,7 @@ from __future__ import annotations
 import os
 import sys
 import spacy
+from spacy.scorer import Scorer
 from spacy.training import Example
 from spacy.tokens import DocBin
 from typing import List, Dict, Tuple, Optional
@@ -40,14 +41,24 @@ def get_gold_labels(docs: list) -> set[str]:
     return labels
 
 
-def evaluate(nlp: spacy.Language, gold_docs: list) -> dict:
-    # Example should be given unprocessed Doc and Gold as recommended. Unprocessed Doc only needs tokenizer
+def predict_docs(
+    nlp: spacy.Language, gold_docs: List[spacy.tokens.Doc], batch_size: Optional[int] = None
+) -> List[spacy.tokens.Doc]:
+    # Run the pipeline once over the gold texts; the predictions are shared by the scorer and the token report
+    texts = [d.text for d in gold_docs]
+    return list(nlp.pipe(texts, batch_size=batch_size))
+
+
+def evaluate(
+    nlp: spacy.Language, gold_docs: list, pred_docs: Optional[List[spacy.tokens.Doc]] = None
+) -> dict:
+    # Score already predicted Docs (same tokenizer and pipeline as nlp.evaluate) instead of running the pipeline again
+    if pred_docs is None:
+        pred_docs = predict_docs(nlp, gold_docs)
     examples: list[Example] = []
-    for gold_doc in gold_docs:
-        pred_doc = nlp.make_doc(gold_doc.text)
+    for gold_doc, pred_doc in zip(gold_docs, pred_docs):
         examples.append(Example(pred_doc, gold_doc))
-    # Evaluate through pipeline
-    return nlp.evaluate(examples)
+    return Scorer(nlp).score(examples)
 
 
 def build_per_label_metrics_df(scores: dict):
@@ -96,13 +107,15 @@ def _sentence_text_for_token(token) -> str:
 
 
 def build_token_level_rows(
-    nlp: spacy.Language, gold_docs: List[spacy.tokens.Doc]
+    nlp: spacy.Language,
+    gold_docs: List[spacy.tokens.Doc],
+    pred_docs: Optional[List[spacy.tokens.Doc]] = None,
 ) -> List[Dict[str, str]]:
     rows: List[Dict[str, str]] = []
 
-    # Execute predictions in batch
-    texts = [d.text for d in gold_docs]
-    pred_docs = list(nlp.pipe(texts))
+    # Execute predictions in batch (unless the Docs scored by evaluate() are passed in)
+    if pred_docs is None:
+        pred_docs = predict_docs(nlp, gold_docs)
 
     for gold_doc, pred_doc in zip(gold_docs, pred_docs):
         gold_ent_spans = _collect_ent_char_spans(gold_doc)
@@ -140,6 +153,7 @@ def export_token_report_to_excel(
     gold_docs: List[spacy.tokens.Doc],
     output_xlsx_path: str,
     per_label_df=None,
+    pred_docs: Optional[List[spacy.tokens.Doc]] = None,
 ) -> str:
     if pd is None:
         raise RuntimeError(
@@ -147,7 +161,7 @@ def export_token_report_to_excel(
             "Example: pip install pandas openpyxl"
         )
 
-    rows = build_token_level_rows(nlp, gold_docs)
+    rows = build_token_level_rows(nlp, gold_docs, pred_docs=pred_docs)
     if not rows:
         # Output empty file even when there are no target outputs
         df = pd.DataFrame(
@@ -205,7 +219,9 @@ def main(model_dir: str = "./output_v4/model-best", dev_path: str = "test.spacy"
         if missing_in_model:
             print("Warning: The following Gold labels are not registered in the model (possible insufficient training): " + ", ".join(missing_in_model), file=sys.stderr)
 
-    scores = evaluate(nlp, gold_docs)
+    # Predict once and reuse the Docs for the metrics and the token-level report
+    pred_docs = predict_docs(nlp, gold_docs)
+    scores = evaluate(nlp, gold_docs, pred_docs=pred_docs)
 
     # Macro display
     ents_p = scores.get("ents_p")
@@ -233,7 +249,7 @@ def main(model_dir: str = "./output_v4/model-best", dev_path: str = "test.spacy"
     xlsx_path = output_path
     try:
         per_label_df = build_per_label_metrics_df(scores)
-        saved_path = export_token_report_to_excel(nlp, gold_docs, xlsx_path, per_label_df=per_label_df)
+        saved_path = export_token_report_to_excel(nlp, gold_docs, xlsx_path, per_label_df=per_label_df, pred_docs=pred_docs)
         print(f"Token-level detailed results and per-label metrics have been output: {saved_path}")
     except RuntimeError as exc:  # pandas not installed, etc.
         print(str(exc), file=sys.stderr)
@@ -1,39 +1,47 @@
+import argparse
+import bz2
+import codecs
+import gc
+import gzip
+import hashlib
+import inspect
+import io
+import itertools
+import json
+import lzma
+import mmap
+import multiprocessing
+import os
+import pickle
+import queue
+import re
+import sqlite3
+import sys
+import threading
+import time
+import numpy as np
 import spacy
 from spacy.matcher import DependencyMatcher
-from collections import defaultdict
-
-# 汎用関数
-def filter_no_obj(token_ids, doc):
-    result = True
-    anchor_verb = doc[token_ids[0]]
-    if any(child.dep_ == "dobj" for child in anchor_verb.children):
-        result = False
-    return result
-
-def filter_passive(token_ids, doc):
-    result = True
-    anchor_verb = doc[token_ids[0]]
-    if any(child.dep_ == "auxpass" for child in anchor_verb.children):
-        result = False
-    return result
-
-def filter_past_participle_modifier(token_ids, doc):
-    result = True
-    anchor_verb = doc[token_ids[0]]
-    if anchor_verb.tag_ == "VBN":
-        # 現在完了形（have + VBN）または受動態（auxpass付き）の場合はTrue
-        has_have_aux = any(child.dep_ == "aux" and child.lemma_ == "have" for child in anchor_verb.children)
-        has_auxpass = any(child.dep_ == "auxpass" for child in anchor_verb.children)
-        
-        # どちらの条件も満たさない場合（単独の過去分詞修飾語）のみFalse
-        if not (has_have_aux or has_auxpass):
-            result = False
-    return result
-
-def word_order_check(anchor_verb, token, doc):
-    if token.i < anchor_verb.i:
-        return False
-    return True
+from spacy.attrs import DEP, HEAD, LEMMA, LOWER, MORPH, NORM, ORTH, POS, SENT_START, TAG
+from spacy.errors import Errors
+from spacy.parts_of_speech import IDS as POS_IDS
+from spacy.pipeline import Tagger
+from spacy.strings import get_string_id
+from spacy.language import Language
+from spacy.tokens import Doc, DocBin, Span, Token
+from collections import Counter, OrderedDict, defaultdict, deque
+from contextlib import contextmanager
+
+try:
+    import zstandard
+except ImportError:  # .zst のコーパスを読む場合のみ必要
+    zstandard = None
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # Parquet で書き出す場合のみ必要
+    pa = None
+    pq = None
 
 # 前置詞の指定
 target_prep_simple = [
@@ -72,10 +80,246 @@ target_prep_complex = [
     "toward", "towards", "with"]
 
 
-# DependencyMatcherを作成 ------------------------------------------------------------
-def create_dependency_matcher(nlp):
-    
-    matcher = DependencyMatcher(nlp.vocab)
+# 文書単位のトークン特徴量テーブル ------------------------------------------------------------
+# フィルターが何度も参照する子ノードの情報を Doc.to_array で1文書につき1回だけ計算しておく
+WH_WORDS = {"what", "who", "which", "whom", "where", "when", "why", "how", "whether", "if"}
+WH_WORDS_TO_INF = {"what", "who", "which", "whom", "where", "when", "why", "how", "whether"}
+REFLEXIVE_PRONOUNS = [
+    "myself", "yourself", "yourselves", "ourselves", "himself",
+    "herself", "itself", "themselves", "oneself"
+    ]
+
+WH_WORD_IDS = {get_string_id(word) for word in WH_WORDS}
+REFLEXIVE_PRONOUN_IDS = {get_string_id(word) for word in REFLEXIVE_PRONOUNS}
+
+ID_ABLE = get_string_id("able")
+ID_ABOUT = get_string_id("about")
+ID_ADVMOD = get_string_id("advmod")
+ID_AUX = get_string_id("aux")
+ID_AUXPASS = get_string_id("auxpass")
+ID_BE = get_string_id("be")
+ID_DOBJ = get_string_id("dobj")
+ID_GO = get_string_id("go")
+ID_HAVE = get_string_id("have")
+ID_LET = get_string_id("let")
+ID_OF = get_string_id("of")
+ID_ON = get_string_id("on")
+ID_OUT = get_string_id("out")
+ID_PREP = get_string_id("prep")
+ID_TO = get_string_id("to")
+ID_TAG_TO = get_string_id("TO")
+ID_TAG_VBG = get_string_id("VBG")
+ID_TAG_VBN = get_string_id("VBN")
+ID_USED = get_string_id("used")
+ID_APOSTROPHE_S = get_string_id("'s")
+
+# 子ノードの特徴ビット（親トークンに OR で集約する）
+CHILD_DOBJ = 1 << 0
+CHILD_AUXPASS = 1 << 1
+CHILD_AUX = 1 << 2
+CHILD_EXPL = 1 << 3
+CHILD_POBJ = 1 << 4
+CHILD_PCOMP = 1 << 5
+CHILD_HAVE_AUX = 1 << 6          # dep=aux, lemma=have
+CHILD_BE_AUX = 1 << 7            # dep=aux, lemma=be
+CHILD_BE_AUX_LOWER = 1 << 8      # dep=aux, lemma.lower()=be
+CHILD_DO_AUX = 1 << 9            # dep=aux, lemma=do
+CHILD_MD_AUX = 1 << 10           # dep=aux, tag=MD
+CHILD_TO = 1 << 11               # tag=TO
+CHILD_TO_AUX = 1 << 12           # dep=aux, tag=TO
+CHILD_THAT_MARK = 1 << 13        # dep=mark, lemma=that
+CHILD_THAT_MARK_LOWER = 1 << 14  # dep=mark, lemma.lower()=that
+CHILD_QUOT = 1 << 15             # PunctType=Quot
+CHILD_AMOD_ADJ = 1 << 16         # dep=amod, pos=ADJ
+CHILD_PCOMP_VBG = 1 << 17        # dep=pcomp, tag=VBG
+
+CHILD_DEP_BITS = {
+    get_string_id("dobj"): CHILD_DOBJ,
+    get_string_id("auxpass"): CHILD_AUXPASS,
+    get_string_id("aux"): CHILD_AUX,
+    get_string_id("expl"): CHILD_EXPL,
+    get_string_id("pobj"): CHILD_POBJ,
+    get_string_id("pcomp"): CHILD_PCOMP,
+}
+
+ID_AMOD = get_string_id("amod")
+ID_DATIVE = get_string_id("dative")
+ID_DO = get_string_id("do")
+ID_MARK = get_string_id("mark")
+ID_PCOMP = get_string_id("pcomp")
+ID_POS_ADJ = get_string_id("ADJ")
+ID_TAG_MD = get_string_id("MD")
+ID_THAT = get_string_id("that")
+SIMPLE_PREP_IDS = {get_string_id(prep) for prep in target_prep_simple}
+COMPLEX_PREP_IDS = {get_string_id(prep) for prep in target_prep_complex}
+
+# 文字列ID -> 小文字化した文字列のID、形態素ID -> (PunctType=Quot, VerbForm=Inf)
+_lower_id_cache = {}
+_morph_flags_cache = {}
+
+
+def _lower_id(strings, key):
+    lowered = _lower_id_cache.get(key)
+    if lowered is None:
+        lowered = get_string_id(strings[key].lower())
+        _lower_id_cache[key] = lowered
+    return lowered
+
+
+def _morph_values(morph_string, field):
+    for feature in morph_string.split("|"):
+        name, _, values = feature.partition("=")
+        if name == field:
+            return values.split(",")
+    return []
+
+
+def _morph_flags(strings, key):
+    flags = _morph_flags_cache.get(key)
+    if flags is None:
+        morph_string = strings[key] if key != 0 else ""
+        flags = (
+            "Quot" in _morph_values(morph_string, "PunctType"),
+            "Inf" in _morph_values(morph_string, "VerbForm"),
+        )
+        _morph_flags_cache[key] = flags
+    return flags
+
+
+class DocFeatures:
+    def __init__(self, doc):
+        strings = doc.vocab.strings
+        n_tokens = len(doc)
+
+        array = doc.to_array([HEAD, DEP, TAG, LEMMA, LOWER, POS, MORPH])
+        self.heads = heads = (np.arange(n_tokens, dtype="int64") + array[:, 0].view("int64")).tolist()
+        self.dep = dep = array[:, 1].tolist()
+        self.tag = tag = array[:, 2].tolist()
+        self.lemma = lemma = array[:, 3].tolist()
+        self.lower = array[:, 4].tolist()
+        pos = array[:, 5].tolist()
+        morph = array[:, 6].tolist()
+        self.lemma_lower = lemma_lower = [_lower_id(strings, key) for key in lemma]
+        self.is_inf = [False] * n_tokens
+        self.child_mask = child_mask = [0] * n_tokens
+        self.closest_prep_simple = closest_simple = [-1] * n_tokens
+        self.closest_prep_complex = closest_complex = [-1] * n_tokens
+
+        for i in range(n_tokens):
+            is_quot, self.is_inf[i] = _morph_flags(strings, morph[i])
+            head = heads[i]
+            # ROOTは自分自身がheadなので、子ノードとしては扱わない
+            if head == i:
+                continue
+
+            # 子ノードの特徴ビットを親に集約
+            token_dep = dep[i]
+            token_tag = tag[i]
+            bits = CHILD_DEP_BITS.get(token_dep, 0)
+            if token_dep == ID_AUX:
+                if lemma[i] == ID_HAVE:
+                    bits |= CHILD_HAVE_AUX
+                if lemma[i] == ID_BE:
+                    bits |= CHILD_BE_AUX
+                if lemma_lower[i] == ID_BE:
+                    bits |= CHILD_BE_AUX_LOWER
+                if lemma[i] == ID_DO:
+                    bits |= CHILD_DO_AUX
+                if token_tag == ID_TAG_MD:
+                    bits |= CHILD_MD_AUX
+                if token_tag == ID_TAG_TO:
+                    bits |= CHILD_TO_AUX
+            elif token_dep == ID_MARK:
+                if lemma[i] == ID_THAT:
+                    bits |= CHILD_THAT_MARK
+                if lemma_lower[i] == ID_THAT:
+                    bits |= CHILD_THAT_MARK_LOWER
+            elif token_dep == ID_AMOD:
+                if pos[i] == ID_POS_ADJ:
+                    bits |= CHILD_AMOD_ADJ
+            elif token_dep == ID_PCOMP:
+                if token_tag == ID_TAG_VBG:
+                    bits |= CHILD_PCOMP_VBG
+            if token_tag == ID_TAG_TO:
+                bits |= CHILD_TO
+            if is_quot:
+                bits |= CHILD_QUOT
+            child_mask[head] |= bits
+
+            # 動詞に最も近い前置詞の子ノード（同距離なら左側。filter_V_prep_n / filter_V_n_prep_n で使用）
+            if token_dep == ID_PREP or token_dep == ID_DATIVE:
+                distance = abs(i - head)
+                if token_dep == ID_PREP and lemma[i] in SIMPLE_PREP_IDS:
+                    closest = closest_simple[head]
+                    if closest == -1 or distance < abs(closest - head):
+                        closest_simple[head] = i
+                if lemma[i] in COMPLEX_PREP_IDS:
+                    closest = closest_complex[head]
+                    if closest == -1 or distance < abs(closest - head):
+                        closest_complex[head] = i
+
+
+# 抽出中の文書の特徴量テーブルは doc.user_data に置き、抽出が終われば外す
+# （文書ごとなのでスレッド間で共有されず、Doc の直列化にも含まれない。retokenize した文書では作り直される）
+DOC_FEATURES_KEY = ("vac_extractor", "features")
+
+
+@contextmanager
+def doc_features_scope(doc):
+    # この中のフィルター呼び出しは、最初の呼び出しで作ったテーブルを共有する
+    if DOC_FEATURES_KEY in doc.user_data:
+        yield
+        return
+    doc.user_data[DOC_FEATURES_KEY] = None
+    try:
+        yield
+    finally:
+        doc.user_data.pop(DOC_FEATURES_KEY, None)
+
+
+def get_doc_features(doc):
+    # doc_features_scope の外では呼び出しのたびに作る
+    if DOC_FEATURES_KEY not in doc.user_data:
+        return DocFeatures(doc)
+    features = doc.user_data[DOC_FEATURES_KEY]
+    if features is None:
+        features = doc.user_data[DOC_FEATURES_KEY] = DocFeatures(doc)
+    return features
+
+
+# 汎用関数
+def filter_no_obj(token_ids, doc):
+    result = True
+    features = get_doc_features(doc)
+    if features.child_mask[token_ids[0]] & CHILD_DOBJ:
+        result = False
+    return result
+
+def filter_passive(token_ids, doc):
+    result = True
+    features = get_doc_features(doc)
+    if features.child_mask[token_ids[0]] & CHILD_AUXPASS:
+        result = False
+    return result
+
+def filter_past_participle_modifier(token_ids, doc):
+    result = True
+    features = get_doc_features(doc)
+    anchor_verb = token_ids[0]
+    if features.tag[anchor_verb] == ID_TAG_VBN:
+        # 現在完了形（have + VBN）または受動態（auxpass付き）の場合はTrue
+        # どちらの条件も満たさない場合（単独の過去分詞修飾語）のみFalse
+        if not features.child_mask[anchor_verb] & (CHILD_HAVE_AUX | CHILD_AUXPASS):
+            result = False
+    return result
+
+def word_order_check(anchor_verb, token, doc):
+    if token.i < anchor_verb.i:
+        return False
+    return True
+
+# DependencyMatcherのパターンを作成 ------------------------------------------------------------
+def create_vac_patterns():
 
     V_ncomp_pattern = [
     {
@@ -1686,38 +1930,759 @@ def create_dependency_matcher(nlp):
         }
     ]
 
-    # matcherにパターンを追加
-    matcher.add("V_n-comp", [V_ncomp_pattern])
-    matcher.add("V_pron-refl", [V_pron_refl_pattern])
-    matcher.add("V_adj", [V_adj_pattern])
-    matcher.add("V_ing", [V_ing_pattern1, V_ing_pattern2, V_ing_pattern3, V_ing_pattern4])
-    matcher.add("V_to-inf", [V_toinf_pattern1, V_toinf_pattern2, V_toinf_pattern3])
-    matcher.add("V_that", [V_that_pattern])
-    matcher.add("V_wh", [V_wh_pattern])
-    matcher.add("V_wh-to-inf", [V_whtoinf_pattern])
-    matcher.add("V_prep_n", [V_prep_n_pattern1, V_prep_n_pattern2, V_prep_n_pattern3])
-    matcher.add("V_by_ing", [V_by_ing_pattern])
-    matcher.add("V_out_of_n", [V_out_of_n_pattern])
-    matcher.add("V_onto_n", [V_onto_n_pattern1, V_onto_n_pattern2])
-    matcher.add("V_n_n-comp", [V_n_ncomp_pattern1, V_n_ncomp_pattern2, V_n_ncomp_pattern3])
-    matcher.add("V_n_n-obj", [V_n_nobj_pattern1, V_n_nobj_pattern2])
-    matcher.add("V_n_adj", [V_n_adj_pattern1, V_n_adj_pattern2, V_n_adj_pattern3])
-    matcher.add("V_n_to-inf", [V_n_toinf_pattern1, V_n_toinf_pattern2, V_n_toinf_pattern3])
-    matcher.add("V_n_inf", [V_n_inf_pattern1, V_n_inf_pattern2])
-    matcher.add("V_n_that", [V_n_that_pattern1, V_n_that_pattern2])
-    matcher.add("V_n_wh", [V_n_wh_pattern1, V_n_wh_pattern2])
-    matcher.add("V_n_wh-to-inf", [V_n_whtoinf_pattern1, V_n_whtoinf_pattern2])
-    matcher.add("V_n_V-ed", [V_n_Ved_pattern1, V_n_Ved_pattern2])
-    matcher.add("V_n_ing", [V_n_ing_pattern1, V_n_ing_pattern2, V_n_ing_pattern3, V_n_ing_pattern4])
-    matcher.add("V_way_prep/adv", [V_way_pattern])
-    matcher.add("V_n_prep_n", [V_n_prep_n_pattern1, V_n_prep_n_pattern2])
-    matcher.add("V_n_out_of_n", [V_n_out_of_n_pattern1, V_n_out_of_n_pattern2])
-    matcher.add("it_V_n/adj_to-inf", [it_V_nadj_toinf_pattern1, it_V_nadj_toinf_pattern2])
-    matcher.add("it_V_(n/adj)_that", [it_V_that_pattern1])
-    matcher.add("V_for_n_to-inf", [V_for_n_toinf_pattern])
-    matcher.add("V_it_n/adj_clause", [V_it_nadj_clause_pattern1, V_it_nadj_clause_pattern2])
+    # ラベルごとのパターン（matcherへの追加順がそのまま優先順位の同点時の順序になる）
+    vac_patterns = {
+        "V_n-comp": [V_ncomp_pattern],
+        "V_pron-refl": [V_pron_refl_pattern],
+        "V_adj": [V_adj_pattern],
+        "V_ing": [V_ing_pattern1, V_ing_pattern2, V_ing_pattern3, V_ing_pattern4],
+        "V_to-inf": [V_toinf_pattern1, V_toinf_pattern2, V_toinf_pattern3],
+        "V_that": [V_that_pattern],
+        "V_wh": [V_wh_pattern],
+        "V_wh-to-inf": [V_whtoinf_pattern],
+        "V_prep_n": [V_prep_n_pattern1, V_prep_n_pattern2, V_prep_n_pattern3],
+        "V_by_ing": [V_by_ing_pattern],
+        "V_out_of_n": [V_out_of_n_pattern],
+        "V_onto_n": [V_onto_n_pattern1, V_onto_n_pattern2],
+        "V_n_n-comp": [V_n_ncomp_pattern1, V_n_ncomp_pattern2, V_n_ncomp_pattern3],
+        "V_n_n-obj": [V_n_nobj_pattern1, V_n_nobj_pattern2],
+        "V_n_adj": [V_n_adj_pattern1, V_n_adj_pattern2, V_n_adj_pattern3],
+        "V_n_to-inf": [V_n_toinf_pattern1, V_n_toinf_pattern2, V_n_toinf_pattern3],
+        "V_n_inf": [V_n_inf_pattern1, V_n_inf_pattern2],
+        "V_n_that": [V_n_that_pattern1, V_n_that_pattern2],
+        "V_n_wh": [V_n_wh_pattern1, V_n_wh_pattern2],
+        "V_n_wh-to-inf": [V_n_whtoinf_pattern1, V_n_whtoinf_pattern2],
+        "V_n_V-ed": [V_n_Ved_pattern1, V_n_Ved_pattern2],
+        "V_n_ing": [V_n_ing_pattern1, V_n_ing_pattern2, V_n_ing_pattern3, V_n_ing_pattern4],
+        "V_way_prep/adv": [V_way_pattern],
+        "V_n_prep_n": [V_n_prep_n_pattern1, V_n_prep_n_pattern2],
+        "V_n_out_of_n": [V_n_out_of_n_pattern1, V_n_out_of_n_pattern2],
+        "it_V_n/adj_to-inf": [it_V_nadj_toinf_pattern1, it_V_nadj_toinf_pattern2],
+        "it_V_(n/adj)_that": [it_V_that_pattern1],
+        "V_for_n_to-inf": [V_for_n_toinf_pattern],
+        "V_it_n/adj_clause": [V_it_nadj_clause_pattern1, V_it_nadj_clause_pattern2],
+    }
+
+    return vac_patterns
 
-    return matcher
+
+# TAGのREGEX制約を、パイプラインのタグ集合に基づくIN制約へ変換する
+# （REGEXはトークンごとに正規表現を評価するため、matcher(doc)の大半を占める）
+PTB_TAGS = [
+    "$", "''", ",", "-LRB-", "-RRB-", ".", ":", "ADD", "AFX", "CC", "CD", "DT", "EX", "FW",
+    "HYPH", "IN", "JJ", "JJR", "JJS", "LS", "MD", "NFP", "NN", "NNP", "NNPS", "NNS", "PDT",
+    "POS", "PRP", "PRP$", "RB", "RBR", "RBS", "RP", "SYM", "TO", "UH", "VB", "VBD", "VBG",
+    "VBN", "VBP", "VBZ", "WDT", "WP", "WP$", "WRB", "XX", "_SP", "``"
+]
+
+
+def get_tag_inventory(nlp):
+    # taggerのラベルとPTBタグ集合の和集合（タグの取りこぼしがあるとマッチが減るため、多めに取る）
+    tags = set(PTB_TAGS)
+    for name, pipe in nlp.pipeline:
+        if isinstance(pipe, Tagger):
+            tags.update(pipe.labels)
+    return sorted(tags)
+
+
+def compile_tag_regex(vac_patterns, tag_inventory):
+    compiled_patterns = {}
+    regex_cache = {}
+    for label, patterns in vac_patterns.items():
+        compiled_patterns[label] = []
+        for pattern in patterns:
+            compiled_pattern = []
+            for node in pattern:
+                node = dict(node)
+                attrs = dict(node["RIGHT_ATTRS"])
+                tag_attr = attrs.get("TAG")
+                if isinstance(tag_attr, dict) and set(tag_attr) == {"REGEX"}:
+                    regex = tag_attr["REGEX"]
+                    if regex not in regex_cache:
+                        compiled = re.compile(regex)
+                        # spaCyのREGEXはre.searchで評価される
+                        regex_cache[regex] = [tag for tag in tag_inventory if compiled.search(tag)]
+                    attrs["TAG"] = {"IN": regex_cache[regex]}
+                node["RIGHT_ATTRS"] = attrs
+                compiled_pattern.append(node)
+            compiled_patterns[label].append(compiled_pattern)
+    return compiled_patterns
+
+
+def count_regex_constraints(vac_patterns):
+    count = 0
+    for patterns in vac_patterns.values():
+        for pattern in patterns:
+            for node in pattern:
+                for value in node["RIGHT_ATTRS"].values():
+                    if isinstance(value, dict) and "REGEX" in value:
+                        count += 1
+    return count
+
+
+# フィルターの条件のうちパターンで表せるものを DependencyMatcher に押し下げる ------------------------------------------------------------
+# after_anchor: word_order_check などで動詞より後ろに限定されるノード (パターン内の位置, そのノードに必要なDEP)
+#   動詞から ">" で直接つながるノードだけを ">++"（右側の子）に書き換える
+# anchor_not_in: 動詞がこの値ならフィルターが必ず False を返す属性値
+# フィルター側の判定はそのまま残す（押し下げはマッチ数を減らすだけで結果は変わらない）
+filter_pushdown_dict = {
+    "V_pron-refl": {"after_anchor": [(1, None)]},
+    "V_ing": {"after_anchor": [(1, None)], "anchor_not_in": {"LEMMA": ["be"]}},
+    "V_to-inf": {"after_anchor": [(1, None)], "anchor_not_in": {"LEMMA": ["have", "be"], "LOWER": ["used"]}},
+    "V_that": {"after_anchor": [(1, None)], "anchor_not_in": {"LEMMA": ["be"]}},
+    # 疑問詞は動詞より後ろ、かつ ccomp より前にあるので ccomp も動詞より後ろ
+    "V_wh": {"after_anchor": [(1, None)], "anchor_not_in": {"LEMMA": ["be"]}},
+    "V_wh-to-inf": {"after_anchor": [(1, None)], "anchor_not_in": {"LEMMA": ["be"]}},
+    # prepが2番目のノードのパターン（advmodを挟むパターンはprepが動詞の子ではない）
+    "V_prep_n": {"after_anchor": [(1, "prep")]},
+    "V_by_ing": {"after_anchor": [(1, None)]},
+    "V_out_of_n": {"after_anchor": [(1, None)]},
+    "V_onto_n": {"after_anchor": [(1, None)]},
+    "V_n_n-comp": {"after_anchor": [(1, None)]},
+    "V_n_adj": {"after_anchor": [(1, None)]},
+    "V_n_to-inf": {"after_anchor": [(1, None)]},
+    "V_n_inf": {"after_anchor": [(1, None)]},
+    "V_n_that": {"after_anchor": [(1, None)]},
+    "V_n_wh": {"after_anchor": [(1, None)]},
+    "V_n_wh-to-inf": {"after_anchor": [(2, None)]},
+    "V_n_V-ed": {"after_anchor": [(1, None)]},
+    "V_n_ing": {"after_anchor": [(1, None)]},
+    "V_way_prep/adv": {"after_anchor": [(3, None)]},
+    "V_n_prep_n": {"after_anchor": [(1, None)]},
+    "V_n_out_of_n": {"after_anchor": [(1, None)]},
+    "it_V_n/adj_to-inf": {"after_anchor": [(1, None)]},
+    "it_V_(n/adj)_that": {"after_anchor": [(1, None)]},
+}
+
+
+def _allowed_values(value):
+    # 完全一致かIN制約なら許される値の集合、それ以外（NOT_IN, REGEXなど）は None
+    if isinstance(value, dict):
+        if set(value) != {"IN"}:
+            return None
+        return set(value["IN"])
+    return {value}
+
+
+def _attrs_imply(attrs, other_attrs):
+    # attrs に一致するトークンは必ず other_attrs にも一致するか
+    for attr_name, other_value in other_attrs.items():
+        if attr_name not in attrs:
+            return False
+        if attrs[attr_name] == other_value:
+            continue
+        allowed = _allowed_values(attrs[attr_name])
+        other_allowed = _allowed_values(other_value)
+        if allowed is None or other_allowed is None or not allowed <= other_allowed:
+            return False
+    return True
+
+
+def push_down_filter_constraints(vac_patterns, pushdown_dict=None):
+    if pushdown_dict is None:
+        pushdown_dict = filter_pushdown_dict
+    pushed_patterns = {}
+    for label, patterns in vac_patterns.items():
+        spec = pushdown_dict.get(label, {})
+        pushed_patterns[label] = []
+        for pattern in patterns:
+            pattern = [dict(node, RIGHT_ATTRS=dict(node.get("RIGHT_ATTRS", {}))) for node in pattern]
+            root_id = pattern[0]["RIGHT_ID"]
+            for j, dep in spec.get("after_anchor", []):
+                if j >= len(pattern):
+                    continue
+                node = pattern[j]
+                if node.get("LEFT_ID") != root_id or node.get("REL_OP") != ">":
+                    continue
+                if dep is not None and _allowed_values(node["RIGHT_ATTRS"].get("DEP")) != {dep}:
+                    continue
+                node["REL_OP"] = ">++"
+            pushed_patterns[label].append(pattern)
+
+    # DependencyMatcher は文の根を「いずれかのノードに一致する最初のトークン」の順に走査するため、
+    # 動詞の属性を絞り込むのは、元の動詞ノードに一致するトークンを絞り込まない別のノードがすべて拾う場合に限る
+    # （そうでないと複数の文を含む文書でマッチの順序が変わる）
+    unrestricted = [
+        node["RIGHT_ATTRS"]
+        for label, patterns in pushed_patterns.items()
+        for pattern in patterns
+        for j, node in enumerate(pattern)
+        if j > 0 or not pushdown_dict.get(label, {}).get("anchor_not_in")
+    ]
+    for label, patterns in pushed_patterns.items():
+        anchor_not_in = pushdown_dict.get(label, {}).get("anchor_not_in")
+        if not anchor_not_in:
+            continue
+        for pattern in patterns:
+            attrs = pattern[0]["RIGHT_ATTRS"]
+            if any(attr_name in attrs for attr_name in anchor_not_in):
+                continue
+            if not any(_attrs_imply(attrs, other_attrs) for other_attrs in unrestricted):
+                continue
+            for attr_name, values in anchor_not_in.items():
+                attrs[attr_name] = {"NOT_IN": list(values)}
+    return pushed_patterns
+
+
+# 配列演算による DependencyMatcher ------------------------------------------------------------
+# DependencyMatcher と同じマッチ（順序も含む）を Doc.to_array の配列に対するNumPy演算で求める
+# 対応するのはVACパターンで使う範囲（根が先頭ノード、LEFT_IDは前のノード、演算子は < > >++ >> . ;）
+ARRAY_MATCHER_ATTRS = {"ORTH": ORTH, "TEXT": ORTH, "LOWER": LOWER, "NORM": NORM, "LEMMA": LEMMA, "POS": POS, "TAG": TAG, "DEP": DEP}
+ARRAY_MATCHER_OPS = ("<", ">", ">++", ">>", ".", ";")
+# 未解析の文書に対して DependencyMatcher と同じエラーを出すための対応表
+_ANNOTATION_PIPES = {TAG: "tagger", POS: "morphologizer or tagger+attribute_ruler", LEMMA: "lemmatizer", DEP: "parser"}
+
+
+class ArrayDependencyMatcher:
+    def __init__(self, vocab):
+        self.vocab = vocab
+        self._keys = []
+        self._patterns = {}
+        self._node_index = {}
+        self._node_checks = []
+        self._seen_attrs = set()
+        self._columns = [HEAD]
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, key):
+        return self.vocab.strings.add(key) in self._patterns
+
+    def _add_node(self, right_attrs):
+        signature = json.dumps(right_attrs, sort_keys=True)
+        if signature in self._node_index:
+            return self._node_index[signature]
+        checks = []
+        for attr_name, value in right_attrs.items():
+            if attr_name not in ARRAY_MATCHER_ATTRS:
+                raise ValueError(f"ArrayDependencyMatcher does not support the attribute {attr_name!r}.")
+            attr = ARRAY_MATCHER_ATTRS[attr_name]
+            if attr not in self._columns:
+                self._columns.append(attr)
+            column = self._columns.index(attr)
+            if not isinstance(value, dict):
+                # 値の比較は Matcher と同じく StringStore のIDで行う
+                self._seen_attrs.add(attr)
+                checks.append((column, "IN", np.array([self._value_id(value)], dtype="uint64")))
+                continue
+            for predicate, argument in value.items():
+                if predicate in ("IN", "NOT_IN"):
+                    checks.append((column, predicate, np.array([self._value_id(v) for v in argument], dtype="uint64")))
+                elif predicate == "REGEX":
+                    checks.append((column, predicate, re.compile(argument)))
+                else:
+                    raise ValueError(f"ArrayDependencyMatcher does not support the predicate {predicate!r}.")
+        self._node_checks.append(checks)
+        self._node_index[signature] = len(self._node_checks) - 1
+        return self._node_index[signature]
+
+    def _value_id(self, value):
+        if isinstance(value, str):
+            return self.vocab.strings.add(value)
+        return int(value)
+
+    def add(self, key, patterns, *, on_match=None):
+        if on_match is not None:
+            raise ValueError("ArrayDependencyMatcher does not support on_match callbacks.")
+        key_id = self.vocab.strings.add(key)
+        compiled = []
+        for pattern in patterns:
+            if len(pattern) == 0:
+                raise ValueError(f"Empty dependency pattern for {key!r}.")
+            positions = {node["RIGHT_ID"]: j for j, node in enumerate(pattern)}
+            nodes = []
+            parents = []
+            for j, node in enumerate(pattern):
+                if j == 0:
+                    if "REL_OP" in node or "LEFT_ID" in node:
+                        raise ValueError(f"ArrayDependencyMatcher requires the root to be the first node ({key!r}).")
+                    parents.append(None)
+                else:
+                    op = node["REL_OP"]
+                    left = positions[node["LEFT_ID"]]
+                    if op not in ARRAY_MATCHER_OPS:
+                        raise ValueError(f"ArrayDependencyMatcher does not support the operator {op!r}.")
+                    if left >= j:
+                        raise ValueError(f"ArrayDependencyMatcher requires LEFT_ID to refer to an earlier node ({key!r}).")
+                    parents.append((left, op))
+                nodes.append(self._add_node(node.get("RIGHT_ATTRS", {})))
+            compiled.append((nodes, parents))
+        if key_id not in self._patterns:
+            self._keys.append(key_id)
+            self._patterns[key_id] = []
+        self._patterns[key_id].extend(compiled)
+
+    def __call__(self, doclike):
+        if isinstance(doclike, Span):
+            doclike = doclike.as_doc(copy_user_data=True)
+        return self.match_docs([doclike])[0]
+
+    def _check_annotation(self, doc):
+        for attr, pipe in _ANNOTATION_PIPES.items():
+            if attr in self._seen_attrs and not doc.has_annotation(attr):
+                raise ValueError(Errors.E155.format(pipe=pipe, attr=self.vocab.strings.as_string(attr)))
+
+    def _node_mask(self, arr, node, cache):
+        if node not in cache:
+            mask = np.ones(len(arr), dtype=bool)
+            for column, predicate, argument in self._node_checks[node]:
+                values = arr[:, column]
+                if predicate == "REGEX":
+                    unique = np.unique(values)
+                    argument = np.array([v for v in unique.tolist() if argument.search(self.vocab.strings[v])], dtype="uint64")
+                    predicate = "IN"
+                if predicate == "IN":
+                    mask &= np.isin(values, argument)
+                else:
+                    mask &= ~np.isin(values, argument)
+            cache[node] = mask
+        return cache[node]
+
+    def match_docs(self, docs):
+        # 複数の文書を連結した配列上でまとめてマッチングする
+        docs = list(docs)
+        for doc in docs:
+            self._check_annotation(doc)
+        results = [[] for _ in docs]
+        lengths = np.array([len(doc) for doc in docs], dtype="int64")
+        n_tokens = int(lengths.sum())
+        if n_tokens == 0 or not self._keys:
+            return results
+        offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+        arr = np.concatenate([doc.to_array(self._columns) for doc in docs if len(doc)])
+        index = np.arange(n_tokens, dtype="int64")
+        heads = arr[:, 0].view("int64") + index
+        tree = _ArrayTree(heads, index, docs, offsets)
+
+        mask_cache = {}
+        any_mask = np.zeros(n_tokens, dtype=bool)
+        for node in range(len(self._node_checks)):
+            any_mask |= self._node_mask(arr, node, mask_cache)
+        # DependencyMatcher は文の根を「いずれかのノードに一致した最初のトークン」の順に走査する
+        matched = np.flatnonzero(any_mask)
+        root_order = np.full(n_tokens, n_tokens, dtype="int64")
+        unique_roots, first = np.unique(tree.roots[matched], return_index=True)
+        root_order[unique_roots] = matched[first]
+
+        for key_id in self._keys:
+            for nodes, parents in self._patterns[key_id]:
+                rows = self._match_pattern(nodes, parents, arr, tree, mask_cache)
+                if len(rows) == 0:
+                    continue
+                sort_keys = [rows[:, j] for j in range(rows.shape[1] - 1, -1, -1)]
+                sort_keys.append(root_order[tree.roots[rows[:, 0]]])
+                rows = rows[np.lexsort(sort_keys)]
+                doc_index = np.searchsorted(offsets, rows[:, 0], side="right") - 1
+                rows = rows - offsets[doc_index][:, None]
+                for d, row in zip(doc_index.tolist(), rows.tolist()):
+                    results[d].append((key_id, row))
+        return results
+
+    def _match_pattern(self, nodes, parents, arr, tree, mask_cache):
+        rows = np.flatnonzero(self._node_mask(arr, nodes[0], mask_cache))[:, None]
+        for j in range(1, len(nodes)):
+            if len(rows) == 0:
+                break
+            left, op = parents[j]
+            mask = self._node_mask(arr, nodes[j], mask_cache)
+            left_pos = rows[:, left]
+            if op == "<":
+                right = tree.heads[left_pos]
+                keep = (right != left_pos) & mask[right]
+                rows = np.column_stack([rows[keep], right[keep]])
+            elif op == ".":
+                right = np.minimum(left_pos + 1, len(mask) - 1)
+                sent_root = tree.roots[left_pos]
+                keep = (left_pos + 1 < len(mask)) & (left_pos + 1 <= tree.sentence_right_edge(sent_root)) & mask[right]
+                keep &= tree.roots[right] == tree.roots[rows[:, 0]]
+                rows = np.column_stack([rows[keep], right[keep]])
+            elif op == ";":
+                right = np.maximum(left_pos - 1, 0)
+                sent_root = tree.roots[left_pos]
+                keep = (left_pos > 0) & (left_pos - 1 >= tree.sentence_left_edge(sent_root)) & mask[right]
+                keep &= tree.roots[right] == tree.roots[rows[:, 0]]
+                rows = np.column_stack([rows[keep], right[keep]])
+            else:
+                candidates = np.flatnonzero(mask)
+                if op in (">", ">++"):
+                    if op == ">":
+                        candidates = candidates[tree.heads[candidates] != candidates]
+                    else:
+                        candidates = candidates[tree.heads[candidates] < candidates]
+                    row_index, right = _expand_groups(left_pos, candidates, tree.heads[candidates])
+                else:
+                    row_index, right = _expand_groups(tree.roots[left_pos], candidates, tree.roots[candidates])
+                    keep = tree.is_ancestor(left_pos[row_index], right)
+                    row_index = row_index[keep]
+                    right = right[keep]
+                rows = np.column_stack([rows[row_index], right])
+        return rows
+
+
+def _expand_groups(keys, candidates, candidate_keys):
+    # 各行の keys と一致する candidate_keys を持つ候補をすべて列挙する（行番号, 候補）
+    order = np.argsort(candidate_keys, kind="stable")
+    sorted_keys = candidate_keys[order]
+    lo = np.searchsorted(sorted_keys, keys, side="left")
+    hi = np.searchsorted(sorted_keys, keys, side="right")
+    counts = hi - lo
+    row_index = np.repeat(np.arange(len(keys)), counts)
+    starts = np.repeat(lo - (np.cumsum(counts) - counts), counts)
+    return row_index, candidates[order[np.arange(len(row_index)) + starts]]
+
+
+class _ArrayTree:
+    # 連結した文書の係り受け木（根・文の範囲・祖先判定）
+    def __init__(self, heads, index, docs, offsets):
+        self.heads = heads
+        self.index = index
+        self.docs = docs
+        self.offsets = offsets
+        roots = heads
+        for _ in range(64):
+            next_roots = roots[roots]
+            if np.array_equal(next_roots, roots):
+                break
+            roots = next_roots
+        self.roots = roots
+        self._edges = {"left_edge": {}, "right_edge": {}}
+        self._up = None
+
+    def sentence_right_edge(self, sent_roots):
+        # DependencyMatcher の "." が使う文の範囲は root.right_edge（非射影木では部分木の右端と一致しないことがある）
+        return self._sentence_edge(sent_roots, "right_edge")
+
+    def sentence_left_edge(self, sent_roots):
+        # ";" が使う文の範囲の左端 root.left_edge
+        return self._sentence_edge(sent_roots, "left_edge")
+
+    def _sentence_edge(self, sent_roots, edge):
+        edges = self._edges[edge]
+        unique_roots = np.unique(sent_roots)
+        doc_index = np.searchsorted(self.offsets, unique_roots, side="right") - 1
+        for root, d in zip(unique_roots.tolist(), doc_index.tolist()):
+            if root not in edges:
+                offset = int(self.offsets[d])
+                edges[root] = getattr(self.docs[d][root - offset], edge).i + offset
+        return np.array([edges[root] for root in sent_roots.tolist()], dtype="int64")
+
+    def _build_lifting(self):
+        up = [self.heads]
+        while len(up) < 64:
+            nxt = up[-1][up[-1]]
+            if np.array_equal(nxt, up[-1]):
+                break
+            up.append(nxt)
+        depth = np.zeros(len(self.heads), dtype="int64")
+        current = self.index.copy()
+        for k in range(len(up) - 1, -1, -1):
+            nxt = up[k][current]
+            move = nxt != self.roots
+            depth[move] += 1 << k
+            current[move] = nxt[move]
+        depth[current != self.roots] += 1
+        self._up = up
+        self.depth = depth
+
+    def is_ancestor(self, ancestors, nodes):
+        if self._up is None:
+            self._build_lifting()
+        diff = self.depth[nodes] - self.depth[ancestors]
+        current = nodes.copy()
+        for k in range(len(self._up)):
+            bit = (diff > 0) & ((diff >> k) & 1 == 1)
+            current[bit] = self._up[k][current[bit]]
+        return (diff > 0) & (current == ancestors)
+
+
+# 文書単位の事前スクリーニング ------------------------------------------------------------
+# 各ラベルのパターンが必要とする DEP/TAG/LEMMA などの値をパターンから自動で導出し、
+# 文書のどの文にもその値がそろわなければそのラベルはマッチングしない（必要条件のみを使うので結果は変わらない）
+def get_sentence_blocks(heads):
+    # heads: doc.to_array([HEAD]) の列（係り先への相対位置）
+    # 係り受け木ごとの (start, end) を返す。木がトークン列の連続した区間になっていなければ None
+    # 連続していれば DependencyMatcher は根を文の順に走査するため、ラベルごとのマッチャーの結果を
+    # ラベル順に連結すると全体のマッチャーと同じ順序になる
+    n_tokens = len(heads)
+    roots = np.arange(n_tokens, dtype="int64") + heads.view("int64")
+    for _ in range(64):
+        next_roots = roots[roots]
+        if np.array_equal(next_roots, roots):
+            break
+        roots = next_roots
+    if np.any(roots[1:] < roots[:-1]):
+        return None
+    starts = np.flatnonzero(np.diff(roots, prepend=-1)).tolist()
+    return list(zip(starts, starts[1:] + [n_tokens]))
+
+
+class PrescreenDependencyMatcher:
+    def __init__(self, nlp, compiled_patterns, validate=True, engine="spacy"):
+        self.nlp = nlp
+        self.vocab = nlp.vocab
+        self.labels = list(compiled_patterns)
+        self._columns = []
+        self._value_bits = []
+        self._label_requirements = {label: self._pattern_requirements(patterns) for label, patterns in compiled_patterns.items()}
+        # ラベルごとのマッチャー（文が連続した文書ではラベル順に連結すれば全体のマッチャーと同じ順序になる）
+        self.label_matchers = {
+            label: _build_matcher_from_patterns(nlp, {label: patterns}, validate=validate, engine=engine)
+            for label, patterns in compiled_patterns.items()
+        }
+        self._compiled_patterns = compiled_patterns
+        self._validate = validate
+        self._engine = engine
+        self._full_matcher = None
+        self.stats = {"docs": 0, "fallback_docs": 0, "labels_run": 0}
+
+    @property
+    def full_matcher(self):
+        # 文が入り組んだ文書にしか使わないため、最初に必要になったときに作る
+        if self._full_matcher is None:
+            self._full_matcher = _build_matcher_from_patterns(self.nlp, self._compiled_patterns, validate=self._validate, engine=self._engine)
+        return self._full_matcher
+
+    def _pattern_requirements(self, patterns):
+        # パターンごとに「文書内に少なくとも1語は必要な値の集合」のビットマスクのリストを作る
+        requirements = []
+        for pattern in patterns:
+            masks = []
+            for node in pattern:
+                for attr_name, value in node.get("RIGHT_ATTRS", {}).items():
+                    attr = ARRAY_MATCHER_ATTRS.get(attr_name)
+                    if attr is None:
+                        continue
+                    if isinstance(value, dict):
+                        if set(value) != {"IN"}:
+                            continue
+                        values = value["IN"]
+                    else:
+                        values = [value]
+                    if attr not in self._columns:
+                        self._columns.append(attr)
+                        self._value_bits.append({})
+                    value_bits = self._value_bits[self._columns.index(attr)]
+                    mask = 0
+                    for v in values:
+                        value_id = self.vocab.strings.add(v) if isinstance(v, str) else int(v)
+                        if value_id not in value_bits:
+                            value_bits[value_id] = 1 << sum(len(bits) for bits in self._value_bits)
+                        mask |= value_bits[value_id]
+                    masks.append(mask)
+            requirements.append(masks)
+        return requirements
+
+    def select_labels(self, doc):
+        # パターンは1つの係り受け木の中でしかマッチしないため、必要な値は文ごとにそろっている必要がある
+        # 木がトークン列の連続した区間になっていない文書では、DependencyMatcher の根の走査順が全ラベルのパターンに依存するため、
+        # マッチの順序を保つために全体のマッチャーを使う（None を返す）
+        self.stats["docs"] += 1
+        if len(doc) == 0:
+            return ()
+        sentence_labels = self.sentence_labels(doc)
+        if sentence_labels is None:
+            self.stats["fallback_docs"] += 1
+            self.stats["labels_run"] += len(self.labels)
+            return None
+        labels = set().union(*sentence_labels)
+        selected = tuple(label for label in self.labels if label in labels)
+        self.stats["labels_run"] += len(selected)
+        return selected
+
+    def sentence_labels(self, doc):
+        # 文ごとに、必要な値がすべてそろうラベルの集合を返す（木が入り組んだ文書では None）
+        arr = doc.to_array([HEAD] + self._columns)
+        blocks = get_sentence_blocks(arr[:, 0])
+        if blocks is None:
+            return None
+        sentence_labels = []
+        for start, end in blocks:
+            bits = 0
+            for column, value_bits in enumerate(self._value_bits, start=1):
+                for value_id in set(arr[start:end, column].tolist()) & value_bits.keys():
+                    bits |= value_bits[value_id]
+            sentence_labels.append({
+                label for label in self.labels
+                if any(all(bits & mask for mask in masks) for masks in self._label_requirements[label])
+            })
+        return sentence_labels
+
+    def __call__(self, doclike):
+        if isinstance(doclike, Span):
+            doclike = doclike.as_doc(copy_user_data=True)
+        labels = self.select_labels(doclike)
+        if labels is None:
+            return self.full_matcher(doclike)
+        matches = []
+        for label in labels:
+            matches.extend(self.label_matchers[label](doclike))
+        return matches
+
+    def match_docs(self, docs):
+        # ラベルごとに、そのラベルが必要な文書だけをまとめてマッチングする
+        docs = list(docs)
+        results = [[] for _ in docs]
+        label_docs = defaultdict(list)
+        fallback = []
+        for i, doc in enumerate(docs):
+            labels = self.select_labels(doc)
+            if labels is None:
+                fallback.append(i)
+                continue
+            for label in labels:
+                label_docs[label].append(i)
+        for label in self.labels:
+            indices = label_docs.get(label)
+            if not indices:
+                continue
+            for i, matches in zip(indices, match_VAC_batch([docs[i] for i in indices], self.label_matchers[label])):
+                results[i].extend(matches)
+        if fallback:
+            for i, matches in zip(fallback, match_VAC_batch([docs[i] for i in fallback], self.full_matcher)):
+                results[i] = matches
+        return results
+
+
+# DependencyMatcherを作成 ------------------------------------------------------------
+MATCHER_ENGINES = ("spacy", "array")
+
+
+def select_label_patterns(vac_patterns, labels):
+    # 指定したラベルのパターンだけを、元のラベル順のまま取り出す
+    unknown = set(labels) - set(vac_patterns)
+    if unknown:
+        raise ValueError(f"Unknown matcher labels: {sorted(unknown)}")
+    return {label: patterns for label, patterns in vac_patterns.items() if label in labels}
+
+
+class SelectionDependencyMatcher:
+    # 指定したラベルのマッチがあった文書だけで競合ラベルをマッチングする
+    # マッチは1つのマッチャーと同じくラベル順に並べる（ラベル内の順序はそのまま）
+    def __init__(self, nlp, compiled_patterns, selection, validate=True, engine="spacy", prescreen=False, lexicon=None):
+        self.selection = selection
+        self.labels = list(selection.labels)
+        target_patterns = select_label_patterns(compiled_patterns, [label for label in self.labels if label in selection.targets])
+        competitor_patterns = select_label_patterns(compiled_patterns, [label for label in self.labels if label not in selection.targets])
+        self.target_matcher = _build_matcher_from_patterns(nlp, target_patterns, validate=validate, engine=engine, prescreen=prescreen, lexicon=lexicon)
+        self.competitor_matcher = None
+        if competitor_patterns:
+            self.competitor_matcher = _build_matcher_from_patterns(nlp, competitor_patterns, validate=validate, engine=engine, prescreen=prescreen, lexicon=lexicon)
+        self._label_rank = {nlp.vocab.strings.add(label): rank for rank, label in enumerate(self.labels)}
+        self.stats = {"docs": 0, "competitor_docs": 0}
+
+    def _merge(self, target_matches, competitor_matches):
+        matches = list(target_matches) + list(competitor_matches)
+        matches.sort(key=lambda match: self._label_rank[match[0]])
+        return matches
+
+    def __call__(self, doclike):
+        self.stats["docs"] += 1
+        matches = self.target_matcher(doclike)
+        if not matches or self.competitor_matcher is None:
+            return matches
+        self.stats["competitor_docs"] += 1
+        return self._merge(matches, self.competitor_matcher(doclike))
+
+    def match_docs(self, docs):
+        docs = list(docs)
+        self.stats["docs"] += len(docs)
+        results = match_VAC_batch(docs, self.target_matcher)
+        hits = [i for i, matches in enumerate(results) if matches]
+        if hits and self.competitor_matcher is not None:
+            self.stats["competitor_docs"] += len(hits)
+            for i, matches in zip(hits, match_VAC_batch([docs[i] for i in hits], self.competitor_matcher)):
+                results[i] = self._merge(results[i], matches)
+        return results
+
+
+def create_dependency_matcher(nlp, compile_tags=True, engine="spacy", prescreen=False, push_down=True, selection=None, lexicon=None):
+    vac_patterns = create_vac_patterns()
+    if compile_tags:
+        vac_patterns = compile_tag_regex(vac_patterns, get_tag_inventory(nlp))
+    if push_down:
+        vac_patterns = push_down_filter_constraints(vac_patterns)
+
+    return _build_matcher_from_patterns(nlp, vac_patterns, engine=engine, prescreen=prescreen, selection=selection, lexicon=lexicon)
+
+
+def _time_matcher(matcher, docs, repeat):
+    best = float("inf")
+    matches = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        matches = [matcher(doc) for doc in docs]
+        best = min(best, time.perf_counter() - start)
+    return best, matches
+
+
+def benchmark_tag_compilation(docs, nlp, repeat=3):
+    # 参照コーパス上で REGEX版 と IN版 の matcher(doc) の時間を比較する（マッチ結果が同一であることも確認）
+    regex_matcher = create_dependency_matcher(nlp, compile_tags=False)
+    compiled_matcher = create_dependency_matcher(nlp, compile_tags=True)
+
+    regex_seconds, regex_matches = _time_matcher(regex_matcher, docs, repeat)
+    compiled_seconds, compiled_matches = _time_matcher(compiled_matcher, docs, repeat)
+    if regex_matches != compiled_matches:
+        raise RuntimeError("Compiled TAG constraints changed the matcher output.")
+
+    return {
+        "docs": len(docs),
+        "tokens": sum(len(doc) for doc in docs),
+        "regex_constraints": count_regex_constraints(create_vac_patterns()),
+        "regex_seconds": regex_seconds,
+        "compiled_seconds": compiled_seconds,
+        "saved_seconds": regex_seconds - compiled_seconds,
+        "speedup": regex_seconds / compiled_seconds if compiled_seconds > 0 else float("inf"),
+    }
+
+
+def benchmark_matcher_engines(docs, nlp, repeat=3, batch_size=256):
+    # 参照コーパス上で spaCy の DependencyMatcher と配列エンジンの時間を比較し、マッチが完全に一致することを確認する
+    spacy_matcher = create_dependency_matcher(nlp, engine="spacy")
+    array_matcher = create_dependency_matcher(nlp, engine="array")
+    batches = [docs[i:i + batch_size] for i in range(0, len(docs), batch_size)]
+
+    spacy_seconds, spacy_matches = _time_matcher(spacy_matcher, docs, repeat)
+    array_seconds = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        array_matches = [matches for batch in batches for matches in array_matcher.match_docs(batch)]
+        array_seconds = min(array_seconds, time.perf_counter() - start)
+
+    for doc, expected, actual in zip(docs, spacy_matches, array_matches):
+        if expected != actual:
+            raise RuntimeError(f"Array matcher output differs from DependencyMatcher on: {doc.text!r}")
+    return {
+        "docs": len(docs),
+        "tokens": sum(len(doc) for doc in docs),
+        "matches": sum(len(matches) for matches in spacy_matches),
+        "spacy_seconds": spacy_seconds,
+        "array_seconds": array_seconds,
+        "speedup": spacy_seconds / array_seconds if array_seconds > 0 else float("inf"),
+    }
+
+
+def report_pushdown_match_counts(docs, nlp):
+    # 押し下げの前後でラベルごとの生のマッチ数（＝フィルター呼び出し数）を数え、抽出結果が同一であることを確認する
+    plain_matcher = create_dependency_matcher(nlp, push_down=False)
+    pushed_matcher = create_dependency_matcher(nlp, push_down=True)
+    counts = {label: [0, 0] for label in create_vac_patterns()}
+    for doc in docs:
+        plain_matches = plain_matcher(doc)
+        pushed_matches = pushed_matcher(doc)
+        for match_id, _ in plain_matches:
+            counts[nlp.vocab.strings[match_id]][0] += 1
+        for match_id, _ in pushed_matches:
+            counts[nlp.vocab.strings[match_id]][1] += 1
+        if extract_VAC(doc, plain_matcher, nlp, matches=plain_matches) != extract_VAC(doc, pushed_matcher, nlp, matches=pushed_matches):
+            raise RuntimeError(f"Pushed-down constraints changed the extracted VACs on: {doc.text!r}")
+    return {
+        "docs": len(docs),
+        "labels": {label: {"before": before, "after": after} for label, (before, after) in counts.items()},
+        "before": sum(before for before, _ in counts.values()),
+        "after": sum(after for _, after in counts.values()),
+    }
 
 ## フィルター関数群 ------------------------------------------------------------
 def filter_V_ncomp(token_ids, doc):
@@ -1733,15 +2698,13 @@ def filter_V_ncomp(token_ids, doc):
     # if not word_order_check(anchor_verb, comp_token, doc):
     #     return False
     
+    features = get_doc_features(doc)
     # there is構文を除外
-    if any(child.dep_ == "expl" for child in anchor_verb.children):
+    if features.child_mask[anchor_verb.i] & CHILD_EXPL:
         return False
     
     # be oneselfを除外
-    if comp_token.lemma_.lower() in [
-        "myself", "yourself", "yourselves", "ourselves", "himself", 
-        "herself", "itself", "themselves", "oneself"
-        ]:
+    if features.lemma_lower[comp_token.i] in REFLEXIVE_PRONOUN_IDS:
         return False
     
     return result
@@ -1774,23 +2737,15 @@ def filter_V_adj(token_ids, doc):
     # if not word_order_check(anchor_verb, adj_token, doc):
     #     return False
     
-    # be able toを除外
-    if (
-        anchor_verb.lemma_.lower() == "be" and
-        anchor_verb.i + 1 < len(doc) and
-        anchor_verb.i + 2 < len(doc) and
-        doc[anchor_verb.i + 1].lemma_.lower() == "able" and
-        doc[anchor_verb.i + 2].lemma_.lower() == "to"
-    ):
-        result = False
-        
-    # be about toを除外
+    features = get_doc_features(doc)
+    lemma_lower = features.lemma_lower
+    # be able to / be about toを除外
     if (
-        anchor_verb.lemma_.lower() == "be" and
+        lemma_lower[anchor_verb.i] == ID_BE and
         anchor_verb.i + 1 < len(doc) and
         anchor_verb.i + 2 < len(doc) and
-        doc[anchor_verb.i + 1].lemma_.lower() == "about" and
-        doc[anchor_verb.i + 2].lemma_.lower() == "to"
+        lemma_lower[anchor_verb.i + 1] in (ID_ABLE, ID_ABOUT) and
+        lemma_lower[anchor_verb.i + 2] == ID_TO
     ):
         result = False
         
@@ -1812,12 +2767,13 @@ def filter_V_ing(token_ids, doc):
     if not word_order_check(anchor_verb, ing_token, doc):
         return False
     
-    if anchor_verb.lemma_ == "be":
+    features = get_doc_features(doc)
+    if features.lemma[anchor_verb.i] == ID_BE:
         return False
-    if anchor_verb.lemma_ == "have" and anchor_verb.dep_ == "aux":
+    if features.lemma[anchor_verb.i] == ID_HAVE and features.dep[anchor_verb.i] == ID_AUX:
         return False
     
-    if any(child.tag_ == "TO" and child.dep_ == "aux" for child in anchor_verb.children):
+    if features.child_mask[anchor_verb.i] & CHILD_TO_AUX:
         return False
     
     return result
@@ -1826,9 +2782,10 @@ def filter_V_ing(token_ids, doc):
 def filter_V_toinf(token_ids, doc):
     result = True
 
+    features = get_doc_features(doc)
     anchor_verb = doc[token_ids[0]]
     inf_verb = doc[token_ids[1]]
-    if doc[token_ids[2]].text.lower() == "to":
+    if features.lower[token_ids[2]] == ID_TO:
         to_token = doc[token_ids[2]]
     else:
         to_token = doc[token_ids[3]]
@@ -1847,23 +2804,21 @@ def filter_V_toinf(token_ids, doc):
     
     
     # be going toを除外
-    if anchor_verb.lemma_.lower() == "go" and anchor_verb.tag_ == "VBG":
+    if features.lemma_lower[anchor_verb.i] == ID_GO and features.tag[anchor_verb.i] == ID_TAG_VBG:
         return False
     # have to を除外
-    if anchor_verb.lemma_ == "have":
+    if features.lemma[anchor_verb.i] == ID_HAVE:
         return False
     # beを除外
-    if anchor_verb.lemma_ == "be":
+    if features.lemma[anchor_verb.i] == ID_BE:
         return False
     # used toを除外
-    if anchor_verb.text.lower() == "used":
+    if features.lower[anchor_verb.i] == ID_USED:
         return False
     
-    wh_words = {"what", "who", "which", "whom", "where", "when", "why", "how", "whether", "if"}
     # to_tokenの一つ前の単語がwh_wordsに含まれるものでないかどうかチェック
     if to_token.i > 0:
-        prev_token = doc[to_token.i - 1]
-        if prev_token.lemma_.lower() in wh_words:
+        if features.lemma_lower[to_token.i - 1] in WH_WORD_IDS:
             return False
     
     return result
@@ -1884,8 +2839,11 @@ def filter_V_that(token_ids, doc):
     if not word_order_check(anchor_verb, ccomp_verb, doc):
         return False
     
+    features = get_doc_features(doc)
+    ccomp_children = features.child_mask[ccomp_verb.i]
+
     # be動詞は除外
-    if anchor_verb.lemma_ == "be":
+    if features.lemma[anchor_verb.i] == ID_BE:
         return False
     
     # ccomp_verbはanchor_verbの後ろに限定
@@ -1893,44 +2851,38 @@ def filter_V_that(token_ids, doc):
         return False
     
     # thatがあればその時点でOK
-    if any(child.lemma_ == "that" and child.dep_ == "mark" for child in ccomp_verb.children):
+    if ccomp_children & CHILD_THAT_MARK:
         return True
     
     # 他のパターンと区別するための条件 ----------------------------
     # 引用符(quotation)のパターンは除外
-    if any("Quot" in child.morph.get("PunctType", [""]) for child in anchor_verb.children):
+    if features.child_mask[anchor_verb.i] & CHILD_QUOT:
         return False
     
     # V_n_to-infの場合を除外するフィルター
-    if any(child.tag_ == "TO" for child in ccomp_verb.children):
+    if ccomp_children & CHILD_TO:
         return False
 
     # 疑問詞が含まれている場合は除外
-    wh_words = {"what", "who", "which", "whom", "where", "when", "why", "how", "whether", "if"}
     for descendant in ccomp_verb.subtree:
-        if descendant.lemma_ in wh_words and descendant.i < ccomp_verb.i:
+        if descendant.i < ccomp_verb.i and descendant.lemma_ in WH_WORDS:
             return False
     
     # V_n_infと区別: Infがある場合は、助動詞がない場合は除外
-    if "Inf" in ccomp_verb.morph.get("VerbForm", []):
-        has_aux_md = any(child.tag_ == "MD" and child.dep_ == "aux" for child in ccomp_verb.children)
-        has_aux_do = any(child.dep_ == "aux" and child.lemma_ == "do" for child in ccomp_verb.children)
-        if not has_aux_md and not has_aux_do:
+    if features.is_inf[ccomp_verb.i]:
+        if not ccomp_children & (CHILD_MD_AUX | CHILD_DO_AUX):
             return False
             
     # V_n_Vedと区別: 単独の過去分詞（助動詞なし）を除外
-    if ccomp_verb.tag_ == "VBN":
+    if features.tag[ccomp_verb.i] == ID_TAG_VBN:
         # 現在完了形（have + VBN）または受動態（auxpass付き）の場合はOK
-        has_have_aux = any(child.lemma_ == "have" and child.dep_ == "aux" for child in ccomp_verb.children)
-        has_auxpass = any(child.dep_ == "auxpass" for child in ccomp_verb.children)
-        
         # どちらもない場合（単独の過去分詞）は除外
-        if not has_have_aux and not has_auxpass:
+        if not ccomp_children & (CHILD_HAVE_AUX | CHILD_AUXPASS):
             return False
         
     # V_n_ingと区別:
-    if ccomp_verb.tag_ == "VBG":
-        if not any(child.lemma_ == "be" and child.dep_ == "aux" for child in ccomp_verb.children):
+    if features.tag[ccomp_verb.i] == ID_TAG_VBG:
+        if not ccomp_children & CHILD_BE_AUX:
             return False
         
     # ------------------------------------------------------------
@@ -1955,7 +2907,7 @@ def filter_V_wh(token_ids, doc):
         return False
     
     # be動詞は除外
-    if anchor_verb.lemma_ == "be":
+    if get_doc_features(doc).lemma[anchor_verb.i] == ID_BE:
         return False
     
     # wh_token が ccomp_token よりも右側にある場合、このマッチを除外
@@ -1982,7 +2934,7 @@ def filter_V_whtoinf(token_ids, doc):
         return False
     
     # be動詞は除外
-    if anchor_verb.lemma_ == "be":
+    if get_doc_features(doc).lemma[anchor_verb.i] == ID_BE:
         return False
     
     # wh_token が comp_token よりも右側にある場合、このマッチを除外
@@ -1995,17 +2947,20 @@ def filter_V_whtoinf(token_ids, doc):
 def filter_V_prep_n(token_ids, doc):
     result = True
     
+    features = get_doc_features(doc)
+    dep = features.dep
+    lemma_lower = features.lemma_lower
+
     which_rule = ""
     if len(token_ids) == 2:
         which_rule = "rule1"
-    elif len(token_ids) == 3 and doc[token_ids[1]].dep_ == "advmod":
+    elif len(token_ids) == 3 and dep[token_ids[1]] == ID_ADVMOD:
         which_rule = "rule2"
-    elif len(token_ids) == 3 and doc[token_ids[2]].dep_ == "auxpass":
+    elif len(token_ids) == 3 and dep[token_ids[2]] == ID_AUXPASS:
         which_rule = "rule3"
 
     anchor_verb = doc[token_ids[0]]
-    prep_token = doc[token_ids[1]] if doc[token_ids[1]].dep_ == "prep" else doc[token_ids[2]]
-    advmod_token = doc[token_ids[1]] if doc[token_ids[1]].dep_ == "advmod" else None
+    prep_token = doc[token_ids[1]] if dep[token_ids[1]] == ID_PREP else doc[token_ids[2]]
     
     if not filter_no_obj(token_ids, doc):
         return False
@@ -2019,39 +2974,34 @@ def filter_V_prep_n(token_ids, doc):
     
     # pobjが主語になった受動態
     if which_rule == "rule3":
-        if any(child.dep_ in ["pobj", "pcomp"] for child in prep_token.children):
+        if features.child_mask[prep_token.i] & (CHILD_POBJ | CHILD_PCOMP):
             return False
     
     # V_n_out_of_nとの区別
-    if prep_token.lemma_.lower() == "of":
-        if doc[prep_token.i-1].lemma_.lower() == "out":
+    if lemma_lower[prep_token.i] == ID_OF:
+        if lemma_lower[prep_token.i-1] == ID_OUT:
             return False
 
     # V_n_onto_nとの区別
-    if prep_token.lemma_.lower() == "to":
-        if doc[prep_token.i-1].lemma_.lower() == "on":
+    if lemma_lower[prep_token.i] == ID_TO:
+        if lemma_lower[prep_token.i-1] == ID_ON:
             return False
-    if prep_token.lemma_.lower() == "on":
+    if lemma_lower[prep_token.i] == ID_ON:
         # インデックスエラー防止のため、範囲内か確認
         if prep_token.i + 1 < len(doc):
-            if doc[prep_token.i+1].lemma_.lower() == "to":
+            if lemma_lower[prep_token.i+1] == ID_TO:
                 return False
     
     # 過去分詞 + 前置詞を除く (完了形はOK)
     if which_rule == "rule1":
-        if anchor_verb.tag_ == "VBN":
-            if not(any(child.dep_ == "aux" and child.lemma_ == "have" for child in anchor_verb.children)):
+        if features.tag[anchor_verb.i] == ID_TAG_VBN:
+            if not features.child_mask[anchor_verb.i] & CHILD_HAVE_AUX:
                 return False
 
     # 最初の前置詞のみを選択（最もanchor_verbに近いもの）
-    prep_children = [child for child in anchor_verb.children 
-                    if child.dep_ == "prep" and child.lemma_ in target_prep_simple]
-    
-    if prep_children:
-        # 動詞に最も近い前置詞を選択
-        first_prep = min(prep_children, key=lambda x: abs(x.i - anchor_verb.i))
-        if prep_token.i != first_prep.i:
-            return False
+    first_prep = features.closest_prep_simple[anchor_verb.i]
+    if first_prep != -1 and prep_token.i != first_prep:
+        return False
 
     return result
 
@@ -2072,7 +3022,7 @@ def get_V_prep_n_label(token_ids, doc):
         
     # V_n_as_adjとの区別
     elif prep_token.lemma_.lower() == "as":
-        if any(child.dep_ == "amod" and child.pos_ == "ADJ" for child in prep_token.children):
+        if get_doc_features(doc).child_mask[prep_token.i] & CHILD_AMOD_ADJ:
             pattern_label = f"V_{prep_token.lemma_.lower()}_adj"
         else:
             pattern_label = f"V_{prep_token.lemma_.lower()}_n"
@@ -2172,9 +3122,8 @@ def filter_V_n_toinf(token_ids, doc):
         return False
     
     # comp_token の子孫にwh疑問詞が含まれているかチェック
-    wh_words = {"what", "who", "which", "whom", "where", "when", "why", "how", "whether"}
     for descendant in comp_token.subtree:
-        if descendant.lemma_ in wh_words and descendant.i < comp_token.i:
+        if descendant.i < comp_token.i and descendant.lemma_ in WH_WORDS_TO_INF:
             # wh疑問詞がある場合は、V_n_wh_to-infパターンとして扱うため除外
             return False
     return result
@@ -2184,23 +3133,26 @@ def filter_V_n_inf(token_ids, doc):
     anchor_verb = doc[token_ids[0]]
     comp_token = doc[token_ids[1]]
     
+    features = get_doc_features(doc)
+    comp_children = features.child_mask[comp_token.i]
+
     # let'sを除外する
-    if anchor_verb.lemma_.lower() == "let" and doc[anchor_verb.i+1].text.lower() == "'s":
+    if features.lemma_lower[anchor_verb.i] == ID_LET and anchor_verb.i + 1 < len(doc) and features.lower[anchor_verb.i+1] == ID_APOSTROPHE_S:
         return False
     
     if not word_order_check(anchor_verb, comp_token, doc):
         return False
     
-    if any(child.tag_ == "TO" for child in comp_token.children):
+    if comp_children & CHILD_TO:
         return False
     
-    if any(child.dep_ == "aux" for child in comp_token.children):
+    if comp_children & CHILD_AUX:
         return False
     
-    if "Inf" not in comp_token.morph.get("VerbForm"):
+    if not features.is_inf[comp_token.i]:
         return False
     
-    if any(child.dep_ == "mark" and child.lemma_.lower() == "that" for child in comp_token.children):
+    if comp_children & CHILD_THAT_MARK_LOWER:
         return False
     
     return result
@@ -2215,19 +3167,20 @@ def filter_V_n_that(token_ids, doc):
     if not word_order_check(anchor_verb, ccomp_verb, doc):
         return False
     
+    features = get_doc_features(doc)
+
     # thatがあればその時点でOK
-    if any(child.lemma_ == "that" and child.dep_ == "mark" for child in ccomp_verb.children):
+    if features.child_mask[ccomp_verb.i] & CHILD_THAT_MARK:
         return True
     
     # 他のパターンと区別するための条件 ----
     # 引用符(quotation)のパターンは除外
-    if any("Quot" in child.morph.get("PunctType", [""]) for child in anchor_verb.children):
+    if features.child_mask[anchor_verb.i] & CHILD_QUOT:
         return False
     
     # 疑問詞が含まれている場合は除外
-    wh_words = {"what", "who", "which", "whom", "where", "when", "why", "how", "whether", "if"}
     for descendant in ccomp_verb.subtree:
-        if descendant.lemma_ in wh_words and descendant.i < ccomp_verb.i:
+        if descendant.i < ccomp_verb.i and descendant.lemma_ in WH_WORDS:
             return False
         
     return result
@@ -2273,13 +3226,7 @@ def filter_V_n_Ved(token_ids, doc):
     if not word_order_check(anchor_verb, comp_token, doc):
         return False
     
-    if any(child.dep_ == "aux" and child.lemma_ == "have" for child in comp_token.children):
-        return False
-    
-    if any(child.dep_ == "auxpass" for child in comp_token.children):
-        return False
-    
-    if any(child.dep_ == "aux" and child.tag_ == "MD" for child in comp_token.children):
+    if get_doc_features(doc).child_mask[comp_token.i] & (CHILD_HAVE_AUX | CHILD_AUXPASS | CHILD_MD_AUX):
         return False
     
     return result
@@ -2293,7 +3240,7 @@ def filter_V_n_ing(token_ids, doc):
     if not word_order_check(anchor_verb, comp_token, doc):
         return False
     
-    if any(child.dep_ == "aux" and child.lemma_.lower() == "be" for child in comp_token.children):
+    if get_doc_features(doc).child_mask[comp_token.i] & CHILD_BE_AUX_LOWER:
         return False
     
     return result
@@ -2313,10 +3260,12 @@ def filter_V_way(token_ids, doc):
 def filter_V_n_prep_n(token_ids, doc):
     result = True
     
+    features = get_doc_features(doc)
+
     which_rule = ""
-    if doc[token_ids[2]].dep_ == "dobj":
+    if features.dep[token_ids[2]] == ID_DOBJ:
         which_rule = "rule1"
-    elif doc[token_ids[2]].dep_ == "auxpass":
+    elif features.dep[token_ids[2]] == ID_AUXPASS:
         which_rule = "rule2"
     
     anchor_verb = doc[token_ids[0]]
@@ -2326,23 +3275,18 @@ def filter_V_n_prep_n(token_ids, doc):
         return False
     
     if which_rule == "rule2":
-        if not any(child.dep_ in ["pobj", "pcomp"] for child in prep_token.children):
+        if not features.child_mask[prep_token.i] & (CHILD_POBJ | CHILD_PCOMP):
             return False
     
     # V_n_out_of_nとの区別
-    if prep_token.lemma_.lower() == "of":
-        if doc[prep_token.i-1].lemma_.lower() == "out":
+    if features.lemma_lower[prep_token.i] == ID_OF:
+        if features.lemma_lower[prep_token.i-1] == ID_OUT:
             return False
 
     # 最初の前置詞のみを選択（最もanchor_verbに近いもの）
-    prep_children = [child for child in anchor_verb.children 
-                    if child.dep_ in ["prep", "dative"] and child.lemma_ in target_prep_complex]
-    
-    if prep_children:
-        # 動詞に最も近い前置詞を選択
-        first_prep = min(prep_children, key=lambda x: abs(x.i - anchor_verb.i))
-        if prep_token.i != first_prep.i:
-            return False
+    first_prep = features.closest_prep_complex[anchor_verb.i]
+    if first_prep != -1 and prep_token.i != first_prep:
+        return False
     
     return result
 
@@ -2360,13 +3304,13 @@ def get_V_n_prep_n_label(token_ids, doc):
         
     # V_n_as_adjとの区別
     elif prep_token.lemma_.lower() == "as":
-        if any(child.dep_ == "amod" and child.pos_ == "ADJ" for child in prep_token.children):
+        if get_doc_features(doc).child_mask[prep_token.i] & CHILD_AMOD_ADJ:
             pattern_label = f"V_n_{prep_token.lemma_.lower()}_adj"
         else:
             pattern_label = f"V_n_{prep_token.lemma_.lower()}_n"
     # V_n_into_ingとの区別
     elif prep_token.lemma_.lower() == "into":
-        if any(child.dep_ == "pcomp" and child.tag_ == "VBG" for child in prep_token.children):
+        if get_doc_features(doc).child_mask[prep_token.i] & CHILD_PCOMP_VBG:
             pattern_label = f"V_n_{prep_token.lemma_.lower()}_ing"
         else:
             pattern_label = f"V_n_{prep_token.lemma_.lower()}_n"
@@ -2427,96 +3371,47 @@ def filter_it_nadj_clause(token_ids, doc):
 
 
 # フィルター関数を適用
+# ラベルとフィルタ関数の対応
+filter_dispatch_dict = {
+    "V_n-comp": filter_V_ncomp,
+    "V_pron-refl": filter_pron_refl,
+    "V_adj": filter_V_adj,
+    "V_ing": filter_V_ing,
+    "V_to-inf": filter_V_toinf,
+    "V_that": filter_V_that,
+    "V_wh": filter_V_wh,
+    "V_wh-to-inf": filter_V_whtoinf,
+    "V_prep_n": filter_V_prep_n,
+    "V_by_ing": filter_V_by_ing,
+    "V_out_of_n": filter_V_out_of_n,
+    "V_onto_n": filter_V_onto_n,
+    "V_n_n-comp": filter_V_n_ncomp,
+    "V_n_n-obj": filter_V_n_nobj,
+    "V_n_adj": filter_V_n_adj,
+    "V_n_to-inf": filter_V_n_toinf,
+    "V_n_inf": filter_V_n_inf,
+    "V_n_that": filter_V_n_that,
+    "V_n_wh": filter_V_n_wh,
+    "V_n_wh-to-inf": filter_V_n_whtoinf,
+    "V_n_V-ed": filter_V_n_Ved,
+    "V_n_ing": filter_V_n_ing,
+    "V_way_prep/adv": filter_V_way,
+    "V_n_prep_n": filter_V_n_prep_n,
+    "V_n_out_of_n": filter_V_n_out_of_n,
+    "it_V_n/adj_to-inf": filter_it_V_nadj_toinf,
+    "it_V_(n/adj)_that": filter_it_V_that,
+    "V_for_n_to-inf": filter_V_for_n_toinf,
+    "V_it_n/adj_clause": filter_it_nadj_clause
+}
+
+
 def apply_filter(match_label, token_ids, doc):
-    if match_label == "V_n-comp":
-        result = filter_V_ncomp(token_ids, doc)
-        return result
-    elif match_label == "V_pron-refl":
-        result = filter_pron_refl(token_ids, doc)
-        return result
-    elif match_label == "V_adj":
-        result = filter_V_adj(token_ids, doc)
-        return result
-    elif match_label == "V_ing":
-        result = filter_V_ing(token_ids, doc)
-        return result
-    elif match_label == "V_to-inf":
-        result = filter_V_toinf(token_ids, doc)
-        return result
-    elif match_label == "V_that":
-        result = filter_V_that(token_ids, doc)
-        return result
-    elif match_label == "V_wh":
-        result = filter_V_wh(token_ids, doc)
-        return result
-    elif match_label == "V_wh-to-inf":
-        result = filter_V_whtoinf(token_ids, doc)
-        return result
-    elif match_label == "V_prep_n":
-        result = filter_V_prep_n(token_ids, doc)
-        return result
-    elif match_label == "V_by_ing":
-        result = filter_V_by_ing(token_ids, doc)
-        return result
-    elif match_label == "V_out_of_n":
-        result = filter_V_out_of_n(token_ids, doc)
-        return result
-    elif match_label == "V_onto_n":
-        result = filter_V_onto_n(token_ids, doc)
-        return result
-    elif match_label == "V_n_n-comp":
-        result = filter_V_n_ncomp(token_ids, doc)
-        return result
-    elif match_label == "V_n_n-obj":
-        result = filter_V_n_nobj(token_ids, doc)
-        return result
-    elif match_label == "V_n_adj":
-        result = filter_V_n_adj(token_ids, doc)
-        return result
-    elif match_label == "V_n_to-inf":
-        result = filter_V_n_toinf(token_ids, doc)
-        return result
-    elif match_label == "V_n_inf":
-        result = filter_V_n_inf(token_ids, doc)
-        return result
-    elif match_label == "V_n_that":
-        result = filter_V_n_that(token_ids, doc)
-        return result
-    elif match_label == "V_n_wh":
-        result = filter_V_n_wh(token_ids, doc)
-        return result
-    elif match_label == "V_n_wh-to-inf":
-        result = filter_V_n_whtoinf(token_ids, doc)
-        return result
-    elif match_label == "V_n_V-ed":
-        result = filter_V_n_Ved(token_ids, doc)
-        return result
-    elif match_label == "V_n_ing":
-        result = filter_V_n_ing(token_ids, doc)
-        return result
-    elif match_label == "V_way_prep/adv":
-        result = filter_V_way(token_ids, doc)
-        return result
-    elif match_label == "V_n_prep_n":
-        result = filter_V_n_prep_n(token_ids, doc)
-        return result
-    elif match_label == "V_n_out_of_n":
-        result = filter_V_n_out_of_n(token_ids, doc)
-        return result
-    elif match_label == "it_V_n/adj_to-inf":
-        result = filter_it_V_nadj_toinf(token_ids, doc)
-        return result
-    elif match_label == "it_V_(n/adj)_that":
-        result = filter_it_V_that(token_ids, doc)
-        return result
-    elif match_label == "V_for_n_to-inf":
-        result = filter_V_for_n_toinf(token_ids, doc)
-        return result
-    elif match_label == "V_it_n/adj_clause":
-        result = filter_it_nadj_clause(token_ids, doc)
+    filter_func = filter_dispatch_dict.get(match_label)
+    if filter_func is None:
+        result = False
         return result
     
-    result = False
+    result = filter_func(token_ids, doc)
     return result
 
 pattern_priority_dict = {
@@ -2593,32 +3488,3005 @@ pattern_priority_dict = {
 }
 
 
-def extract_VAC(doc, matcher, spacy_nlp):
-    matches = matcher(doc)
+# V_prep_n / V_n_prep_n は前置詞のlemmaからラベルを作成
+label_expander_dict = {
+    "V_prep_n": get_V_prep_n_label,
+    "V_n_prep_n": get_V_n_prep_n_label
+}
+
+
+def get_VAC_label(match_label, token_ids, doc):
+    expander = label_expander_dict.get(match_label)
+    if expander is None:
+        return match_label
+    return expander(token_ids, doc)
+
+
+# VAC ラベルの整数化 ------------------------------------------------------------
+# 出力しうるすべての VAC ラベル（pattern_priority_dict の順）。番号は保存した配列の解釈に使うため、ラベルの追加は末尾に行う
+VAC_LABELS = tuple(pattern_priority_dict)
+VAC_LABEL_IDS = {label: label_id for label_id, label in enumerate(VAC_LABELS)}
+VAC_LABEL_PRIORITIES = np.array([pattern_priority_dict[label] for label in VAC_LABELS], dtype=np.int8)
+_vac_label_priority_list = VAC_LABEL_PRIORITIES.tolist()
+
+
+def _build_prep_label_ids(prefix, preps, merged, alternatives):
+    # get_V_prep_n_label / get_V_n_prep_n_label と同じ規則を前置詞の lemma の ID で引ける表にする
+    # {前置詞: (ラベル, 子ノードの特徴ビット, そのビットがある場合のラベル)}
+    table = {}
+    for prep in preps:
+        label_id = VAC_LABEL_IDS[merged.get(prep, f"{prefix}{prep}_n")]
+        bit, alternative = alternatives.get(prep, (0, None))
+        table[get_string_id(prep)] = (label_id, bit, VAC_LABEL_IDS[alternative] if alternative else label_id)
+    return table
+
+
+V_PREP_N_LABEL_IDS = _build_prep_label_ids(
+    "V_",
+    target_prep_simple,
+    {"around": "V_around/round_n", "round": "V_around/round_n", "upon": "V_on_n", "towards": "V_toward_n", "between": "V_between_pl-n"},
+    {"as": (CHILD_AMOD_ADJ, "V_as_adj")},
+)
+V_N_PREP_N_LABEL_IDS = _build_prep_label_ids(
+    "V_n_",
+    target_prep_complex,
+    {"between": "V_n_between/among_pl-n", "among": "V_n_between/among_pl-n", "upon": "V_n_on_n", "towards": "V_n_toward_n"},
+    {"as": (CHILD_AMOD_ADJ, "V_n_as_adj"), "into": (CHILD_PCOMP_VBG, "V_n_into_ing")},
+)
+
+
+def _get_prep_label_id(table, prep_idx, features):
+    entry = table.get(features.lemma_lower[prep_idx])
+    if entry is None:
+        return None
+    label_id, bit, alternative = entry
+    return alternative if features.child_mask[prep_idx] & bit else label_id
+
+
+def get_V_prep_n_label_id(token_ids, doc):
+    features = get_doc_features(doc)
+    prep_idx = token_ids[1] if features.dep[token_ids[1]] == ID_PREP else token_ids[2]
+    return _get_prep_label_id(V_PREP_N_LABEL_IDS, prep_idx, features)
+
+
+def get_V_n_prep_n_label_id(token_ids, doc):
+    return _get_prep_label_id(V_N_PREP_N_LABEL_IDS, token_ids[1], get_doc_features(doc))
+
+
+label_id_expander_dict = {
+    "V_prep_n": get_V_prep_n_label_id,
+    "V_n_prep_n": get_V_n_prep_n_label_id
+}
+
+
+def get_VAC_label_id(match_label, token_ids, doc):
+    # 文字列のラベルを作らずに VAC_LABELS の番号を返す
+    expander = label_id_expander_dict.get(match_label)
+    label_id = VAC_LABEL_IDS.get(match_label) if expander is None else expander(token_ids, doc)
+    if label_id is None:
+        # 前置詞の表にない lemma などは文字列のラベルから引く
+        label = get_VAC_label(match_label, token_ids, doc)
+        if label not in VAC_LABEL_IDS:
+            raise ValueError(f"VAC label {label!r} is not in VAC_LABELS (add it to pattern_priority_dict).")
+        label_id = VAC_LABEL_IDS[label]
+    return label_id
+
+
+# 展開後のラベル（V_on_n など）を出力しうる、展開前のマッチャーのラベル
+expanded_label_regex_dict = {
+    "V_prep_n": re.compile(r"^V_([^_]+_n|as_adj|between_pl-n)$"),
+    "V_n_prep_n": re.compile(r"^V_n_([^_]+_n|as_adj|into_ing|between/among_pl-n)$"),
+}
+
+
+def get_VAC_label_priorities(match_label, outputs=None):
+    # マッチャーのラベルが出力しうるラベルの優先度の集合（outputs を指定するとその出力に限る）
+    if outputs is None:
+        regex = expanded_label_regex_dict.get(match_label)
+        if regex is None:
+            outputs = [match_label]
+        else:
+            # 優先度表にない前置詞のラベルは -inf になる
+            return {priority for label, priority in pattern_priority_dict.items() if regex.match(label)} | {float('-inf')}
+    return {pattern_priority_dict.get(label, float('-inf')) for label in outputs}
+
+
+class VACLabelSelection:
+    # 指定したラベルだけを抽出するための、マッチャーに登録するラベルと出力対象のラベル
+    # labels には、指定したラベルと、優先度の解決でそれに勝ちうるラベル（競合ラベル）だけを含める
+    def __init__(self, requested, label_order=None):
+        if label_order is None:
+            label_order = list(create_vac_patterns())
+        self.requested = list(requested)
+        # {マッチャーのラベル: 出力対象の展開後のラベルの集合（None はすべて）}
+        self.targets = {}
+        for label in self.requested:
+            sources = [
+                source for source in label_order
+                if source == label or (source in expanded_label_regex_dict and expanded_label_regex_dict[source].match(label))
+            ]
+            if not sources:
+                raise ValueError(f"Unknown VAC label {label!r}.")
+            for source in sources:
+                if source == label:
+                    self.targets[source] = None
+                elif self.targets.get(source, set()) is not None:
+                    self.targets.setdefault(source, set()).add(label)
+
+        rank = {label: i for i, label in enumerate(label_order)}
+        lowest = {target: min(get_VAC_label_priorities(target, outputs)) for target, outputs in self.targets.items()}
+        self.labels = []
+        for label in label_order:
+            highest = max(get_VAC_label_priorities(label))
+            # 優先度が同じ場合はラベル順が前のものが選ばれる
+            if label in self.targets or any(
+                highest > lowest[target] or (highest == lowest[target] and rank[label] < rank[target])
+                for target in self.targets
+            ):
+                self.labels.append(label)
+
+    def accepts(self, match_label, vac_label):
+        if match_label not in self.targets:
+            return False
+        outputs = self.targets[match_label]
+        return outputs is None or vac_label in outputs
+
+
+def _resolve_VAC_lazy(doc, matches, spacy_nlp, selection=None, lexicon=None):
+    # 動詞ごとに採用したマッチを (出力順, 動詞の位置, ラベルの番号, token_ids) で返す
+    # 同一の (ラベル, token_ids) の重複マッチをまとめ、動詞ごとに候補を集める
+    candidate_dict = defaultdict(list)
+    seen = set()
+    for order, (match_id, token_ids) in enumerate(matches):
+        match_label = spacy_nlp.vocab.strings[match_id]
+        key = (match_label, tuple(token_ids))
+        if key in seen:
+            continue
+        seen.add(key)
+        candidate_dict[token_ids[0]].append((order, match_label, token_ids))
+    
+    if selection is not None:
+        # 指定したラベルの候補がない動詞は、競合ラベルのフィルタも評価しない
+        candidate_dict = {
+            anchor_idx: candidates for anchor_idx, candidates in candidate_dict.items()
+            if any(candidate[1] in selection.targets for candidate in candidates)
+        }
+    
+    filter_results = {}
+    
+    def passes(candidate):
+        order = candidate[0]
+        if order not in filter_results:
+            filter_results[order] = apply_filter(candidate[1], candidate[2], doc)
+        return filter_results[order]
+    
+    lemmas = get_doc_features(doc).lemma if lexicon is not None else None
+    results = []
+    for anchor_idx, candidates in candidate_dict.items():
+        # 優先度の高い候補から順にフィルタを適用し、最初に通過したものを採用
+        ranked = []
+        for candidate in candidates:
+            label_id = get_VAC_label_id(candidate[1], candidate[2], doc)
+            ranked.append((-_vac_label_priority_list[label_id], candidate[0], label_id, candidate))
+        if lexicon is not None:
+            # 動詞の lemma が取らないラベルの候補はマッチしなかったものとして扱う
+            allowed = lexicon.allowed_label_ids(lemmas[anchor_idx])
+            if allowed is not None:
+                ranked = [entry for entry in ranked if entry[2] in allowed]
+                candidates = [entry[3] for entry in ranked]
+        ranked.sort(key=lambda x: (x[0], x[1]))
+        
+        for _, order, label_id, candidate in ranked:
+            if passes(candidate):
+                break
+        else:
+            continue
+        if selection is not None and not selection.accepts(candidate[1], VAC_LABELS[label_id]):
+            continue
+        
+        # 出力順は一括評価と同じく「最初にフィルタを通過したマッチ」の位置に合わせる
+        first_order = order
+        for candidate in candidates:
+            if candidate[0] >= order:
+                break
+            if passes(candidate):
+                first_order = candidate[0]
+                break
+        results.append((first_order, anchor_idx, label_id, candidate[2]))
+    
+    results.sort(key=lambda x: x[0])
+    return results
+
+
+def _extract_VAC_lazy(doc, matches, spacy_nlp, selection=None, lexicon=None, with_tokens=False):
+    resolved = _resolve_VAC_lazy(doc, matches, spacy_nlp, selection=selection, lexicon=lexicon)
+    if with_tokens:
+        return [(idx, VAC_LABELS[label_id], list(token_ids)) for _, idx, label_id, token_ids in resolved]
+    return [(idx, VAC_LABELS[label_id]) for _, idx, label_id, _ in resolved]
+
+
+def match_VAC_batch(docs, matcher):
+    # 配列エンジンは複数文書をまとめてマッチングする
+    if hasattr(matcher, "match_docs"):
+        return matcher.match_docs(docs)
+    return [matcher(doc) for doc in docs]
+
+
+def extract_VAC(doc, matcher, spacy_nlp, lazy=True, matches=None, selection=None, lexicon=None, with_tokens=False):
+    # with_tokens: (動詞の位置, ラベル, 採用したマッチの token_ids) を返す
+    if matches is None:
+        matches = matcher(doc)
+    with doc_features_scope(doc):
+        if lazy:
+            return _extract_VAC_lazy(doc, matches, spacy_nlp, selection=selection, lexicon=lexicon, with_tokens=with_tokens)
+        return _extract_VAC_eager(doc, matches, spacy_nlp, selection=selection, lexicon=lexicon, with_tokens=with_tokens)
+
+
+def _extract_VAC_eager(doc, matches, spacy_nlp, selection=None, lexicon=None, with_tokens=False):
+    # すべてのマッチにフィルタを適用してから、動詞ごとに優先度の最も高いラベルを選ぶ
     match_dict = defaultdict(list)
     
     for match_id, token_ids in matches:
         match_label = spacy_nlp.vocab.strings[match_id]
         anchor_idx = doc[token_ids[0]].i
+        if lexicon is not None:
+            allowed = lexicon.allowed_label_ids(doc[anchor_idx].lemma)
+            if allowed is not None and get_VAC_label_id(match_label, token_ids, doc) not in allowed:
+                continue
         
         if apply_filter(match_label, token_ids, doc):
-            # V_prep_n の場合は、prep_token のlemmaを取得して、labelを作成
-            if match_label == "V_prep_n":
-                V_prep_n_label = get_V_prep_n_label(token_ids, doc)
-                match_dict[anchor_idx].append(V_prep_n_label)
-                
-            elif match_label == "V_n_prep_n":
-                V_n_prep_n_label = get_V_n_prep_n_label(token_ids, doc)
-                match_dict[anchor_idx].append(V_n_prep_n_label)
-                
-            else:
-                match_dict[anchor_idx].append(match_label)
+            match_dict[anchor_idx].append((get_VAC_label(match_label, token_ids, doc), match_label, token_ids))
     
+    results = []
     for idx, labels in match_dict.items():
         # labelsの要素が2つ以上ある場合、pattern_priority_dictに基づいて並べ替える
         # print(doc[idx].text, labels, doc)
         if len(labels) >= 2:
-            labels.sort(key=lambda x: pattern_priority_dict.get(x, float('-inf')), reverse=True)
-        match_dict[idx] = labels[0] # 複数のラベルがつく場合、最初のラベルを選択
-    
-    return [(idx, label) for idx, label in match_dict.items()]
\ No newline at end of file
+            labels.sort(key=lambda x: pattern_priority_dict.get(x[0], float('-inf')), reverse=True)
+        label, match_label, token_ids = labels[0] # 複数のラベルがつく場合、最初のラベルを選択
+        if selection is None or selection.accepts(match_label, label):
+            results.append((idx, label, list(token_ids)) if with_tokens else (idx, label))
+
+    return results
+
+
+# 配列形式の出力 ------------------------------------------------------------
+# 1行1 VAC。label は VAC_LABELS の番号、tokens は採用したマッチの動詞以外のトークン位置（足りない分は -1）
+VAC_ARRAY_MAX_TOKENS = max(len(pattern) for patterns in create_vac_patterns().values() for pattern in patterns) - 1
+VAC_ARRAY_DTYPE = np.dtype([
+    ("doc", np.int64),
+    ("sent", np.int32),
+    ("i", np.int32),
+    ("label", np.uint8),
+    ("tokens", np.int32, (VAC_ARRAY_MAX_TOKENS,)),
+])
+
+
+def _sentence_ids(doc):
+    # 文境界がない文書（未解析）はすべて文 0 とする
+    sent_starts = doc.to_array([SENT_START]).reshape(-1)
+    return np.maximum(np.cumsum(sent_starts == 1) - 1, 0)
+
+
+def extract_VAC_array(docs, matcher, spacy_nlp, doc_offset=0, batch_matches=None, selection=None, lexicon=None):
+    # 文書のバッチから VAC_ARRAY_DTYPE の構造化配列を作る（doc は doc_offset からの通し番号）
+    # 結果は extract_VAC と同じで、文字列とタプルを作らない
+    if batch_matches is None:
+        batch_matches = match_VAC_batch(docs, matcher)
+    resolved = []
+    for doc, matches in zip(docs, batch_matches):
+        with doc_features_scope(doc):
+            resolved.append(_resolve_VAC_lazy(doc, matches, spacy_nlp, selection=selection, lexicon=lexicon))
+    array = np.zeros(sum(len(rows) for rows in resolved), dtype=VAC_ARRAY_DTYPE)
+    array["tokens"] = -1
+    row = 0
+    for doc_index, (doc, rows) in enumerate(zip(docs, resolved)):
+        if not rows:
+            continue
+        end = row + len(rows)
+        array["doc"][row:end] = doc_offset + doc_index
+        anchors = [idx for _, idx, _, _ in rows]
+        array["i"][row:end] = anchors
+        array["sent"][row:end] = _sentence_ids(doc)[anchors]
+        array["label"][row:end] = [label_id for _, _, label_id, _ in rows]
+        tokens = array["tokens"]
+        for offset, (_, _, _, token_ids) in enumerate(rows):
+            tokens[row + offset, :len(token_ids) - 1] = token_ids[1:]
+        row = end
+    return array
+
+
+def get_VAC_array_labels(array):
+    # 構造化配列の label を文字列に戻す
+    return np.asarray(VAC_LABELS, dtype=object)[array["label"]]
+
+
+# 文単位の抽出 ------------------------------------------------------------
+# 文ごとに Doc を作ってマッチングとフィルタを行い、動詞の位置を文書の位置に戻す。
+# マッチの集合と特徴量テーブルは文ごとに作り直して捨てるため、中間状態の大きさは最長の文で決まる。
+# 依存関係は文をまたがないので、文の外の語を読むフィルタを除けば結果は文書全体の抽出と同じ（出力は文の順に並ぶ）
+SENTENCE_DOC_ATTRS = [TAG, POS, MORPH, LEMMA, DEP, HEAD]
+
+
+def get_sentence_ranges(doc):
+    # 文境界がない文書（未解析）は全体を1文とする
+    if not doc.has_annotation("SENT_START"):
+        return [(0, len(doc))]
+    return [(sent.start, sent.end) for sent in doc.sents]
+
+
+def iter_sentence_docs(doc, ranges=None):
+    # (文の開始位置, 文の Doc) を返す。Span.as_doc は文ごとに文書全体を配列にするため、配列は一度だけ作って切り出す
+    if ranges is None:
+        ranges = get_sentence_ranges(doc)
+    if ranges == [(0, len(doc))]:
+        yield 0, doc
+        return
+    array = doc.to_array(SENTENCE_DOC_ATTRS)
+    head_col = SENTENCE_DOC_ATTRS.index(HEAD)
+    heads = np.arange(len(doc), dtype="int64") + array[:, head_col].view("int64")
+    words = [token.text for token in doc]
+    spaces = [bool(token.whitespace_) for token in doc]
+    for start, end in ranges:
+        sent_array = array[start:end].copy()
+        # 範囲の外を指す head（文分割器と構文解析器が食い違う場合や、切り詰めた文）はその語自身を根にする
+        sent_heads = heads[start:end]
+        sent_array[:, head_col] = np.where((sent_heads >= start) & (sent_heads < end), sent_heads - np.arange(start, end), 0).astype("int64").view("uint64")
+        sent_doc = Doc(doc.vocab, words=words[start:end], spaces=spaces[start:end])
+        sent_doc.from_array(SENTENCE_DOC_ATTRS, sent_array)
+        yield start, sent_doc
+
+
+def _shift_VAC_results(results, start):
+    # 文の中の位置を文書の位置に戻す（token_ids 付きの結果も同様）
+    if start == 0:
+        return results
+    shifted = []
+    for result in results:
+        if len(result) == 3:
+            shifted.append((result[0] + start, result[1], [i + start for i in result[2]]))
+        else:
+            shifted.append((result[0] + start, result[1]))
+    return shifted
+
+
+def extract_VAC_by_sentence(doc, matcher, spacy_nlp, lazy=True, selection=None, lexicon=None, with_tokens=False):
+    results = []
+    for start, sent_doc in iter_sentence_docs(doc):
+        results.extend(_shift_VAC_results(extract_VAC(sent_doc, matcher, spacy_nlp, lazy=lazy, selection=selection, lexicon=lexicon, with_tokens=with_tokens), start))
+    return results
+
+
+# 文書ごとの処理の上限 ------------------------------------------------------------
+# OCR の崩れた長大な文や表を平文にしたものなど、1文書で DependencyMatcher の組み合わせ探索や
+# フィルタの部分木の走査に数秒かかる入力が、バッチ全体の遅延を決めないようにする。
+# 上限を超えた文は切り詰めるか飛ばし、飛ばした範囲は出力のレコードに残す（文単位で処理する）
+LONG_SENTENCE_ACTIONS = ("skip", "truncate")
+
+
+class VACBudget:
+    def __init__(self, max_sentence_tokens=None, max_matches=None, max_seconds=None, long_sentences="skip", slow_seconds=None):
+        if long_sentences not in LONG_SENTENCE_ACTIONS:
+            raise ValueError(f"Unknown long sentence action {long_sentences!r}; expected one of {LONG_SENTENCE_ACTIONS}.")
+        # 1文の最大トークン数、1文の生のマッチ数の上限、1文書の経過時間の上限（秒）
+        self.max_sentence_tokens = max_sentence_tokens
+        self.max_matches = max_matches
+        self.max_seconds = max_seconds
+        self.long_sentences = long_sentences
+        # この時間以上かかった文書を遅い文書の記録に書き出す
+        self.slow_seconds = slow_seconds
+
+
+def extract_VAC_with_budget(doc, matcher, spacy_nlp, budget, lazy=True, selection=None, lexicon=None, with_tokens=False):
+    # 結果と、処理の記録 {"tokens", "matches", "seconds", "skipped": [{"start", "end", "reason", ...}]} を返す
+    start_time = time.perf_counter()
+    skipped = []
+    ranges = []
+    for start, end in get_sentence_ranges(doc):
+        if budget.max_sentence_tokens is not None and end - start > budget.max_sentence_tokens:
+            if budget.long_sentences == "skip":
+                skipped.append({"start": start, "end": end, "reason": "sentence_length"})
+                continue
+            skipped.append({"start": start + budget.max_sentence_tokens, "end": end, "reason": "sentence_length"})
+            end = start + budget.max_sentence_tokens
+        ranges.append((start, end))
+
+    results = []
+    n_matches = 0
+    sentences = iter_sentence_docs(doc, ranges)
+    for k, (start, sent_doc) in enumerate(sentences):
+        if budget.max_seconds is not None and time.perf_counter() - start_time > budget.max_seconds:
+            # 残りの文はまとめて飛ばす（処理中の文は中断できないため、判定は文の間で行う）
+            skipped.extend({"start": rest_start, "end": rest_end, "reason": "time"} for rest_start, rest_end in ranges[k:])
+            break
+        matches = matcher(sent_doc)
+        n_matches += len(matches)
+        if budget.max_matches is not None and len(matches) > budget.max_matches:
+            skipped.append({"start": start, "end": start + len(sent_doc), "reason": "matches", "matches": len(matches)})
+            continue
+        results.extend(_shift_VAC_results(extract_VAC(sent_doc, matcher, spacy_nlp, lazy=lazy, matches=matches, selection=selection, lexicon=lexicon, with_tokens=with_tokens), start))
+    sentences.close()
+    skipped.sort(key=lambda record: record["start"])
+    return results, {"tokens": len(doc), "matches": n_matches, "seconds": time.perf_counter() - start_time, "skipped": skipped}
+
+
+# 動詞の lemma ごとのフレーム辞書 ------------------------------------------------------------
+# 参照コーパスで各動詞の lemma に付いた VAC ラベルを数えておき、抽出時にはその lemma が取らないラベルの
+# マッチングとフィルタを省く。辞書にない lemma と出現数が min_lemma_count 未満の lemma はすべてのラベルを候補にする
+FRAME_LEXICON_VERSION = 1
+
+
+class VACFrameLexicon:
+    def __init__(self, lemmas, counts, min_count=1, min_lemma_count=1):
+        self.lemmas = list(lemmas)
+        self.counts = np.asarray(counts, dtype=np.uint32).reshape(len(self.lemmas), len(VAC_LABELS))
+        self.min_count = min_count
+        self.min_lemma_count = min_lemma_count
+        label_order = list(create_vac_patterns())
+        # 展開後のラベルの番号 -> それを出力しうるマッチャーのラベル
+        sources = [
+            frozenset(
+                source for source in label_order
+                if source == label or (source in expanded_label_regex_dict and expanded_label_regex_dict[source].match(label))
+            )
+            for label in VAC_LABELS
+        ]
+        # {lemma の ID: 取りうるラベルの番号の集合}、{lemma の ID: マッチングするラベルの集合}
+        self.label_ids = {}
+        self.matcher_labels = {}
+        for lemma, row in zip(self.lemmas, self.counts):
+            if int(row.sum()) < min_lemma_count:
+                continue
+            label_ids = frozenset(np.flatnonzero(row >= min_count).tolist())
+            lemma_id = get_string_id(lemma)
+            self.label_ids[lemma_id] = label_ids
+            self.matcher_labels[lemma_id] = frozenset().union(*(sources[label_id] for label_id in label_ids))
+
+    def __len__(self):
+        return len(self.label_ids)
+
+    def allowed_label_ids(self, lemma_id):
+        # 辞書にない lemma は None（すべてのラベルを候補にする）
+        return self.label_ids.get(lemma_id)
+
+    def to_bytes(self):
+        buffer = io.BytesIO()
+        np.savez_compressed(
+            buffer,
+            version=np.array(FRAME_LEXICON_VERSION),
+            labels=np.array(VAC_LABELS),
+            lemmas=np.array(self.lemmas, dtype=str),
+            counts=self.counts,
+        )
+        return buffer.getvalue()
+
+    def save(self, path):
+        dir_path = os.path.dirname(path)
+        if dir_path:
+            os.makedirs(dir_path, exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(self.to_bytes())
+
+    @classmethod
+    def from_bytes(cls, data, min_count=1, min_lemma_count=1):
+        return cls.load(io.BytesIO(data), min_count=min_count, min_lemma_count=min_lemma_count)
+
+    @classmethod
+    def load(cls, path, min_count=1, min_lemma_count=1):
+        # path はファイルのパスか、バイナリのファイルオブジェクト
+        with np.load(path) as data:
+            if int(data["version"]) != FRAME_LEXICON_VERSION:
+                raise ValueError(f"Unsupported frame lexicon version in {path}.")
+            labels = data["labels"].tolist()
+            # ラベルは末尾にしか追加しないので、保存時のラベルが先頭に一致すれば列を補って使える
+            if tuple(labels) != VAC_LABELS[:len(labels)]:
+                raise ValueError(f"Frame lexicon {path} was built with a different VAC label table.")
+            counts = np.zeros((len(data["lemmas"]), len(VAC_LABELS)), dtype=np.uint32)
+            counts[:, :len(labels)] = data["counts"]
+            return cls(data["lemmas"].tolist(), counts, min_count=min_count, min_lemma_count=min_lemma_count)
+
+
+class FrameCountWriter:
+    # extract_VAC_corpus の書き出し先として、lemma ごとのラベルの出現数を数える
+    def __init__(self):
+        self.counts = defaultdict(lambda: [0] * len(VAC_LABELS))
+
+    def write(self, record):
+        for vac in record["vacs"]:
+            self.counts[vac["lemma"]][VAC_LABEL_IDS[vac["label"]]] += 1
+
+    def close(self):
+        pass
+
+    def lexicon(self, min_count=1, min_lemma_count=1):
+        lemmas = sorted(self.counts)
+        counts = np.array([self.counts[lemma] for lemma in lemmas], dtype=np.uint32).reshape(len(lemmas), len(VAC_LABELS))
+        return VACFrameLexicon(lemmas, counts, min_count=min_count, min_lemma_count=min_lemma_count)
+
+
+def build_frame_lexicon(records, spacy_nlp, matcher=None, n_process=1, batch_size=64, parse_cache=None, min_count=1, min_lemma_count=1):
+    # 参照コーパスに抽出器をかけて辞書を作る（辞書を使わない通常の抽出）
+    counter = FrameCountWriter()
+    extract_VAC_corpus(records, spacy_nlp, counter, matcher=matcher, n_process=n_process, batch_size=batch_size, parse_cache=parse_cache)
+    return counter.lexicon(min_count=min_count, min_lemma_count=min_lemma_count)
+
+
+class LexiconDependencyMatcher:
+    # 文ごとに、文内の動詞の lemma が取りうるラベルだけをマッチングする（辞書にない動詞はすべてのラベルを取りうるものとする）
+    # prescreen では、さらにその文に必要な値がそろうラベルに絞る
+    # 木が入り組んだ文書は PrescreenDependencyMatcher と同じくマッチ順を保つため全体のマッチャーを使う
+    def __init__(self, nlp, compiled_patterns, lexicon, validate=True, engine="spacy", prescreen=False):
+        self.nlp = nlp
+        self.lexicon = lexicon
+        self.strings = nlp.vocab.strings
+        self.labels = list(compiled_patterns)
+        self.prescreen = None
+        if prescreen:
+            self.prescreen = PrescreenDependencyMatcher(nlp, compiled_patterns, validate=validate, engine=engine)
+            self.label_matchers = self.prescreen.label_matchers
+        else:
+            self.label_matchers = {
+                label: _build_matcher_from_patterns(nlp, {label: patterns}, validate=validate, engine=engine)
+                for label, patterns in compiled_patterns.items()
+            }
+        self._compiled_patterns = compiled_patterns
+        self._validate = validate
+        self._engine = engine
+        self._full_matcher = None
+        self._verb_tags = {}
+        self.stats = {"docs": 0, "fallback_docs": 0, "labels_run": 0}
+
+    @property
+    def full_matcher(self):
+        if self._full_matcher is None:
+            self._full_matcher = _build_matcher_from_patterns(self.nlp, self._compiled_patterns, validate=self._validate, engine=self._engine)
+        return self._full_matcher
+
+    def _is_verb_tag(self, tag):
+        is_verb = self._verb_tags.get(tag)
+        if is_verb is None:
+            is_verb = self._verb_tags[tag] = self.strings[tag].startswith("V") if tag else False
+        return is_verb
+
+    def select_labels(self, doc):
+        self.stats["docs"] += 1
+        if len(doc) == 0:
+            return ()
+        arr = doc.to_array([HEAD, TAG, LEMMA])
+        blocks = get_sentence_blocks(arr[:, 0])
+        if blocks is None:
+            self.stats["fallback_docs"] += 1
+            self.stats["labels_run"] += len(self.labels)
+            return None
+        sentence_labels = self.prescreen.sentence_labels(doc) if self.prescreen is not None else None
+        all_labels = set(self.labels)
+        labels = set()
+        for k, (start, end) in enumerate(blocks):
+            sentence = set()
+            for tag, lemma in set(zip(arr[start:end, 1].tolist(), arr[start:end, 2].tolist())):
+                if not self._is_verb_tag(tag):
+                    continue
+                sentence |= self.lexicon.matcher_labels.get(lemma, all_labels)
+            if sentence_labels is not None:
+                sentence &= sentence_labels[k]
+            labels |= sentence
+        selected = tuple(label for label in self.labels if label in labels)
+        self.stats["labels_run"] += len(selected)
+        return selected
+
+    def __call__(self, doclike):
+        if isinstance(doclike, Span):
+            doclike = doclike.as_doc(copy_user_data=True)
+        labels = self.select_labels(doclike)
+        if labels is None:
+            return self.full_matcher(doclike)
+        matches = []
+        for label in labels:
+            matches.extend(self.label_matchers[label](doclike))
+        return matches
+
+    def match_docs(self, docs):
+        docs = list(docs)
+        results = [[] for _ in docs]
+        label_docs = defaultdict(list)
+        fallback = []
+        for i, doc in enumerate(docs):
+            labels = self.select_labels(doc)
+            if labels is None:
+                fallback.append(i)
+                continue
+            for label in labels:
+                label_docs[label].append(i)
+        for label in self.labels:
+            indices = label_docs.get(label)
+            if not indices:
+                continue
+            for i, matches in zip(indices, match_VAC_batch([docs[i] for i in indices], self.label_matchers[label])):
+                results[i].extend(matches)
+        if fallback:
+            for i, matches in zip(fallback, match_VAC_batch([docs[i] for i in fallback], self.full_matcher)):
+                results[i] = matches
+        return results
+
+
+def score_VAC_against_gold(gold_docs, docs, batch_results):
+    # 金データ（doc.ents に VAC ラベル）との一致: 予測は動詞の文字範囲が同じラベルの ent に含まれれば正解
+    correct = predicted = found = gold = 0
+    for gold_doc, doc, results in zip(gold_docs, docs, batch_results):
+        ents = [(ent.start_char, ent.end_char, ent.label_) for ent in gold_doc.ents]
+        gold += len(ents)
+        hit = set()
+        for idx, label in results:
+            predicted += 1
+            token = doc[idx]
+            start, end = token.idx, token.idx + len(token.text)
+            for k, (ent_start, ent_end, ent_label) in enumerate(ents):
+                if ent_label == label and ent_start <= start and end <= ent_end:
+                    correct += 1
+                    hit.add(k)
+                    break
+        found += len(hit)
+    precision = correct / predicted if predicted else 0.0
+    recall = found / gold if gold else 0.0
+    f1 = 2 * precision * recall / (precision + recall) if precision + recall else 0.0
+    return {"predicted": predicted, "gold": gold, "precision": precision, "recall": recall, "f1": f1}
+
+
+def benchmark_frame_lexicon(gold_docs, spacy_nlp, lexicon, repeat=3):
+    # 金データ上で辞書なし / ありのマッチングと抽出の時間、および精度・再現率を比較する
+    docs = list(spacy_nlp.pipe(doc.text for doc in gold_docs))
+    runs = {}
+    for name, run_lexicon in (("full", None), ("lexicon", lexicon)):
+        matcher = create_dependency_matcher(spacy_nlp, lexicon=run_lexicon)
+        best = float("inf")
+        batch_results = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            batch_results = [extract_VAC(doc, matcher, spacy_nlp, lexicon=run_lexicon) for doc in docs]
+            best = min(best, time.perf_counter() - start)
+        runs[name] = dict(score_VAC_against_gold(gold_docs, docs, batch_results), seconds=best, results=batch_results)
+    full, pruned = runs["full"], runs["lexicon"]
+    changed = sum(len(set(a) ^ set(b)) for a, b in zip(full.pop("results"), pruned.pop("results")))
+    unseen = sum(
+        1 for doc in docs for token in doc
+        if token.tag_.startswith("V") and lexicon.allowed_label_ids(token.lemma) is None
+    )
+    return {
+        "docs": len(docs),
+        "lemmas": len(lexicon),
+        "unseen_verbs": unseen,
+        "full": full,
+        "lexicon": pruned,
+        "changed": changed,
+        "speedup": full["seconds"] / pruned["seconds"] if pruned["seconds"] > 0 else float("inf"),
+    }
+
+
+# コンパイル済みDependencyMatcherの検証済みスタンプ ------------------------------------------------------------
+# パターンは毎回作り直す（約1ms）ため、保存するのは「この指紋のパターンは検証済み」という記録だけにする
+MATCHER_ARTIFACT_VERSION = 3
+
+
+def get_pipeline_signature(nlp):
+    return [nlp.lang, nlp.meta.get("name"), nlp.meta.get("version"), list(nlp.pipe_names)]
+
+
+def get_matcher_fingerprint(nlp, compiled_patterns, tag_inventory):
+    # パターン・タグ集合・パイプラインが変われば指紋も変わる
+    # パターンの作成は検証（DependencyMatcher.add）より十分安いため、ソースではなく作成したパターンそのものを指紋にする
+    payload = {
+        "version": MATCHER_ARTIFACT_VERSION,
+        "spacy": spacy.__version__,
+        "pipeline": get_pipeline_signature(nlp),
+        "tags": list(tag_inventory),
+        "patterns": compiled_patterns,
+    }
+    data = json.dumps(payload, sort_keys=True, ensure_ascii=False).encode("utf-8")
+    return hashlib.sha256(data).hexdigest()
+
+
+def save_matcher_stamp(path, fingerprint):
+    stamp = {"version": MATCHER_ARTIFACT_VERSION, "fingerprint": fingerprint}
+    # 並行して起動したワーカーが書きかけのファイルを読まないよう、一時ファイル経由で置き換える
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(stamp, f)
+    os.replace(tmp_path, path)
+
+
+def _read_matcher_stamp(path):
+    try:
+        with open(path, encoding="utf-8") as f:
+            stamp = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(stamp, dict) or stamp.get("version") != MATCHER_ARTIFACT_VERSION:
+        return None
+    return stamp
+
+
+def _build_matcher_from_patterns(nlp, compiled_patterns, validate=True, engine="spacy", prescreen=False, selection=None, lexicon=None):
+    if selection is not None:
+        return SelectionDependencyMatcher(nlp, compiled_patterns, selection, validate=validate, engine=engine, prescreen=prescreen, lexicon=lexicon)
+    if lexicon is not None:
+        return LexiconDependencyMatcher(nlp, compiled_patterns, lexicon, validate=validate, engine=engine, prescreen=prescreen)
+    if prescreen:
+        return PrescreenDependencyMatcher(nlp, compiled_patterns, validate=validate, engine=engine)
+    if engine == "array":
+        matcher = ArrayDependencyMatcher(nlp.vocab)
+    elif engine == "spacy":
+        matcher = DependencyMatcher(nlp.vocab, validate=validate)
+    else:
+        raise ValueError(f"Unknown matcher engine {engine!r}; expected one of {MATCHER_ENGINES}.")
+    for label, patterns in compiled_patterns.items():
+        matcher.add(label, patterns)
+    return matcher
+
+
+def load_dependency_matcher(nlp, path, engine="spacy", prescreen=False, selection=None, lexicon=None):
+    # 指紋が一致すれば作り直したパターンを検証せずに登録し、一致しなければ検証してスタンプを書く
+    tag_inventory = get_tag_inventory(nlp)
+    compiled_patterns = push_down_filter_constraints(compile_tag_regex(create_vac_patterns(), tag_inventory))
+    fingerprint = get_matcher_fingerprint(nlp, compiled_patterns, tag_inventory)
+
+    stamp = _read_matcher_stamp(path)
+    if stamp is not None and stamp.get("fingerprint") == fingerprint:
+        return _build_matcher_from_patterns(nlp, compiled_patterns, validate=False, engine=engine, prescreen=prescreen, selection=selection, lexicon=lexicon)
+
+    # 指紋は全ラベルのパターンから取る（ラベルの指定が違う実行でも共有できる）
+    matcher = _build_matcher_from_patterns(nlp, compiled_patterns, engine=engine, prescreen=prescreen, selection=selection, lexicon=lexicon)
+    save_matcher_stamp(path, fingerprint)
+    return matcher
+
+
+# spaCyのパイプラインコンポーネント ------------------------------------------------------------
+# 結果は doc.spans[spans_key]（動詞1語のSpan、label=VACラベル）と token._.vac に書き込む
+if not Token.has_extension("vac"):
+    Token.set_extension("vac", default=None)
+
+
+class VACExtractor:
+    def __init__(self, nlp, name="vac_extractor", spans_key="vac", lazy=True, matcher_cache=None, engine="spacy", prescreen=False, labels=None, lexicon=None, by_sentence=False, budget=None):
+        self.nlp = nlp
+        self.engine = engine
+        self.prescreen = prescreen
+        self.name = name
+        self.spans_key = spans_key
+        self.lazy = lazy
+        self.matcher_cache = matcher_cache
+        self.selection = VACLabelSelection(labels) if labels else None
+        # lexicon はフレーム辞書のパス（最初の呼び出し時に読み込む）
+        self.lexicon_path = lexicon
+        self.lexicon = None
+        self.by_sentence = by_sentence
+        # budget は VACBudget の引数の dict。飛ばした範囲は doc.spans[f"{spans_key}_skipped"]（label は理由）に入れる
+        self.budget = VACBudget(**budget) if budget else None
+        self._matcher = None
+
+    @property
+    def matcher(self):
+        # タグ集合は tagger の読み込み後に確定するため、最初の呼び出し時に作成する
+        if self._matcher is None:
+            self._load_lexicon()
+            if self.matcher_cache:
+                self._matcher = load_dependency_matcher(self.nlp, self.matcher_cache, engine=self.engine, prescreen=self.prescreen, selection=self.selection, lexicon=self.lexicon)
+            else:
+                self._matcher = create_dependency_matcher(self.nlp, engine=self.engine, prescreen=self.prescreen, selection=self.selection, lexicon=self.lexicon)
+        return self._matcher
+
+    def __call__(self, doc):
+        if self.by_sentence or self.budget is not None:
+            return self._set_annotations(doc, None)
+        return self._set_annotations(doc, self.matcher(doc))
+
+    def _set_annotations(self, doc, matches):
+        if self.budget is not None:
+            results, report = extract_VAC_with_budget(doc, self.matcher, self.nlp, self.budget, lazy=self.lazy, selection=self.selection, lexicon=self.lexicon)
+            doc.spans[f"{self.spans_key}_skipped"] = [Span(doc, record["start"], record["end"], label=record["reason"]) for record in report["skipped"]]
+        elif self.by_sentence:
+            results = extract_VAC_by_sentence(doc, self.matcher, self.nlp, lazy=self.lazy, selection=self.selection, lexicon=self.lexicon)
+        else:
+            results = extract_VAC(doc, self.matcher, self.nlp, lazy=self.lazy, matches=matches, selection=self.selection, lexicon=self.lexicon)
+        spans = []
+        for idx, label in results:
+            spans.append(Span(doc, idx, idx + 1, label=label))
+            doc[idx]._.vac = label
+        doc.spans[self.spans_key] = spans
+        return doc
+
+    def pipe(self, stream, batch_size=128):
+        for docs in spacy.util.minibatch(stream, size=batch_size):
+            if self.by_sentence or self.budget is not None:
+                for doc in docs:
+                    yield self._set_annotations(doc, None)
+                continue
+            batch_matches = match_VAC_batch(docs, self.matcher)
+            for doc, matches in zip(docs, batch_matches):
+                yield self._set_annotations(doc, matches)
+
+    def _load_lexicon(self):
+        if self.lexicon is None and self.lexicon_path:
+            self.lexicon = VACFrameLexicon.load(self.lexicon_path)
+        return self.lexicon
+
+    # 保存時は設定を cfg に、フレーム辞書はパスではなく中身を lexicon に書き出す（読み込む側に元の辞書ファイルがなくてもよい）
+    # マッチャーは保存せず、読み込み後の最初の呼び出しで作り直す
+    def _get_cfg(self):
+        return {
+            "spans_key": self.spans_key,
+            "lazy": self.lazy,
+            "matcher_cache": self.matcher_cache,
+            "engine": self.engine,
+            "prescreen": self.prescreen,
+            "labels": self.selection.requested if self.selection is not None else None,
+            "by_sentence": self.by_sentence,
+            "budget": vars(self.budget) if self.budget is not None else None,
+        }
+
+    def _set_cfg(self, cfg):
+        self.spans_key = cfg["spans_key"]
+        self.lazy = cfg["lazy"]
+        self.matcher_cache = cfg["matcher_cache"]
+        self.engine = cfg["engine"]
+        self.prescreen = cfg["prescreen"]
+        self.selection = VACLabelSelection(cfg["labels"]) if cfg["labels"] else None
+        self.by_sentence = cfg["by_sentence"]
+        self.budget = VACBudget(**cfg["budget"]) if cfg["budget"] else None
+        # 辞書は保存されていたものに置き換える（保存されていなければ辞書なし）
+        self.lexicon_path = None
+        self.lexicon = None
+        self._matcher = None
+
+    def to_disk(self, path, *, exclude=tuple()):
+        lexicon = self._load_lexicon()
+
+        def write_cfg(cfg_path):
+            with open(cfg_path, "w", encoding="utf-8") as f:
+                json.dump(self._get_cfg(), f, ensure_ascii=False)
+
+        serializers = {"cfg": write_cfg}
+        if lexicon is not None:
+            serializers["lexicon"] = lambda lexicon_path: lexicon.save(str(lexicon_path))
+        spacy.util.to_disk(path, serializers, exclude)
+
+    def from_disk(self, path, *, exclude=tuple()):
+        def read_cfg(cfg_path):
+            with open(cfg_path, encoding="utf-8") as f:
+                self._set_cfg(json.load(f))
+
+        def read_lexicon(lexicon_path):
+            if lexicon_path.exists():
+                self.lexicon = VACFrameLexicon.load(str(lexicon_path))
+
+        spacy.util.from_disk(path, {"cfg": read_cfg, "lexicon": read_lexicon}, exclude)
+        return self
+
+    def to_bytes(self, *, exclude=tuple()):
+        lexicon = self._load_lexicon()
+        serializers = {"cfg": lambda: json.dumps(self._get_cfg(), ensure_ascii=False)}
+        if lexicon is not None:
+            serializers["lexicon"] = lexicon.to_bytes
+        return spacy.util.to_bytes(serializers, exclude)
+
+    def from_bytes(self, bytes_data, *, exclude=tuple()):
+        def set_lexicon(data):
+            self.lexicon = VACFrameLexicon.from_bytes(data)
+
+        spacy.util.from_bytes(bytes_data, {"cfg": lambda data: self._set_cfg(json.loads(data)), "lexicon": set_lexicon}, exclude)
+        return self
+
+
+@Language.factory(
+    "vac_extractor",
+    default_config={"spans_key": "vac", "lazy": True, "matcher_cache": None, "engine": "spacy", "prescreen": False, "labels": None, "lexicon": None, "by_sentence": False, "budget": None},
+    requires=["token.tag", "token.dep", "token.head", "token.lemma"],
+    assigns=["doc.spans", "token._.vac"],
+)
+def make_vac_extractor(nlp, name, spans_key, lazy, matcher_cache, engine, prescreen, labels, lexicon, by_sentence, budget):
+    return VACExtractor(nlp, name, spans_key=spans_key, lazy=lazy, matcher_cache=matcher_cache, engine=engine, prescreen=prescreen, labels=labels, lexicon=lexicon, by_sentence=by_sentence, budget=budget)
+
+
+def get_VAC_spans(doc, spans_key="vac"):
+    # コンポーネントの出力を extract_VAC と同じ (idx, label) のリストに戻す
+    if spans_key not in doc.spans:
+        return []
+    return [(span.start, span.label_) for span in doc.spans[spans_key]]
+
+
+# 解析結果のキャッシュ ------------------------------------------------------------
+PARSE_CACHE_VERSION = 1
+
+
+def get_parser_fingerprint(nlp):
+    # パイプラインの名前と版だけでは再学習したモデルと区別できないため、設定・トークナイザ・各コンポーネントの重みも含める
+    digest = hashlib.sha256()
+    digest.update(json.dumps([PARSE_CACHE_VERSION, spacy.__version__, get_pipeline_signature(nlp)], sort_keys=True).encode("utf-8"))
+    digest.update(nlp.config.to_str().encode("utf-8"))
+    digest.update(nlp.tokenizer.to_bytes(exclude=["vocab"]))
+    for name, pipe in nlp.pipeline:
+        digest.update(name.encode("utf-8"))
+        # 関数のコンポーネントは保存する状態を持たない
+        if hasattr(pipe, "to_bytes"):
+            digest.update(pipe.to_bytes(exclude=["vocab"]))
+    return digest.hexdigest()
+
+
+class ParseCache:
+    # テキストのハッシュと解析モデルの指紋をキーに、解析済みDocをDocBinのシャードに保存する
+    def __init__(self, path, nlp, max_bytes=None, shard_size=1000, max_loaded_shards=4):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.vocab = nlp.vocab
+        self.fingerprint = get_parser_fingerprint(nlp)
+        self.max_bytes = max_bytes
+        self.shard_size = shard_size
+        self.max_loaded_shards = max_loaded_shards
+        self.hits = 0
+        self.misses = 0
+        self._shards = {}
+        self._entries = {}
+        self._loaded = OrderedDict()
+        self._pending = {}
+        self._removed = set()
+        self._read_index()
+
+    @property
+    def index_path(self):
+        return os.path.join(self.path, "index.json")
+
+    def _read_index(self):
+        # ディスク上のインデックスを取り込む。同じディレクトリを使う他のプロセスが追加・削除したシャードもここで反映される
+        if not os.path.exists(self.index_path):
+            return
+        with open(self.index_path, encoding="utf-8") as f:
+            index = json.load(f)
+        if index.get("version") != PARSE_CACHE_VERSION:
+            return
+        for name, shard in index["shards"].items():
+            # インデックスに残っていても実体が消えているシャードや、このプロセスが削除したシャードは無視する
+            if name in self._removed or not os.path.exists(os.path.join(self.path, name)):
+                continue
+            if name in self._shards:
+                self._shards[name]["last_used"] = max(self._shards[name]["last_used"], shard["last_used"])
+                continue
+            self._shards[name] = shard
+            for pos, key in enumerate(shard["keys"]):
+                self._entries.setdefault(key, (name, pos))
+        for name in list(self._shards):
+            if not os.path.exists(os.path.join(self.path, name)):
+                self._drop_shard(name)
+
+    def _write_index(self):
+        index = {"version": PARSE_CACHE_VERSION, "shards": self._shards}
+        tmp_path = f"{self.index_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(index, f)
+        os.replace(tmp_path, self.index_path)
+
+    def key(self, text):
+        return hashlib.sha256((self.fingerprint + "\0" + text).encode("utf-8")).hexdigest()
+
+    def __contains__(self, key):
+        return key in self._entries or key in self._pending
+
+    def __len__(self):
+        return len(self._entries) + len(self._pending)
+
+    @property
+    def total_bytes(self):
+        return sum(shard["bytes"] for shard in self._shards.values())
+
+    def _load_shard(self, name):
+        if name in self._loaded:
+            self._loaded.move_to_end(name)
+            return self._loaded[name]
+        doc_bin = DocBin().from_disk(os.path.join(self.path, name))
+        docs = list(doc_bin.get_docs(self.vocab))
+        self._loaded[name] = docs
+        if len(self._loaded) > self.max_loaded_shards:
+            self._loaded.popitem(last=False)
+        return docs
+
+    def get(self, key):
+        # シャードに書き出す前の文書もキャッシュとして返す
+        if key in self._pending:
+            self.hits += 1
+            return self._pending[key]
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        name, pos = entry
+        try:
+            docs = self._load_shard(name)
+        except FileNotFoundError:
+            # 他のプロセスが容量超過で削除したシャードは未登録として扱う
+            self._drop_shard(name)
+            self.misses += 1
+            return None
+        self._shards[name]["last_used"] = time.time()
+        self.hits += 1
+        return docs[pos]
+
+    def put(self, key, doc):
+        # シャードを書き出すたびに容量超過のシャードを削除するため、実行中も書き出しの直後を除いて max_bytes を超えない
+        if key in self:
+            return
+        self._pending[key] = doc
+        if len(self._pending) >= self.shard_size:
+            self.flush()
+
+    def flush(self):
+        if self._pending:
+            doc_bin = DocBin(store_user_data=False, docs=self._pending.values())
+            data = doc_bin.to_bytes()
+            name = f"shard-{time.time_ns()}-{os.getpid()}.spacy"
+            with open(os.path.join(self.path, name), "wb") as f:
+                f.write(data)
+            now = time.time()
+            self._shards[name] = {"bytes": len(data), "created": now, "last_used": now, "keys": list(self._pending)}
+            for pos, key in enumerate(self._pending):
+                self._entries[key] = (name, pos)
+            self._pending = {}
+        # index.json は丸ごと置き換えるため、直前にディスク上の内容と合わせて他のプロセスのシャードを消さないようにする
+        self._read_index()
+        self.evict()
+        self._write_index()
+
+    def evict(self):
+        # 容量を超えた場合は最後に使われた時刻が古いシャードから丸ごと削除する
+        if self.max_bytes is None:
+            return
+        total = self.total_bytes
+        for name in sorted(self._shards, key=lambda n: self._shards[n]["last_used"]):
+            if total <= self.max_bytes:
+                break
+            total -= self._drop_shard(name)["bytes"]
+            self._removed.add(name)
+            try:
+                os.remove(os.path.join(self.path, name))
+            except FileNotFoundError:
+                pass
+
+    def _drop_shard(self, name):
+        shard = self._shards.pop(name)
+        for key in shard["keys"]:
+            if self._entries.get(key, (None,))[0] == name:
+                del self._entries[key]
+        self._loaded.pop(name, None)
+        return shard
+
+    def close(self):
+        self.flush()
+
+
+def iter_parsed_with_cache(items, spacy_nlp, parse_cache, n_process=1, batch_size=64, max_pending=1024):
+    # items: (text, context) のイテラブル。キャッシュにある文書は nlp を通さず、入力順を保って (doc, context) を返す
+    # 解析待ちの文書がなければヒットはそのまま返す。解析中にヒットが max_pending 件続いた場合は nlp.pipe をいったん閉じてヒットを返す
+    # （キャッシュが温まっている区間でも入力を読み切らずに出力し、pending を max_pending 件程度に抑える）
+    # ヒットは見つけた時点で Doc を取り出しておく（解析中のシャード書き出しで容量超過のシャードが削除されても返せる）
+    items = iter(items)
+    pending = deque()
+
+    def iter_misses(first_text):
+        yield first_text, None
+        n_hits = 0
+        for text, context in items:
+            key = parse_cache.key(text)
+            doc = parse_cache.get(key)
+            pending.append((context, key, doc))
+            if doc is not None:
+                n_hits += 1
+                if n_hits >= max_pending:
+                    return
+            else:
+                n_hits = 0
+                yield text, None
+
+    def drain_hits():
+        while pending and pending[0][2] is not None:
+            context, _, doc = pending.popleft()
+            yield doc, context
+
+    for text, context in items:
+        key = parse_cache.key(text)
+        doc = parse_cache.get(key)
+        if doc is not None:
+            yield doc, context
+            continue
+        pending.append((context, key, None))
+        for doc, _ in spacy_nlp.pipe(iter_misses(text), as_tuples=True, n_process=n_process, batch_size=batch_size):
+            yield from drain_hits()
+            miss_context, miss_key, _ = pending.popleft()
+            parse_cache.put(miss_key, doc)
+            yield doc, miss_context
+        yield from drain_hits()
+
+
+def warm_parse_cache(records, spacy_nlp, parse_cache, n_process=1, batch_size=64):
+    # コーパス全体を (必要なら複数プロセスで) 解析し、未登録の文書をキャッシュに追加する
+    n_texts = 0
+    n_cached = 0
+    queued = set()
+
+    def iter_missing():
+        nonlocal n_texts, n_cached
+        for record in records:
+            text = record[-1]
+            n_texts += 1
+            key = parse_cache.key(text)
+            if key in parse_cache or key in queued:
+                n_cached += 1
+                continue
+            queued.add(key)
+            yield text, key
+
+    n_parsed = 0
+    for doc, key in spacy_nlp.pipe(iter_missing(), as_tuples=True, n_process=n_process, batch_size=batch_size):
+        parse_cache.put(key, doc)
+        queued.discard(key)
+        n_parsed += 1
+    parse_cache.flush()
+    return {"texts": n_texts, "cached": n_cached, "parsed": n_parsed}
+
+
+# コーパスファイルの逐次読み込み ------------------------------------------------------------
+# 非圧縮のファイルは mmap で開き、ページキャッシュから直接読む（ファイル全体を Python の文字列にしない）。
+# 圧縮ファイルは拡張子で判定し、伸長しながら読む。zstd は zstandard がある場合のみ
+CORPUS_INPUT_FORMATS = ("lines", "jsonl", "chunks")
+CORPUS_CHUNK_CHARS = 100_000
+CORPUS_READ_BYTES = 1 << 20
+_SENTENCE_END_RE = re.compile(r"[.!?][\"')\]]*\s+")
+
+
+def open_corpus_file(path):
+    # バイナリのファイルオブジェクトを返す（read/readline/close を持つ）
+    if path.endswith(".gz"):
+        return gzip.open(path, "rb")
+    if path.endswith(".bz2"):
+        return bz2.open(path, "rb")
+    if path.endswith(".xz"):
+        return lzma.open(path, "rb")
+    if path.endswith(".zst"):
+        if zstandard is None:
+            raise RuntimeError(f"{path}: reading .zst files requires the zstandard package")
+        f = open(path, "rb")
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(f, closefd=True))
+    f = open(path, "rb")
+    if os.fstat(f.fileno()).st_size == 0:
+        # 長さ0のファイルは mmap できない
+        return f
+    try:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    finally:
+        f.close()
+
+
+def _corpus_base_name(path):
+    base = os.path.basename(path)
+    for ext in (".gz", ".bz2", ".xz", ".zst"):
+        if base.endswith(ext):
+            return base[:-len(ext)]
+    return base
+
+
+def _find_chunk_end(text, max_chars):
+    # max_chars 以内で、段落の切れ目 > 文末 > 空白 の順に切る位置を探す（見つからなければ max_chars で切る）
+    window = text[:max_chars]
+    cut = window.rfind("\n\n")
+    if cut > 0:
+        return cut + 2
+    ends = [m.end() for m in _SENTENCE_END_RE.finditer(window)]
+    if ends:
+        return ends[-1]
+    for cut in range(len(window) - 1, 0, -1):
+        if window[cut].isspace():
+            return cut + 1
+    return max_chars
+
+
+def iter_corpus_chunks(path, input_format="lines", max_chars=CORPUS_CHUNK_CHARS, text_field="text", id_field="id"):
+    # (doc_id, char_offset, text) を1つずつ返す。char_offset は元の（伸長後の）ファイル先頭からの文字位置
+    #   lines:  1行1文書（空行はスキップ）
+    #   jsonl:  1行1つの JSON。text_field を本文、id_field（なければ "ファイル名:行番号"）を doc_id にする。char_offset はその行の先頭の位置
+    #           （本文はエスケープされているためファイル上の位置とは対応しない。本文内の位置は char - offset で求める）
+    #   chunks: ファイル全体を1つのテキストとみなし、max_chars 以内の段落・文の切れ目で分割する
+    if input_format not in CORPUS_INPUT_FORMATS:
+        raise ValueError(f"unknown input format: {input_format} (expected one of {', '.join(CORPUS_INPUT_FORMATS)})")
+    base = _corpus_base_name(path)
+    f = open_corpus_file(path)
+    try:
+        if input_format == "chunks":
+            yield from _iter_text_chunks(f, base, max_chars)
+            return
+        offset = 0
+        for line_no, raw in enumerate(iter(f.readline, b""), start=1):
+            line = raw.decode("utf-8")
+            line_offset = offset
+            offset += len(line)
+            if not line.strip():
+                continue
+            if input_format == "jsonl":
+                obj = json.loads(line)
+                doc_id = obj.get(id_field)
+                yield (f"{base}:{line_no}" if doc_id is None else str(doc_id)), line_offset, obj[text_field]
+            else:
+                yield f"{base}:{line_no}", line_offset, line.rstrip("\r\n")
+    finally:
+        f.close()
+
+
+def _iter_text_chunks(f, base, max_chars):
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    buffer = ""
+    offset = 0
+    k = 0
+    eof = False
+    while True:
+        while not eof and len(buffer) <= max_chars:
+            data = f.read(CORPUS_READ_BYTES)
+            eof = not data
+            buffer += decoder.decode(data, final=eof)
+        if not buffer:
+            return
+        end = len(buffer) if eof and len(buffer) <= max_chars else _find_chunk_end(buffer, max_chars)
+        text = buffer[:end]
+        if text.strip():
+            k += 1
+            yield f"{base}:{k}", offset, text
+        offset += end
+        buffer = buffer[end:]
+
+
+# コーパス単位の抽出パイプライン ------------------------------------------------------------
+# reader -> nlp.pipe による解析 -> マッチング -> 書き出し の各段を上限付きキューでつなぐ。
+# キューが詰まると上流が待つ（バックプレッシャー）ため、巨大なコーパスでもメモリ使用量は一定に保たれる。
+_PIPELINE_END = object()
+
+
+def read_corpus_texts(path):
+    # ディレクトリの場合は *.txt を1ファイル1文書として読み込む
+    if os.path.isdir(path):
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                if not name.endswith(".txt"):
+                    continue
+                file_path = os.path.join(root, name)
+                with open(file_path, encoding="utf-8") as f:
+                    yield os.path.relpath(file_path, path), f.read()
+        return
+
+    # ファイルの場合は1行1文書（空行はスキップ。圧縮ファイルも可）
+    for doc_id, _, text in iter_corpus_chunks(path, "lines"):
+        yield doc_id, text
+
+
+class JsonlVACWriter:
+    def __init__(self, path):
+        dir_path = os.path.dirname(path)
+        if dir_path:
+            os.makedirs(dir_path, exist_ok=True)
+        self.path = path
+        self._file = open(path, "w", encoding="utf-8")
+
+    def write(self, record):
+        self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    def close(self):
+        self._file.close()
+
+
+# Parquet の列。label は VAC_LABELS を辞書とする辞書符号化（行グループをまたいで番号が共通）
+# char_start/char_end は動詞の文字位置（offset 付きの入力では元のファイル上の位置）、tokens は採用したマッチの token_ids
+PARQUET_ROW_GROUP_SIZE = 1 << 20
+
+
+def get_parquet_schema():
+    return pa.schema([
+        ("doc_id", pa.string()),
+        ("sent", pa.int32()),
+        ("char_start", pa.int64()),
+        ("char_end", pa.int64()),
+        ("i", pa.int32()),
+        ("lemma", pa.string()),
+        ("label", pa.dictionary(pa.int8(), pa.string())),
+        ("tokens", pa.list_(pa.int32())),
+    ])
+
+
+class ParquetVACWriter:
+    # extract_VAC_corpus(..., with_tokens=True) のレコードを1行1 VAC で書き出す。
+    # row_group_size 行たまるごとに行グループを書き出すため、メモリ使用量は行グループ1つ分で一定
+    def __init__(self, path, row_group_size=PARQUET_ROW_GROUP_SIZE, compression="zstd"):
+        if pa is None:
+            raise RuntimeError("Parquet output requires the pyarrow package")
+        dir_path = os.path.dirname(path)
+        if dir_path:
+            os.makedirs(dir_path, exist_ok=True)
+        self.path = path
+        self.row_group_size = row_group_size
+        self.schema = get_parquet_schema()
+        self._labels = pa.array(VAC_LABELS, type=pa.string())
+        self._writer = pq.ParquetWriter(path, self.schema, compression=compression)
+        self._columns = {name: [] for name in self.schema.names}
+        self._n_rows = 0
+
+    def write(self, record):
+        columns = self._columns
+        for vac in record["vacs"]:
+            if "tokens" not in vac:
+                raise ValueError("ParquetVACWriter needs records built with with_tokens=True")
+            columns["doc_id"].append(record["doc_id"])
+            columns["sent"].append(vac["sent"])
+            columns["char_start"].append(vac["char"])
+            columns["char_end"].append(vac["char"] + len(vac["verb"]))
+            columns["i"].append(vac["i"])
+            columns["lemma"].append(vac["lemma"])
+            columns["label"].append(VAC_LABEL_IDS[vac["label"]])
+            columns["tokens"].append(vac["tokens"])
+        self._n_rows += len(record["vacs"])
+        if self._n_rows >= self.row_group_size:
+            self.flush()
+
+    def flush(self):
+        if not self._n_rows:
+            return
+        columns = self._columns
+        arrays = []
+        for field in self.schema:
+            if field.name == "label":
+                arrays.append(pa.DictionaryArray.from_arrays(pa.array(columns["label"], type=pa.int8()), self._labels))
+            else:
+                arrays.append(pa.array(columns[field.name], type=field.type))
+        self._writer.write_table(pa.Table.from_arrays(arrays, schema=self.schema), row_group_size=self._n_rows)
+        self._columns = {name: [] for name in self.schema.names}
+        self._n_rows = 0
+
+    def close(self):
+        self.flush()
+        self._writer.close()
+
+
+# SQLite の結果ストア。lemma とラベルは表に登録して番号で持ち、(label, lemma) と文書で索引を張る。
+# 挿入は batch_size 件ごとに1つのトランザクションにまとめる（WAL なので書き込み中も別の接続から読める）
+SQLITE_STORE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS labels (id INTEGER PRIMARY KEY, label TEXT NOT NULL UNIQUE);
+CREATE TABLE IF NOT EXISTS lemmas (id INTEGER PRIMARY KEY, lemma TEXT NOT NULL UNIQUE);
+CREATE TABLE IF NOT EXISTS docs (id INTEGER PRIMARY KEY, doc_id TEXT NOT NULL, char_offset INTEGER, skipped TEXT);
+CREATE TABLE IF NOT EXISTS vacs (
+    doc INTEGER NOT NULL REFERENCES docs(id),
+    i INTEGER NOT NULL,
+    verb TEXT NOT NULL,
+    lemma INTEGER NOT NULL REFERENCES lemmas(id),
+    label INTEGER NOT NULL REFERENCES labels(id),
+    char INTEGER,
+    sent INTEGER,
+    tokens TEXT
+);
+CREATE VIEW IF NOT EXISTS vac_view AS
+    SELECT docs.doc_id, vacs.i, vacs.verb, lemmas.lemma, labels.label, vacs.char, vacs.sent, vacs.tokens
+    FROM vacs
+    JOIN docs ON docs.id = vacs.doc
+    JOIN lemmas ON lemmas.id = vacs.lemma
+    JOIN labels ON labels.id = vacs.label;
+"""
+# 索引は一括挿入の後に作る（挿入中に索引を更新するより速い）
+SQLITE_STORE_INDEXES = """
+CREATE INDEX IF NOT EXISTS vacs_label_lemma ON vacs (label, lemma);
+CREATE INDEX IF NOT EXISTS vacs_doc ON vacs (doc);
+CREATE INDEX IF NOT EXISTS docs_doc_id ON docs (doc_id);
+"""
+SQLITE_BATCH_SIZE = 50_000
+
+
+class SqliteVACWriter:
+    # append=False の場合は既存のストアを作り直す（JsonlVACWriter と同じく上書き）
+    def __init__(self, path, batch_size=SQLITE_BATCH_SIZE, append=False):
+        dir_path = os.path.dirname(path)
+        if dir_path:
+            os.makedirs(dir_path, exist_ok=True)
+        if not append:
+            for suffix in ("", "-wal", "-shm"):
+                if os.path.exists(path + suffix):
+                    os.remove(path + suffix)
+        self.path = path
+        self.batch_size = batch_size
+        # extract_VAC_corpus は書き出しスレッドで write し、呼び出し元のスレッドで close する（同時には使わない）
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(SQLITE_STORE_SCHEMA)
+        # ラベルは VAC_LABELS の番号をそのまま使う
+        self._conn.executemany("INSERT OR IGNORE INTO labels (id, label) VALUES (?, ?)", enumerate(VAC_LABELS))
+        self._conn.commit()
+        self._lemma_ids = dict(self._conn.execute("SELECT lemma, id FROM lemmas"))
+        self._next_doc = self._conn.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM docs").fetchone()[0]
+        self._docs = []
+        self._lemmas = []
+        self._vacs = []
+
+    def _lemma_id(self, lemma):
+        lemma_id = self._lemma_ids.get(lemma)
+        if lemma_id is None:
+            lemma_id = len(self._lemma_ids) + 1
+            self._lemma_ids[lemma] = lemma_id
+            self._lemmas.append((lemma_id, lemma))
+        return lemma_id
+
+    def write(self, record):
+        doc = self._next_doc
+        self._next_doc += 1
+        skipped = record.get("skipped")
+        self._docs.append((doc, record["doc_id"], record.get("offset"), json.dumps(skipped) if skipped else None))
+        for vac in record["vacs"]:
+            tokens = vac.get("tokens")
+            self._vacs.append((
+                doc, vac["i"], vac["verb"], self._lemma_id(vac["lemma"]), VAC_LABEL_IDS[vac["label"]],
+                vac.get("char"), vac.get("sent"), json.dumps(tokens) if tokens is not None else None,
+            ))
+        if len(self._vacs) + len(self._docs) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        with self._conn:
+            self._conn.executemany("INSERT INTO lemmas (id, lemma) VALUES (?, ?)", self._lemmas)
+            self._conn.executemany("INSERT INTO docs (id, doc_id, char_offset, skipped) VALUES (?, ?, ?, ?)", self._docs)
+            self._conn.executemany("INSERT INTO vacs (doc, i, verb, lemma, label, char, sent, tokens) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", self._vacs)
+        self._docs = []
+        self._lemmas = []
+        self._vacs = []
+
+    def close(self):
+        self.flush()
+        self._conn.executescript(SQLITE_STORE_INDEXES)
+        self._conn.execute("PRAGMA optimize")
+        self._conn.close()
+
+
+def query_VAC_store(path, label=None, lemma=None, doc_id=None, limit=None):
+    # (doc_id, i, verb, lemma, label, char, sent, tokens) の行を返す。label と lemma の絞り込みは vacs_label_lemma 索引を使う
+    conditions = []
+    params = []
+    for column, value in (("labels.label", label), ("lemmas.lemma", lemma), ("docs.doc_id", doc_id)):
+        if value is not None:
+            conditions.append(f"{column} = ?")
+            params.append(value)
+    sql = (
+        "SELECT docs.doc_id, vacs.i, vacs.verb, lemmas.lemma, labels.label, vacs.char, vacs.sent, vacs.tokens"
+        " FROM vacs JOIN docs ON docs.id = vacs.doc JOIN lemmas ON lemmas.id = vacs.lemma JOIN labels ON labels.id = vacs.label"
+    )
+    if conditions:
+        sql += " WHERE " + " AND ".join(conditions)
+    sql += " ORDER BY vacs.doc, vacs.i"
+    if limit is not None:
+        sql += f" LIMIT {int(limit)}"
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        rows = conn.execute(sql, params).fetchall()
+    finally:
+        conn.close()
+    return [row[:7] + (json.loads(row[7]) if row[7] is not None else None,) for row in rows]
+
+
+# 書き出し専用のプロセス ------------------------------------------------------------
+# 複数のプロセスで抽出する場合でも、ストアに書き込むのは1つのプロセスだけにする。
+# 各プロセスは QueueVACWriter でレコードをキューに送り、WriterProcess が writer_factory() で作った writer に順に書き込む
+class QueueVACWriter:
+    def __init__(self, record_queue):
+        self._queue = record_queue
+
+    def write(self, record):
+        self._queue.put(record)
+
+    def close(self):
+        # ストアを閉じるのは WriterProcess.close
+        pass
+
+
+def _run_writer_process(writer_factory, record_queue):
+    writer = None
+    error = None
+    try:
+        writer = writer_factory()
+    except BaseException as exc:  # noqa: BLE001
+        error = exc
+    while True:
+        record = record_queue.get()
+        if record is None:
+            break
+        if error is not None:
+            # 書き込みに失敗した後も送り手が詰まらないように、キューは最後まで読み捨てる
+            continue
+        try:
+            writer.write(record)
+        except BaseException as exc:  # noqa: BLE001
+            error = exc
+    if writer is not None:
+        try:
+            writer.close()
+        except BaseException as exc:  # noqa: BLE001
+            error = error or exc
+    if error is not None:
+        print(f"vac-writer: {type(error).__name__}: {error}", file=sys.stderr)
+        sys.exit(1)
+
+
+class WriterProcess:
+    # writer_factory はプロセスに渡すため pickle できるもの（functools.partial(SqliteVACWriter, path) など）
+    def __init__(self, writer_factory, queue_size=1024, context=None):
+        context = context or multiprocessing.get_context()
+        self._queue = context.Queue(maxsize=queue_size)
+        self._process = context.Process(target=_run_writer_process, args=(writer_factory, self._queue), name="vac-writer", daemon=True)
+        self._process.start()
+
+    def client(self):
+        return QueueVACWriter(self._queue)
+
+    def close(self):
+        self._queue.put(None)
+        self._process.join()
+        if self._process.exitcode != 0:
+            raise RuntimeError(f"writer process exited with code {self._process.exitcode}")
+
+
+def build_VAC_record(doc_id, doc, results, offset=None):
+    # offset: 文書の先頭の、元のファイル上の文字位置（分割して読み込んだ場合）。各 VAC に動詞のファイル上の位置 "char" を付ける
+    # results が token_ids 付き（with_tokens=True）の場合は、文番号 "sent" と "tokens" も付ける（"char" は offset がなければ文書内の位置）
+    vacs = []
+    sent_ids = None
+    for result in results:
+        idx, label = result[0], result[1]
+        token = doc[idx]
+        vac = {"i": idx, "verb": token.text, "lemma": token.lemma_, "label": label}
+        if offset is not None:
+            vac["char"] = offset + token.idx
+        if len(result) == 3:
+            if sent_ids is None:
+                sent_ids = _sentence_ids(doc)
+            vac["sent"] = int(sent_ids[idx])
+            vac["tokens"] = result[2]
+            vac.setdefault("char", token.idx)
+        vacs.append(vac)
+    if offset is None:
+        return {"doc_id": doc_id, "vacs": vacs}
+    return {"doc_id": doc_id, "offset": offset, "vacs": vacs}
+
+
+def _put_or_stop(q, item, stop_event):
+    # 下流が異常終了した場合に put で永久に待たないようにする
+    while not stop_event.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _get_or_stop(q, stop_event):
+    while not stop_event.is_set():
+        try:
+            return q.get(timeout=0.1)
+        except queue.Empty:
+            continue
+    return _PIPELINE_END
+
+
+def _extract_VAC_batch(batch_docs, matcher, spacy_nlp, selection=None, lexicon=None, by_sentence=False, budget=None, with_tokens=False):
+    # 解析済みの文書のバッチの結果と、budget を指定した場合は文書ごとの処理の記録を返す
+    batch_reports = [None] * len(batch_docs)
+    if budget is not None:
+        batch_results = []
+        for k, doc in enumerate(batch_docs):
+            results, batch_reports[k] = extract_VAC_with_budget(doc, matcher, spacy_nlp, budget, selection=selection, lexicon=lexicon, with_tokens=with_tokens)
+            batch_results.append(results)
+    elif by_sentence:
+        # 文単位では文書をまとめてマッチングせず、1文ずつ処理する
+        batch_results = [extract_VAC_by_sentence(doc, matcher, spacy_nlp, selection=selection, lexicon=lexicon, with_tokens=with_tokens) for doc in batch_docs]
+    else:
+        batch_matches = match_VAC_batch(batch_docs, matcher)
+        batch_results = [
+            extract_VAC(doc, matcher, spacy_nlp, matches=matches, selection=selection, lexicon=lexicon, with_tokens=with_tokens)
+            for doc, matches in zip(batch_docs, batch_matches)
+        ]
+    return batch_results, batch_reports
+
+
+def extract_VAC_corpus(records, spacy_nlp, writer, matcher=None, n_process=1, batch_size=64, queue_size=256, parse_cache=None, selection=None, lexicon=None, by_sentence=False, budget=None, slow_log=None, preparsed=False, with_tokens=False):
+    # records: (doc_id, text) または (doc_id, char_offset, text) のイテラブル（preparsed=True なら (doc_id, Doc)。read_conllu などの解析済みの入力で、spaCy の解析を省く）
+    # selection: VACLabelSelection（指定したラベルだけを出力する）
+    # lexicon: VACFrameLexicon（動詞の lemma が取らないラベルを省く。matcher も同じ辞書で作る）
+    # by_sentence: 文ごとにマッチングする（extract_VAC_by_sentence）
+    # budget: VACBudget（文ごとに処理し、上限を超えた文は飛ばして record["skipped"] に残す）
+    # slow_log: budget.slow_seconds 以上かかった文書の記録の書き出し先（write(dict) を持つもの）
+    # with_tokens: 各 VAC に文番号と採用したマッチの token_ids を付ける（ParquetVACWriter 用）
+    if matcher is None:
+        matcher = create_dependency_matcher(spacy_nlp, selection=selection, lexicon=lexicon)
+
+    read_q = queue.Queue(maxsize=queue_size)
+    parsed_q = queue.Queue(maxsize=queue_size)
+    write_q = queue.Queue(maxsize=queue_size)
+    stop_event = threading.Event()
+    errors = []
+
+    def reader_stage():
+        try:
+            for record in records:
+                # (doc_id, char_offset, text) の場合は元のファイル上の文字位置も出力する
+                if len(record) == 3:
+                    doc_id, offset, text = record
+                else:
+                    (doc_id, text), offset = record, None
+                if not _put_or_stop(read_q, (text, (doc_id, offset)), stop_event):
+                    return
+        except BaseException as exc:  # noqa: BLE001
+            errors.append(exc)
+            stop_event.set()
+        finally:
+            _put_or_stop(read_q, _PIPELINE_END, stop_event)
+
+    def iter_read_queue():
+        while True:
+            item = _get_or_stop(read_q, stop_event)
+            if item is _PIPELINE_END:
+                return
+            yield item
+
+    def parse_stage():
+        try:
+            if preparsed:
+                parsed = iter_read_queue()
+            elif parse_cache is None:
+                parsed = spacy_nlp.pipe(iter_read_queue(), as_tuples=True, n_process=n_process, batch_size=batch_size)
+            else:
+                parsed = iter_parsed_with_cache(iter_read_queue(), spacy_nlp, parse_cache, n_process=n_process, batch_size=batch_size)
+            for doc, context in parsed:
+                if not _put_or_stop(parsed_q, (context, doc), stop_event):
+                    return
+            if parse_cache is not None:
+                parse_cache.flush()
+        except BaseException as exc:  # noqa: BLE001
+            errors.append(exc)
+            stop_event.set()
+        finally:
+            _put_or_stop(parsed_q, _PIPELINE_END, stop_event)
+
+    def writer_stage():
+        try:
+            while True:
+                record = _get_or_stop(write_q, stop_event)
+                if record is _PIPELINE_END:
+                    return
+                writer.write(record)
+        except BaseException as exc:  # noqa: BLE001
+            errors.append(exc)
+            stop_event.set()
+
+    threads = [
+        threading.Thread(target=reader_stage, name="vac-reader", daemon=True),
+        threading.Thread(target=parse_stage, name="vac-parser", daemon=True),
+        threading.Thread(target=writer_stage, name="vac-writer", daemon=True),
+    ]
+    for thread in threads:
+        thread.start()
+
+    # マッチング段はメインスレッドで実行する
+    n_docs = 0
+    n_vacs = 0
+    n_skipped = 0
+    n_slow = 0
+    try:
+        finished = False
+        while not finished:
+            batch = []
+            while len(batch) < batch_size:
+                item = _get_or_stop(parsed_q, stop_event)
+                if item is _PIPELINE_END:
+                    finished = True
+                    break
+                batch.append(item)
+            batch_docs = [doc for _, doc in batch]
+            batch_results, batch_reports = _extract_VAC_batch(
+                batch_docs, matcher, spacy_nlp, selection=selection, lexicon=lexicon, by_sentence=by_sentence, budget=budget, with_tokens=with_tokens,
+            )
+            for ((doc_id, offset), doc), results, report in zip(batch, batch_results, batch_reports):
+                record = build_VAC_record(doc_id, doc, results, offset=offset)
+                if report is not None:
+                    if report["skipped"]:
+                        record["skipped"] = report["skipped"]
+                        n_skipped += 1
+                    if slow_log is not None and budget.slow_seconds is not None and report["seconds"] >= budget.slow_seconds:
+                        slow_log.write({"doc_id": doc_id, "tokens": report["tokens"], "matches": report["matches"], "seconds": round(report["seconds"], 3), "skipped": len(report["skipped"])})
+                        n_slow += 1
+                if not _put_or_stop(write_q, record, stop_event):
+                    finished = True
+                    break
+                n_docs += 1
+                n_vacs += len(results)
+    except BaseException as exc:  # noqa: BLE001
+        errors.append(exc)
+        stop_event.set()
+    finally:
+        _put_or_stop(write_q, _PIPELINE_END, stop_event)
+        for thread in threads:
+            thread.join()
+
+    if errors:
+        raise errors[0]
+    return {"docs": n_docs, "vacs": n_vacs, "skipped_docs": n_skipped, "slow_docs": n_slow}
+
+
+# 事前 fork のワーカープール ------------------------------------------------------------
+# 親プロセスでパイプラインとマッチャーを一度だけ作り、fork した子プロセスでページを共有する（copy-on-write）。
+# fork の前に gc.freeze() で既存のオブジェクトを GC の対象から外し、GC がオブジェクトのヘッダに書き込んで
+# ページが複製されるのを防ぐ（参照カウントの更新による複製は防げない）。各ワーカーは終了時にメモリ使用量を報告する
+_MEMORY_FIELDS = {"Rss": "rss_mb", "Pss": "pss_mb", "Shared_Clean": "shared_clean_mb", "Shared_Dirty": "shared_dirty_mb", "Private_Clean": "private_clean_mb", "Private_Dirty": "private_dirty_mb"}
+
+
+def get_process_memory():
+    # Linux では /proc/self/smaps_rollup の RSS・PSS・共有/専有ページ（MB）。それ以外では最大 RSS のみ
+    report = {}
+    try:
+        with open("/proc/self/smaps_rollup", encoding="ascii") as f:
+            for line in f:
+                name, _, value = line.partition(":")
+                if name in _MEMORY_FIELDS:
+                    report[_MEMORY_FIELDS[name]] = int(value.split()[0]) / 1024
+    except OSError:
+        import resource
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss は Linux では KB、macOS ではバイト
+        report["max_rss_mb"] = maxrss / 2**20 if sys.platform == "darwin" else maxrss / 1024
+    return report
+
+
+def _run_prefork_worker(spacy_nlp, matcher, task_q, result_q, batch_size, options):
+    # matcher.stats はこのプロセスの複製なので、増えた分を "done" で親に返す
+    n_docs = 0
+    n_slow = 0
+    start_stats = dict(getattr(matcher, "stats", {}))
+    budget = options["budget"]
+    try:
+        while True:
+            task = task_q.get()
+            if task is None:
+                break
+            docs = list(spacy_nlp.pipe(((text, (doc_id, offset)) for doc_id, offset, text in task), as_tuples=True, batch_size=batch_size))
+            batch_docs = [doc for doc, _ in docs]
+            batch_results, batch_reports = _extract_VAC_batch(batch_docs, matcher, spacy_nlp, **options)
+            records = []
+            for (doc, (doc_id, offset)), results, report in zip(docs, batch_results, batch_reports):
+                record = build_VAC_record(doc_id, doc, results, offset=offset)
+                if report is not None:
+                    if report["skipped"]:
+                        record["skipped"] = report["skipped"]
+                    if budget.slow_seconds is not None and report["seconds"] >= budget.slow_seconds:
+                        n_slow += 1
+                records.append(record)
+            n_docs += len(records)
+            result_q.put(("records", records))
+        matcher_stats = {name: count - start_stats.get(name, 0) for name, count in getattr(matcher, "stats", {}).items()}
+        result_q.put(("done", {"pid": os.getpid(), "docs": n_docs, "slow_docs": n_slow, "matcher_stats": matcher_stats, **get_process_memory()}))
+    except BaseException as exc:  # noqa: BLE001
+        result_q.put(("error", f"{type(exc).__name__}: {exc}"))
+
+
+def extract_VAC_prefork(records, spacy_nlp, writer, matcher=None, n_workers=2, batch_size=64, queue_size=16, freeze=True, selection=None, lexicon=None, by_sentence=False, budget=None, with_tokens=False):
+    # records と writer は extract_VAC_corpus と同じ。出力の順は入力の順と一致しない（batch_size 文書ごとに終わった順）
+    # freeze: fork の前に gc.freeze() する（比較用に無効にできる）
+    # ワーカーの matcher.stats の増分は、終了時に親の matcher.stats に足す
+    if "fork" not in multiprocessing.get_all_start_methods():
+        raise RuntimeError("extract_VAC_prefork requires the fork start method")
+    if matcher is None:
+        matcher = create_dependency_matcher(spacy_nlp, selection=selection, lexicon=lexicon)
+    options = {"selection": selection, "lexicon": lexicon, "by_sentence": by_sentence, "budget": budget, "with_tokens": with_tokens}
+    context = multiprocessing.get_context("fork")
+    task_q = context.Queue(maxsize=queue_size)
+    result_q = context.Queue(maxsize=queue_size)
+    parent_memory = get_process_memory()
+    if freeze:
+        gc.collect()
+        gc.freeze()
+    workers = []
+    try:
+        # スレッドを作る前に fork する
+        for _ in range(n_workers):
+            process = context.Process(target=_run_prefork_worker, args=(spacy_nlp, matcher, task_q, result_q, batch_size, options), daemon=True)
+            process.start()
+            workers.append(process)
+    finally:
+        if freeze:
+            gc.unfreeze()
+
+    stop_event = threading.Event()
+    feeder_errors = []
+
+    def feeder():
+        try:
+            batch = []
+            for record in records:
+                if len(record) == 3:
+                    batch.append(record)
+                else:
+                    batch.append((record[0], None, record[1]))
+                if len(batch) >= batch_size:
+                    if not _put_or_stop(task_q, batch, stop_event):
+                        return
+                    batch = []
+            if batch:
+                _put_or_stop(task_q, batch, stop_event)
+        except BaseException as exc:  # noqa: BLE001
+            feeder_errors.append(exc)
+        finally:
+            for _ in workers:
+                _put_or_stop(task_q, None, stop_event)
+
+    feeder_thread = threading.Thread(target=feeder, name="vac-feeder", daemon=True)
+    feeder_thread.start()
+
+    n_docs = 0
+    n_vacs = 0
+    n_skipped = 0
+    reports = []
+    errors = []
+    n_running = len(workers)
+    while n_running and not errors:
+        try:
+            kind, payload = result_q.get(timeout=1.0)
+        except queue.Empty:
+            # 報告せずに終了したワーカー（OOM killer などで強制終了された場合）
+            for process in workers:
+                if process.exitcode not in (None, 0):
+                    errors.append(f"process {process.pid} exited with code {process.exitcode}")
+            continue
+        if kind == "records":
+            for record in payload:
+                writer.write(record)
+                n_vacs += len(record["vacs"])
+                n_skipped += "skipped" in record
+            n_docs += len(payload)
+        else:
+            n_running -= 1
+            if kind == "done":
+                reports.append(payload)
+            else:
+                errors.append(payload)
+    if errors:
+        stop_event.set()
+        for process in workers:
+            process.terminate()
+    feeder_thread.join()
+    for process in workers:
+        process.join()
+    if feeder_errors:
+        raise feeder_errors[0]
+    if errors:
+        raise RuntimeError(f"worker failed: {errors[0]}")
+    reports.sort(key=lambda report: report["pid"])
+    n_slow = 0
+    for report in reports:
+        n_slow += report["slow_docs"]
+        for name, count in report.pop("matcher_stats").items():
+            matcher.stats[name] += count
+    return {"docs": n_docs, "vacs": n_vacs, "skipped_docs": n_skipped, "slow_docs": n_slow, "parent": parent_memory, "workers": reports}
+
+
+# シャード単位の分散抽出 ------------------------------------------------------------
+# マニフェスト（JSON）がコーパスを doc_id のハッシュの範囲で n_shards 個に分け、各シャードを1つのワーカー
+# （別のマシンでもよい。出力先は共有ファイルシステム）が処理する。各ワーカーは checkpoint_every 文書ごとに
+# 出力を fsync してからチェックポイント（書き出し済みの文書数・出力のバイト数・集計）を置き換える。
+# 異常終了後は出力をチェックポイントのバイト数まで切り詰め、書き出し済みの文書を飛ばして再開するため、出力は重複しない
+SHARD_MANIFEST_VERSION = 1
+SHARD_HASH_SPACE = 1 << 64
+SHARD_INPUT_FORMATS = ("text",) + CORPUS_INPUT_FORMATS
+
+
+def get_shard_hash(doc_id):
+    return int.from_bytes(hashlib.sha1(doc_id.encode("utf-8")).digest()[:8], "big")
+
+
+def create_shard_manifest(path, input_path, n_shards, output_dir=None, input_format="text", max_chars=CORPUS_CHUNK_CHARS):
+    # output_dir を省略するとマニフェストと同じディレクトリに shard-00000.jsonl などを置く
+    if input_format not in SHARD_INPUT_FORMATS:
+        raise ValueError(f"unknown input format: {input_format} (expected one of {', '.join(SHARD_INPUT_FORMATS)})")
+    if n_shards < 1:
+        raise ValueError("n_shards must be at least 1")
+    manifest_dir = os.path.dirname(os.path.abspath(path))
+    output_dir = os.path.abspath(output_dir) if output_dir else manifest_dir
+    shards = []
+    for shard in range(n_shards):
+        name = f"shard-{shard:05d}"
+        shards.append({
+            "shard": shard,
+            "hash_start": shard * SHARD_HASH_SPACE // n_shards,
+            "hash_end": (shard + 1) * SHARD_HASH_SPACE // n_shards,
+            "output": os.path.join(output_dir, f"{name}.jsonl"),
+            "checkpoint": os.path.join(output_dir, f"{name}.checkpoint.json"),
+        })
+    manifest = {
+        "version": SHARD_MANIFEST_VERSION,
+        "input": os.path.abspath(input_path),
+        "input_format": input_format,
+        "max_chars": max_chars,
+        "n_shards": n_shards,
+        "shards": shards,
+    }
+    os.makedirs(manifest_dir, exist_ok=True)
+    _write_json_atomic(path, manifest)
+    return manifest
+
+
+def load_shard_manifest(path):
+    with open(path, encoding="utf-8") as f:
+        manifest = json.load(f)
+    if manifest.get("version") != SHARD_MANIFEST_VERSION:
+        raise ValueError(f"{path}: unsupported shard manifest version {manifest.get('version')!r}")
+    return manifest
+
+
+def _write_json_atomic(path, obj):
+    # 書き込み途中で落ちても、古い内容か新しい内容のどちらかが残るようにする
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(obj, f, ensure_ascii=False)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def _read_checkpoint(path):
+    if not os.path.exists(path):
+        return {"docs": 0, "vacs": 0, "bytes": 0, "last_doc_id": None, "labels": {}, "done": False}
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def iter_shard_records(manifest, shard):
+    # 入力全体を読み、ハッシュがこのシャードの範囲に入る文書だけを入力の順に返す
+    spec = manifest["shards"][shard]
+    if manifest["input_format"] == "text":
+        records = read_corpus_texts(manifest["input"])
+    else:
+        records = iter_corpus_chunks(manifest["input"], manifest["input_format"], max_chars=manifest["max_chars"])
+    for record in records:
+        if spec["hash_start"] <= get_shard_hash(record[0]) < spec["hash_end"]:
+            yield record
+
+
+class ShardVACWriter:
+    # JsonlVACWriter と同じ出力に、checkpoint_every 文書ごとのチェックポイントを加えたもの
+    def __init__(self, output_path, checkpoint_path, checkpoint_every=1000):
+        self.output_path = output_path
+        self.checkpoint_path = checkpoint_path
+        self.checkpoint_every = checkpoint_every
+        self.checkpoint = _read_checkpoint(checkpoint_path)
+        self.labels = Counter(self.checkpoint["labels"])
+        dir_path = os.path.dirname(output_path)
+        if dir_path:
+            os.makedirs(dir_path, exist_ok=True)
+        # 最後のチェックポイントより後に書かれた部分（書き出し済みと記録されていない文書）は捨てる
+        with open(output_path, "ab") as f:
+            f.truncate(self.checkpoint["bytes"])
+        self._file = open(output_path, "ab")
+        self._docs = self.checkpoint["docs"]
+        self._vacs = self.checkpoint["vacs"]
+        self._last_doc_id = self.checkpoint["last_doc_id"]
+        self._pending = 0
+
+    @property
+    def committed_docs(self):
+        return self.checkpoint["docs"]
+
+    def write(self, record):
+        self._file.write((json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8"))
+        self._docs += 1
+        self._vacs += len(record["vacs"])
+        self._last_doc_id = record["doc_id"]
+        self.labels.update(vac["label"] for vac in record["vacs"])
+        self._pending += 1
+        if self._pending >= self.checkpoint_every:
+            self.commit()
+
+    def commit(self, done=False):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self.checkpoint = {
+            "docs": self._docs,
+            "vacs": self._vacs,
+            "bytes": self._file.tell(),
+            "last_doc_id": self._last_doc_id,
+            "labels": dict(self.labels),
+            "done": done,
+        }
+        _write_json_atomic(self.checkpoint_path, self.checkpoint)
+        self._pending = 0
+
+    def close(self, done=True):
+        # 例外で終わった場合（done=False）は書きかけの行があり得るため、チェックポイントは更新しない
+        if done:
+            self.commit(done=True)
+        self._file.close()
+
+
+def extract_VAC_shard(manifest_path, shard, spacy_nlp, checkpoint_every=1000, **kwargs):
+    # kwargs は extract_VAC_corpus に渡す（matcher, n_process, batch_size, by_sentence など）
+    manifest = load_shard_manifest(manifest_path)
+    spec = manifest["shards"][shard]
+    writer = ShardVACWriter(spec["output"], spec["checkpoint"], checkpoint_every=checkpoint_every)
+    if writer.checkpoint["done"]:
+        writer.close()
+        return {"shard": shard, "resumed_docs": writer.committed_docs, "docs": 0, "vacs": 0, "done": True}
+    resumed = writer.committed_docs
+    records = itertools.islice(iter_shard_records(manifest, shard), resumed, None)
+    done = False
+    try:
+        summary = extract_VAC_corpus(records, spacy_nlp, writer, **kwargs)
+        done = True
+    finally:
+        writer.close(done=done)
+    return {"shard": shard, "resumed_docs": resumed, "docs": summary["docs"], "vacs": summary["vacs"], "done": True}
+
+
+def merge_VAC_shards(manifest_path, output_path, counts_path=None, allow_partial=False):
+    # 各シャードの出力のうちチェックポイントまでの部分をシャードの順に連結し、集計を合算する
+    manifest = load_shard_manifest(manifest_path)
+    checkpoints = [_read_checkpoint(spec["checkpoint"]) for spec in manifest["shards"]]
+    unfinished = [spec["shard"] for spec, checkpoint in zip(manifest["shards"], checkpoints) if not checkpoint["done"]]
+    if unfinished and not allow_partial:
+        raise RuntimeError(f"shards not finished: {', '.join(map(str, unfinished))}")
+    dir_path = os.path.dirname(output_path)
+    if dir_path:
+        os.makedirs(dir_path, exist_ok=True)
+    labels = Counter()
+    n_docs = 0
+    n_vacs = 0
+    with open(output_path, "wb") as out:
+        for spec, checkpoint in zip(manifest["shards"], checkpoints):
+            if checkpoint["bytes"]:
+                with open(spec["output"], "rb") as f:
+                    remaining = checkpoint["bytes"]
+                    while remaining:
+                        data = f.read(min(remaining, CORPUS_READ_BYTES))
+                        if not data:
+                            raise RuntimeError(f"{spec['output']} is shorter than its checkpoint")
+                        out.write(data)
+                        remaining -= len(data)
+            n_docs += checkpoint["docs"]
+            n_vacs += checkpoint["vacs"]
+            labels.update(checkpoint["labels"])
+    counts = {"docs": n_docs, "vacs": n_vacs, "shards": manifest["n_shards"], "unfinished": unfinished, "labels": dict(labels.most_common())}
+    if counts_path is not None:
+        _write_json_atomic(counts_path, counts)
+    return counts
+
+
+# 解析済みの入力 ------------------------------------------------------------
+# CoNLL-U や外部の解析結果の配列から、spaCy で解析せずに Doc を作る。
+# パターンは spaCy の英語モデルの規約（PTB のタグと ClearNLP の依存関係ラベル）で書かれているため、UD の解析はその規約に変換する
+UD_TO_CLEARNLP_DEPS = {
+    "root": "ROOT",
+    "obj": "dobj",
+    "iobj": "dative",
+    "nsubj:pass": "nsubjpass",
+    "csubj:pass": "csubjpass",
+    "aux:pass": "auxpass",
+    "obl:agent": "agent",
+    "obl:tmod": "npadvmod",
+    "obl:npmod": "npadvmod",
+    "obl": "npadvmod",
+    "nmod:tmod": "npadvmod",
+    "nmod:npmod": "npadvmod",
+    "nmod:poss": "poss",
+    "compound:prt": "prt",
+    "det:predet": "predet",
+    "acl:relcl": "relcl",
+    "cc:preconj": "preconj",
+    "discourse": "intj",
+    "vocative": "npadvmod",
+    "flat": "compound",
+    "fixed": "prep",
+    "list": "dep",
+    "goeswith": "dep",
+    "orphan": "dep",
+    "reparandum": "dep",
+    "dislocated": "dep",
+}
+# コピュラを主要部にするときに述語からコピュラへ付け替える（節に係る）関係
+UD_COPULA_CLAUSE_DEPS = {"nsubj", "nsubj:pass", "csubj", "csubj:pass", "expl", "aux", "aux:pass", "mark", "punct", "cc", "discourse", "parataxis", "advcl", "vocative"}
+UD_NEGATION_LEMMAS = {"not", "n't", "never"}
+UD_PREPOSITION_LEMMAS = set(target_prep_simple) | set(target_prep_complex) | {"by", "onto", "out", "without", "before", "since", "despite"}
+PTB_MODAL_LEMMAS = {"can", "could", "may", "might", "must", "shall", "should", "will", "would", "ought"}
+
+
+def _ud_feats(feats):
+    if not feats or feats == "_":
+        return {}
+    return dict(feature.split("=", 1) for feature in feats.split("|") if "=" in feature)
+
+
+def ud_to_ptb_tag(upos, feats, lemma, word):
+    # XPOS がない（または PTB でない）場合に UPOS と FEATS から PTB のタグを推定する
+    f = _ud_feats(feats)
+    lemma = lemma.lower()
+    if upos in ("VERB", "AUX"):
+        if upos == "AUX" and (f.get("VerbType") == "Mod" or lemma in PTB_MODAL_LEMMAS):
+            return "MD"
+        verb_form = f.get("VerbForm")
+        if verb_form == "Inf":
+            return "VB"
+        if verb_form == "Ger":
+            return "VBG"
+        if verb_form == "Part":
+            return "VBG" if f.get("Tense") == "Pres" else "VBN"
+        if f.get("Tense") == "Past":
+            return "VBD"
+        if f.get("Person") == "3" and f.get("Number") == "Sing":
+            return "VBZ"
+        return "VBP" if verb_form == "Fin" else "VB"
+    if upos == "NOUN":
+        return "NNS" if f.get("Number") == "Plur" else "NN"
+    if upos == "PROPN":
+        return "NNPS" if f.get("Number") == "Plur" else "NNP"
+    if upos in ("ADJ", "ADV"):
+        base = "JJ" if upos == "ADJ" else ("WRB" if f.get("PronType") in ("Int", "Rel") else "RB")
+        if base == "WRB":
+            return base
+        return base + {"Cmp": "R", "Sup": "S"}.get(f.get("Degree"), "")
+    if upos == "PRON":
+        if f.get("PronType") in ("Int", "Rel"):
+            return "WP$" if f.get("Poss") == "Yes" else "WP"
+        return "PRP$" if f.get("Poss") == "Yes" else "PRP"
+    if upos == "DET":
+        return "WDT" if f.get("PronType") in ("Int", "Rel") else "DT"
+    if upos == "PART":
+        if lemma == "to":
+            return "TO"
+        if lemma in UD_NEGATION_LEMMAS:
+            return "RB"
+        return "POS" if lemma in ("'s", "'") else "RP"
+    if upos == "PUNCT":
+        return word if word in (",", ".", ":", "``", "''") else "."
+    return {"ADP": "IN", "SCONJ": "IN", "CCONJ": "CC", "NUM": "CD", "SYM": "SYM", "INTJ": "UH", "X": "FW"}.get(upos, "XX")
+
+
+def convert_ud_to_clearnlp(lemmas, upos, tags, heads, deprels):
+    # heads: 0 始まりの絶対位置（根は -1）。ClearNLP 規約の (heads, deps) を返す（根は自分自身を指す）
+    # 変換するのはパターンとフィルタが区別する構造に限る:
+    # コピュラを主要部にする / 前置詞（case）を名詞の親にする（prep + pobj）/ 前置詞 + 動名詞（prep + pcomp）/
+    # 不定詞の to（mark -> aux）/ 形式主語の it（expl -> nsubj）/ 否定（neg）/ ラベル名の対応（UD_TO_CLEARNLP_DEPS）
+    n_tokens = len(heads)
+    heads = list(heads)
+    rels = [rel.lower() for rel in deprels]
+    lemmas = [lemma.lower() for lemma in lemmas]
+
+    for cop in range(n_tokens):
+        pred = heads[cop]
+        if rels[cop] != "cop" or pred < 0 or upos[pred] in ("VERB", "AUX"):
+            continue
+        children = [k for k in range(n_tokens) if heads[k] == pred and k != cop]
+        has_expl = any(rels[k] == "expl" for k in children)
+        has_case = any(rels[k] == "case" for k in children)
+        heads[cop], rels[cop] = heads[pred], rels[pred]
+        for k in children:
+            rel = rels[k]
+            if (
+                rel in UD_COPULA_CLAUSE_DEPS
+                or (rel.startswith("obl") and upos[pred] != "ADJ")
+                or (rel == "advmod" and lemmas[k] in UD_NEGATION_LEMMAS)
+            ):
+                heads[k] = cop
+                if rel.startswith("csubj") and has_expl:
+                    rels[k] = "xcomp"
+        heads[pred] = cop
+        rels[pred] = "obl" if has_case else ("acomp" if upos[pred] == "ADJ" else "attr")
+
+    for noun in range(n_tokens):
+        rel = rels[noun]
+        if not (rel.startswith("obl") or rel.startswith("nmod")) or rel == "nmod:poss":
+            continue
+        cases = [k for k in range(n_tokens) if heads[k] == noun and rels[k] == "case"]
+        if not cases:
+            continue
+        # "out of the house" のように case が複数ある場合は左から prep をつなぐ
+        head = heads[noun]
+        for k in cases:
+            heads[k], rels[k] = head, ("agent" if rel == "obl:agent" and head == heads[noun] else "prep")
+            head = k
+        heads[noun], rels[noun] = head, "pobj"
+
+    for verb in range(n_tokens):
+        if rels[verb] not in ("advcl", "acl", "xcomp", "ccomp") or tags[verb] != "VBG":
+            continue
+        marks = [k for k in range(n_tokens) if heads[k] == verb and rels[k] == "mark" and (upos[k] == "ADP" or lemmas[k] in UD_PREPOSITION_LEMMAS)]
+        if marks:
+            prep = marks[0]
+            heads[prep], rels[prep] = heads[verb], "prep"
+            heads[verb], rels[verb] = prep, "pcomp"
+
+    deps = []
+    for k, rel in enumerate(rels):
+        if heads[k] < 0:
+            heads[k] = k
+            deps.append("ROOT")
+        elif rel == "mark" and (tags[k] == "TO" or (lemmas[k] == "to" and upos[k] == "PART")):
+            deps.append("aux")
+        elif rel == "expl":
+            deps.append("nsubj" if lemmas[k] == "it" else "expl")
+        elif rel == "advmod" and lemmas[k] in UD_NEGATION_LEMMAS:
+            deps.append("neg")
+        else:
+            deps.append(UD_TO_CLEARNLP_DEPS.get(rel, UD_TO_CLEARNLP_DEPS.get(rel.split(":")[0], rel.split(":")[0])))
+    return heads, deps
+
+
+def doc_from_parse(vocab, words, tags, heads, deps, lemmas, morphs=None, pos=None, spaces=None, scheme="clearnlp"):
+    # 外部の解析結果の配列から Doc.from_array で Doc を作る。heads は 0 始まりの絶対位置（根は自分自身か -1）
+    # scheme="ud" の場合は deps を UD のラベルとして ClearNLP 規約に変換し、PTB でないタグは UPOS と形態素素性から推定する
+    n_tokens = len(words)
+    morphs = list(morphs) if morphs is not None else [""] * n_tokens
+    pos = list(pos) if pos is not None else [""] * n_tokens
+    tags = list(tags)
+    heads = [-1 if head is None or head < 0 or head == k else head for k, head in enumerate(heads)]
+    if scheme == "ud":
+        ptb_tags = set(PTB_TAGS)
+        tags = [tag if tag in ptb_tags else ud_to_ptb_tag(upos, feats, lemma, word) for tag, upos, feats, lemma, word in zip(tags, pos, morphs, lemmas, words)]
+        heads, deps = convert_ud_to_clearnlp(lemmas, pos, tags, heads, deps)
+    elif scheme == "clearnlp":
+        heads = [k if head < 0 else head for k, head in enumerate(heads)]
+        deps = ["ROOT" if head == k else dep for k, (head, dep) in enumerate(zip(heads, deps))]
+    else:
+        raise ValueError(f"Unknown dependency scheme {scheme!r}; expected 'clearnlp' or 'ud'.")
+
+    doc = Doc(vocab, words=list(words), spaces=list(spaces) if spaces is not None else None)
+    strings = vocab.strings
+    array = np.zeros((n_tokens, len(SENTENCE_DOC_ATTRS)), dtype="uint64")
+    for k in range(n_tokens):
+        feats = morphs[k] if morphs[k] and morphs[k] != "_" else ""
+        array[k] = (
+            strings.add(tags[k]),
+            POS_IDS.get(pos[k], 0),
+            vocab.morphology.add(feats) if feats else 0,
+            strings.add(lemmas[k]),
+            strings.add(deps[k]),
+            np.array(heads[k] - k, dtype="int64").view("uint64"),
+        )
+    doc.from_array(SENTENCE_DOC_ATTRS, array)
+    return doc
+
+
+def read_conllu(path, vocab, scheme="ud", group_docs=False):
+    # CoNLL-U ファイルから (doc_id, Doc) を返す。1文1文書（group_docs=True なら "# newdoc" ごとにまとめる）
+    # 複合語の行（1-2）と空ノード（1.1）は読み飛ばす。XPOS がなければ UPOS と FEATS から PTB のタグを推定する
+    base = os.path.basename(path)
+
+    def sentence_doc(rows):
+        words = [row[1] for row in rows]
+        lemmas = [row[2] if row[2] != "_" else row[1] for row in rows]
+        pos = [row[3] for row in rows]
+        tags = [row[4] for row in rows]
+        morphs = [row[5] for row in rows]
+        heads = [int(row[6]) - 1 if row[6] not in ("_", "0") else -1 for row in rows]
+        deps = [row[7] for row in rows]
+        spaces = ["SpaceAfter=No" not in row[9].split("|") for row in rows]
+        return doc_from_parse(vocab, words, tags, heads, deps, lemmas, morphs=morphs, pos=pos, spaces=spaces, scheme=scheme)
+
+    pending = []
+    pending_id = None
+
+    def flush():
+        docs = [doc for _, doc in pending]
+        doc_id = pending_id or pending[0][0]
+        pending.clear()
+        return doc_id, Doc.from_docs(docs) if len(docs) > 1 else docs[0]
+
+    with open(path, encoding="utf-8") as f:
+        rows = []
+        sent_id = None
+        sent_no = 0
+        for line in itertools.chain(f, [""]):
+            line = line.rstrip("\n")
+            if line.startswith("#"):
+                key, _, value = line[1:].partition("=")
+                key = key.strip()
+                if key == "sent_id":
+                    sent_id = value.strip()
+                elif key.startswith("newdoc") and group_docs:
+                    if pending:
+                        yield flush()
+                    pending_id = value.strip() or None
+                continue
+            if line.strip():
+                columns = line.split("\t")
+                if "-" in columns[0] or "." in columns[0]:
+                    continue
+                rows.append(columns)
+                continue
+            if not rows:
+                continue
+            sent_no += 1
+            item = (sent_id or f"{base}:{sent_no}", sentence_doc(rows))
+            rows = []
+            sent_id = None
+            if group_docs:
+                pending.append(item)
+            else:
+                yield item
+        if pending:
+            yield flush()
+
+
+# ルールを変更したラベルだけの再抽出 ------------------------------------------------------------
+INCREMENTAL_STATE_VERSION = 1
+
+
+def _stable_repr(value):
+    # set の順序や実行時の状態に左右されない表現
+    if isinstance(value, (set, frozenset)):
+        return sorted(_stable_repr(v) for v in value)
+    if isinstance(value, dict):
+        return sorted((_stable_repr(k), _stable_repr(v)) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return [_stable_repr(v) for v in value]
+    if callable(value):
+        # 関数やクラスの repr にはメモリ上のアドレスが入るため、名前で表す（ソースは参照先として別に集める）
+        return getattr(value, "__qualname__", type(value).__qualname__)
+    return repr(value)
+
+
+def _iter_code_names(code):
+    yield from code.co_names
+    for const in code.co_consts:
+        if inspect.iscode(const):
+            yield from _iter_code_names(const)
+
+
+def _iter_module_functions(value, module):
+    # 表（dict・list など）に入っている、同じモジュールの関数・クラス
+    if isinstance(value, dict):
+        for v in value.values():
+            yield from _iter_module_functions(v, module)
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        for v in value:
+            yield from _iter_module_functions(v, module)
+    elif (inspect.isfunction(value) or inspect.isclass(value)) and value.__module__ == module:
+        yield value
+
+
+def get_source_closure(roots):
+    # 関数・クラスのソースと、そこから参照されるモジュール内の関数・クラス・定数を再帰的に集める
+    # （"_" で始まる非関数のグローバルは実行時キャッシュなので含めない）
+    sources = {}
+    stack = list(roots)
+    while stack:
+        obj = stack.pop()
+        name = obj.__qualname__
+        if name in sources:
+            continue
+        sources[name] = inspect.getsource(obj)
+        if inspect.isclass(obj):
+            functions = [v for v in vars(obj).values() if inspect.isfunction(v)]
+        else:
+            functions = [obj]
+        for function in functions:
+            module_globals = function.__globals__
+            for ref in _iter_code_names(function.__code__):
+                if ref not in module_globals:
+                    continue
+                value = module_globals[ref]
+                if inspect.isfunction(value) or inspect.isclass(value):
+                    if value.__module__ == obj.__module__:
+                        stack.append(value)
+                elif not inspect.ismodule(value) and not ref.startswith("_"):
+                    sources[ref] = _stable_repr(value)
+                    stack.extend(_iter_module_functions(value, obj.__module__))
+    return sources
+
+
+def get_label_fingerprints(compiled_patterns):
+    fingerprints = {}
+    for label, patterns in compiled_patterns.items():
+        roots = [filter_dispatch_dict[label]]
+        if label in label_expander_dict:
+            roots.append(label_expander_dict[label])
+        payload = {
+            "version": INCREMENTAL_STATE_VERSION,
+            "patterns": patterns,
+            "source": get_source_closure(roots),
+        }
+        data = json.dumps(payload, sort_keys=True, ensure_ascii=False).encode("utf-8")
+        fingerprints[label] = hashlib.sha256(data).hexdigest()
+    return fingerprints
+
+
+def resolve_VAC_labels(entries, priority_dict):
+    # entries: (マッチ順, 動詞のidx, ラベル) のリスト
+    # extract_VAC と同じく、優先度の高いラベル（同順位ならマッチ順で先のもの）を選び、
+    # 動詞の順は最初にフィルタを通過したマッチの順とする
+    best = {}
+    first = {}
+    for order, anchor_idx, label in sorted(entries):
+        if anchor_idx not in first:
+            first[anchor_idx] = order
+            best[anchor_idx] = label
+        elif priority_dict.get(label, float('-inf')) > priority_dict.get(best[anchor_idx], float('-inf')):
+            best[anchor_idx] = label
+    return sorted(((first[idx], idx, label) for idx, label in best.items()))
+
+
+class IncrementalVACStore:
+    # state.json: 指紋・優先度表・文書ハッシュ、labels/*.pkl: ラベルごとのフィルタ通過結果、docs.pkl: 動詞の情報と確定ラベル
+    # docs.pkl と読み込んだラベルの結果は丸ごとメモリに置く（コーパス中のマッチした動詞の数に比例する）
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.join(path, "labels"), exist_ok=True)
+        self.label_fingerprints = {}
+        self.label_order = []
+        self.priority = {}
+        self.doc_hashes = {}
+        self.label_results = {}
+        self.docs = {}
+        self._dirty_labels = set()
+        state_path = os.path.join(path, "state.json")
+        if not os.path.exists(state_path):
+            return
+        with open(state_path, encoding="utf-8") as f:
+            state = json.load(f)
+        if state.get("version") != INCREMENTAL_STATE_VERSION:
+            return
+        self.label_fingerprints = state["label_fingerprints"]
+        self.label_order = state["label_order"]
+        self.priority = state["priority"]
+        self.doc_hashes = state["doc_hashes"]
+        with open(os.path.join(path, "docs.pkl"), "rb") as f:
+            self.docs = pickle.load(f)
+
+    def _label_path(self, label):
+        name = hashlib.sha1(label.encode("utf-8")).hexdigest()
+        return os.path.join(self.path, "labels", f"{name}.pkl")
+
+    def get_label_results(self, label):
+        if label not in self.label_results:
+            label_path = self._label_path(label)
+            if os.path.exists(label_path) and label in self.label_fingerprints:
+                with open(label_path, "rb") as f:
+                    self.label_results[label] = pickle.load(f)
+            else:
+                self.label_results[label] = {}
+        return self.label_results[label]
+
+    def set_label_entries(self, label, doc_id, entries):
+        results = self.get_label_results(label)
+        if entries:
+            results[doc_id] = entries
+        else:
+            results.pop(doc_id, None)
+        self._dirty_labels.add(label)
+
+    def remove_doc(self, doc_id):
+        for label in self.label_order:
+            if doc_id in self.get_label_results(label):
+                self.set_label_entries(label, doc_id, [])
+        self.docs.pop(doc_id, None)
+        self.doc_hashes.pop(doc_id, None)
+
+    def save(self):
+        for label in self._dirty_labels:
+            tmp_path = self._label_path(label) + ".tmp"
+            with open(tmp_path, "wb") as f:
+                pickle.dump(self.label_results[label], f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self._label_path(label))
+        self._dirty_labels = set()
+        tmp_path = os.path.join(self.path, "docs.pkl.tmp")
+        with open(tmp_path, "wb") as f:
+            pickle.dump(self.docs, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, os.path.join(self.path, "docs.pkl"))
+        # state.json は最後に書き、途中で失敗した場合は次回すべて再計算されるようにする
+        state = {
+            "version": INCREMENTAL_STATE_VERSION,
+            "label_fingerprints": self.label_fingerprints,
+            "label_order": self.label_order,
+            "priority": self.priority,
+            "doc_hashes": self.doc_hashes,
+        }
+        tmp_path = os.path.join(self.path, "state.json.tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(state, f, ensure_ascii=False)
+        os.replace(tmp_path, os.path.join(self.path, "state.json"))
+
+
+def _match_VAC_labels(doc, matcher, spacy_nlp, label_rank):
+    # ラベルごとのフィルタ通過結果 {label: [((ラベル順, ラベル内のマッチ順), 動詞のidx, 展開後のラベル), ...]}
+    entries = defaultdict(list)
+    counters = defaultdict(int)
+    matches = matcher(doc)
+    with doc_features_scope(doc):
+        for match_id, token_ids in matches:
+            match_label = spacy_nlp.vocab.strings[match_id]
+            order = (label_rank[match_label], counters[match_label])
+            counters[match_label] += 1
+            if apply_filter(match_label, token_ids, doc):
+                entries[match_label].append((order, token_ids[0], get_VAC_label(match_label, token_ids, doc)))
+    return entries
+
+
+def extract_VAC_incremental(records, spacy_nlp, state_path, writer=None, parse_cache=None, n_process=1, batch_size=64):
+    # 前回の実行から指紋が変わったラベルと、本文が変わった文書だけを再マッチ・再フィルタする
+    store = IncrementalVACStore(state_path)
+    compiled_patterns = push_down_filter_constraints(compile_tag_regex(create_vac_patterns(), get_tag_inventory(spacy_nlp)))
+    label_order = list(compiled_patterns)
+    label_rank = {label: rank for rank, label in enumerate(label_order)}
+    fingerprints = get_label_fingerprints(compiled_patterns)
+    changed_labels = [label for label in label_order if store.label_fingerprints.get(label) != fingerprints[label]]
+    # 優先度表やラベル順が変わった場合はフィルタは再実行せず、全動詞のラベルを決め直す
+    resolve_all = store.priority != pattern_priority_dict or store.label_order != label_order
+    for label in store.label_order:
+        if label not in label_rank:
+            store.label_fingerprints.pop(label, None)
+    store.label_order = label_order
+    parser_fingerprint = get_parser_fingerprint(spacy_nlp)
+
+    matchers = {}
+
+    def get_matcher(labels):
+        key = tuple(labels)
+        if key not in matchers:
+            matchers[key] = _build_matcher_from_patterns(spacy_nlp, {label: compiled_patterns[label] for label in labels})
+        return matchers[key]
+
+    doc_ids = []
+    seen_doc_ids = set()
+    # 再解析した文書の影響を受けた動詞と、差分に出す動詞ごとの文（Doc は保持しない）
+    touched = {}
+
+    def iter_work():
+        for doc_id, text in records:
+            if doc_id in seen_doc_ids:
+                raise ValueError(f"Duplicate doc_id: {doc_id!r}")
+            seen_doc_ids.add(doc_id)
+            doc_ids.append(doc_id)
+            text_hash = hashlib.sha256((parser_fingerprint + "\0" + text).encode("utf-8")).hexdigest()
+            if store.doc_hashes.get(doc_id) != text_hash:
+                labels = label_order
+            else:
+                labels = changed_labels
+            if labels:
+                yield text, (doc_id, text_hash, labels)
+
+    # キャッシュがないとラベルが1つ変わっただけで全文書を解析し直すため、指定がなければ state_path の下に作る
+    if parse_cache is None:
+        parse_cache = ParseCache(os.path.join(state_path, "parses"), spacy_nlp)
+    parsed = iter_parsed_with_cache(iter_work(), spacy_nlp, parse_cache, n_process=n_process, batch_size=batch_size)
+
+    for doc, (doc_id, text_hash, labels) in parsed:
+        entries = _match_VAC_labels(doc, get_matcher(labels), spacy_nlp, label_rank)
+        doc_state = store.docs.setdefault(doc_id, {"tokens": {}, "resolved": {}})
+        anchors = set()
+        for label in labels:
+            old_entries = store.get_label_results(label).get(doc_id, [])
+            anchors.update(anchor_idx for _, anchor_idx, _ in old_entries)
+            anchors.update(anchor_idx for _, anchor_idx, _ in entries[label])
+            store.set_label_entries(label, doc_id, entries[label])
+        sentences = {}
+        for anchor_idx in anchors:
+            if anchor_idx < len(doc):
+                token = doc[anchor_idx]
+                doc_state["tokens"][anchor_idx] = (token.text, token.lemma_)
+                if doc.has_annotation("SENT_START"):
+                    sentences[anchor_idx] = token.sent.text
+        touched[doc_id] = (anchors, sentences)
+        store.doc_hashes[doc_id] = text_hash
+    parse_cache.flush()
+
+    for doc_id in [doc_id for doc_id in store.doc_hashes if doc_id not in seen_doc_ids]:
+        store.remove_doc(doc_id)
+
+    # 影響を受けた動詞についてだけ優先度による選択をやり直し、前回との差分を取る
+    diff = []
+    for doc_id in doc_ids:
+        if not resolve_all and doc_id not in touched:
+            continue
+        anchors, sentences = touched.get(doc_id, (None, {}))
+        doc_state = store.docs.setdefault(doc_id, {"tokens": {}, "resolved": {}})
+        all_entries = []
+        for label in label_order:
+            # 保存済みのマッチ順は前回のラベル順なので、現在のラベル順に付け替える
+            all_entries.extend(((label_rank[label], order[1]), anchor_idx, vac_label) for order, anchor_idx, vac_label in store.get_label_results(label).get(doc_id, []))
+        if anchors is not None and not resolve_all:
+            all_entries = [entry for entry in all_entries if entry[1] in anchors]
+        else:
+            anchors = set(doc_state["resolved"]) | {entry[1] for entry in all_entries}
+        resolved = {anchor_idx: (label, order) for order, anchor_idx, label in resolve_VAC_labels(all_entries, pattern_priority_dict)}
+        for anchor_idx in sorted(anchors):
+            old = doc_state["resolved"].pop(anchor_idx, (None, None))[0]
+            new = resolved.get(anchor_idx, (None, None))[0]
+            verb = doc_state["tokens"].get(anchor_idx, (None, None))[0]
+            if anchor_idx in resolved:
+                doc_state["resolved"][anchor_idx] = resolved[anchor_idx]
+            else:
+                doc_state["tokens"].pop(anchor_idx, None)
+            if old != new:
+                change = {"doc_id": doc_id, "i": anchor_idx, "verb": verb, "old": old, "new": new}
+                if anchor_idx in sentences:
+                    change["sentence"] = sentences[anchor_idx]
+                diff.append(change)
+
+    store.label_fingerprints = fingerprints
+    store.priority = dict(pattern_priority_dict)
+    store.save()
+
+    n_vacs = 0
+    if writer is not None:
+        for doc_id in doc_ids:
+            doc_state = store.docs.get(doc_id, {"tokens": {}, "resolved": {}})
+            vacs = []
+            for anchor_idx, (label, _) in sorted(doc_state["resolved"].items(), key=lambda x: x[1][1]):
+                verb, lemma = doc_state["tokens"][anchor_idx]
+                vacs.append({"i": anchor_idx, "verb": verb, "lemma": lemma, "label": label})
+            writer.write({"doc_id": doc_id, "vacs": vacs})
+            n_vacs += len(vacs)
+
+    return {"docs": len(doc_ids), "reparsed": len(touched), "changed_labels": changed_labels, "vacs": n_vacs, "diff": diff}
+
+
+# コマンドライン ------------------------------------------------------------
+def build_arg_parser():
+    parser = argparse.ArgumentParser(description="Rule-based VAC extraction with spaCy's DependencyMatcher.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    extract_parser = subparsers.add_parser("extract", help="Extract VACs from a corpus and write JSONL.")
+    extract_parser.add_argument("input", help="Text file (one document per line), directory of .txt files, or CoNLL-U file (--input-format conllu).")
+    extract_parser.add_argument("output", help="Output JSONL path (or Parquet path with --output-format parquet).")
+    extract_parser.add_argument("--output-format", choices=("jsonl", "parquet", "sqlite"), default="jsonl", help="parquet: one row per VAC with sentence id, character offsets, dictionary-encoded label and matched token indices (requires pyarrow). sqlite: a single-file store indexed on (label, lemma) and document id (see the query command).")
+    extract_parser.add_argument("--row-group-size", type=int, default=PARQUET_ROW_GROUP_SIZE, help="Rows per Parquet row group.")
+    extract_parser.add_argument("--model", default=None, help="spaCy pipeline with tagger and parser (default: en_core_web_trf; a blank English pipeline for CoNLL-U input).")
+    extract_parser.add_argument("--input-format", choices=("text", "conllu") + CORPUS_INPUT_FORMATS, default="text", help="conllu: read tagged and parsed sentences instead of parsing with spaCy. lines/jsonl/chunks: stream a plain (memory-mapped) or .gz/.bz2/.xz/.zst file and add character offsets into it to the output.")
+    extract_parser.add_argument("--max-chars", type=int, default=CORPUS_CHUNK_CHARS, help="Largest chunk for --input-format chunks (split at paragraph, then sentence boundaries).")
+    extract_parser.add_argument("--text-field", default="text", help="Text field of --input-format jsonl.")
+    extract_parser.add_argument("--id-field", default="id", help="Document id field of --input-format jsonl.")
+    extract_parser.add_argument("--conllu-scheme", choices=("ud", "clearnlp"), default="ud", help="Dependency labels of the CoNLL-U input (ud is converted to the ClearNLP labels of the patterns).")
+    extract_parser.add_argument("--group-docs", action="store_true", help="Merge the CoNLL-U sentences of each '# newdoc' into one document.")
+    extract_parser.add_argument("--n-process", type=int, default=1)
+    extract_parser.add_argument("--prefork", type=int, default=None, help="Parse and match in this many forked workers that share the pipeline and matcher loaded once in the parent; reports each worker's resident memory.")
+    extract_parser.add_argument("--batch-size", type=int, default=64)
+    extract_parser.add_argument("--queue-size", type=int, default=256)
+    extract_parser.add_argument("--engine", choices=MATCHER_ENGINES, default="spacy", help="Matcher engine (array: batched NumPy matching over Doc.to_array).")
+    extract_parser.add_argument("--prescreen", action="store_true", help="Skip labels whose required DEP/TAG/LEMMA values are absent from the document.")
+    extract_parser.add_argument("--matcher-cache", help="Validation stamp for the matcher patterns (JSON; rewritten when the patterns or pipeline change).")
+    extract_parser.add_argument("--lexicon", help="Verb frame lexicon (see build-lexicon); labels a known verb lemma never takes are not matched or filtered.")
+    extract_parser.add_argument("--by-sentence", action="store_true", help="Match and filter one sentence at a time (memory bounded by the longest sentence).")
+    extract_parser.add_argument("--max-sentence-tokens", type=int, default=None, help="Skip (or truncate, see --long-sentences) sentences longer than this.")
+    extract_parser.add_argument("--long-sentences", choices=LONG_SENTENCE_ACTIONS, default="skip")
+    extract_parser.add_argument("--max-matches", type=int, default=None, help="Skip sentences with more raw matches than this.")
+    extract_parser.add_argument("--max-doc-seconds", type=float, default=None, help="Skip the remaining sentences of a document after this many seconds.")
+    extract_parser.add_argument("--slow-log", help="Write documents that took at least --slow-seconds to this JSONL path (doc_id, tokens, matches, seconds).")
+    extract_parser.add_argument("--slow-seconds", type=float, default=1.0)
+    extract_parser.add_argument("--labels", type=_label_list, default=None, help="Comma-separated VAC labels to extract (matcher labels such as V_prep_n or expanded labels such as V_on_n).")
+    extract_parser.add_argument("--parse-cache", help="Directory of cached parses (DocBin shards); texts found there are not re-parsed.")
+    extract_parser.add_argument("--parse-cache-max-mb", type=float, default=None, help="Evict least recently used shards above this size whenever a shard is written.")
+
+    bench_engine_parser = subparsers.add_parser("benchmark-engine", help="Check that the array engine matches DependencyMatcher and compare their time.")
+    bench_engine_parser.add_argument("input", help="Reference corpus (text file or directory of .txt files).")
+    bench_engine_parser.add_argument("--model", default="en_core_web_trf")
+    bench_engine_parser.add_argument("--limit", type=int, default=1000, help="Maximum number of documents to parse.")
+    bench_engine_parser.add_argument("--repeat", type=int, default=3)
+    bench_engine_parser.add_argument("--batch-size", type=int, default=256)
+
+    pushdown_parser = subparsers.add_parser("report-pushdown", help="Count raw matches per label with and without the pushed-down filter constraints.")
+    pushdown_parser.add_argument("input", help="Reference corpus (text file or directory of .txt files).")
+    pushdown_parser.add_argument("--model", default="en_core_web_trf")
+    pushdown_parser.add_argument("--limit", type=int, default=1000, help="Maximum number of documents to parse.")
+
+    incremental_parser = subparsers.add_parser("extract-incremental", help="Re-run only the labels whose patterns or filters changed since the last run.")
+    incremental_parser.add_argument("input", help="Text file (one document per line) or directory of .txt files.")
+    incremental_parser.add_argument("output", help="Output JSONL path (full results).")
+    incremental_parser.add_argument("state", help="Directory holding per-label results of previous runs.")
+    incremental_parser.add_argument("--model", default="en_core_web_trf")
+    incremental_parser.add_argument("--n-process", type=int, default=1)
+    incremental_parser.add_argument("--batch-size", type=int, default=64)
+    incremental_parser.add_argument("--parse-cache", help="Directory of cached parses (see extract --parse-cache; default: STATE/parses).")
+    incremental_parser.add_argument("--diff", help="Write the verbs whose label changed to this JSONL path.")
+
+    warm_parser = subparsers.add_parser("warm-cache", help="Parse a corpus into the parse cache.")
+    warm_parser.add_argument("input", help="Text file (one document per line) or directory of .txt files.")
+    warm_parser.add_argument("cache", help="Parse cache directory.")
+    warm_parser.add_argument("--model", default="en_core_web_trf")
+    warm_parser.add_argument("--n-process", type=int, default=1)
+    warm_parser.add_argument("--batch-size", type=int, default=64)
+    warm_parser.add_argument("--max-mb", type=float, default=None, help="Evict least recently used shards above this size whenever a shard is written.")
+
+    lexicon_parser = subparsers.add_parser("build-lexicon", help="Count the VAC labels of each verb lemma on a reference corpus.")
+    lexicon_parser.add_argument("input", help="Reference corpus (text file or directory of .txt files).")
+    lexicon_parser.add_argument("output", help="Output lexicon path (.npz).")
+    lexicon_parser.add_argument("--model", default="en_core_web_trf")
+    lexicon_parser.add_argument("--n-process", type=int, default=1)
+    lexicon_parser.add_argument("--batch-size", type=int, default=64)
+    lexicon_parser.add_argument("--parse-cache", help="Directory of cached parses (see extract --parse-cache).")
+
+    bench_lexicon_parser = subparsers.add_parser("benchmark-lexicon", help="Compare time, precision and recall with and without a frame lexicon on gold data.")
+    bench_lexicon_parser.add_argument("gold", help="Gold DocBin (.spacy) with VAC labels as entities.")
+    bench_lexicon_parser.add_argument("lexicon", help="Frame lexicon built with build-lexicon.")
+    bench_lexicon_parser.add_argument("--model", default="en_core_web_trf")
+    bench_lexicon_parser.add_argument("--repeat", type=int, default=3)
+    bench_lexicon_parser.add_argument("--min-count", type=int, default=1, help="Occurrences needed for a label to be kept for a lemma.")
+    bench_lexicon_parser.add_argument("--min-lemma-count", type=int, default=1, help="Occurrences needed for a lemma to be pruned at all.")
+
+    plan_parser = subparsers.add_parser("plan-shards", help="Write a shard manifest that splits a corpus by document id hash.")
+    plan_parser.add_argument("input", help="Corpus file or directory (read as in extract).")
+    plan_parser.add_argument("manifest", help="Output manifest path (.json).")
+    plan_parser.add_argument("--shards", type=int, required=True)
+    plan_parser.add_argument("--output-dir", help="Directory for the shard outputs and checkpoints on the shared filesystem (default: next to the manifest).")
+    plan_parser.add_argument("--input-format", choices=SHARD_INPUT_FORMATS, default="text")
+    plan_parser.add_argument("--max-chars", type=int, default=CORPUS_CHUNK_CHARS)
+
+    shard_parser = subparsers.add_parser("extract-shard", help="Extract one shard of a manifest, resuming from its checkpoint.")
+    shard_parser.add_argument("manifest", help="Shard manifest (see plan-shards).")
+    shard_parser.add_argument("shard", type=int)
+    shard_parser.add_argument("--model", default="en_core_web_trf")
+    shard_parser.add_argument("--n-process", type=int, default=1)
+    shard_parser.add_argument("--batch-size", type=int, default=64)
+    shard_parser.add_argument("--checkpoint-every", type=int, default=1000, help="Documents between checkpoints.")
+    shard_parser.add_argument("--matcher-cache", help="Validation stamp for the matcher patterns (JSON; rewritten when the patterns or pipeline change).")
+    shard_parser.add_argument("--parse-cache", help="Directory of cached parses (DocBin shards).")
+    shard_parser.add_argument("--by-sentence", action="store_true", help="Match and filter one sentence at a time.")
+
+    merge_parser = subparsers.add_parser("merge-shards", help="Concatenate the shard outputs of a manifest and sum their label counts.")
+    merge_parser.add_argument("manifest", help="Shard manifest (see plan-shards).")
+    merge_parser.add_argument("output", help="Merged JSONL path.")
+    merge_parser.add_argument("--counts", help="Write the summed document, VAC and label counts to this JSON path.")
+    merge_parser.add_argument("--allow-partial", action="store_true", help="Merge the committed part of unfinished shards instead of failing.")
+
+    query_parser = subparsers.add_parser("query", help="Look up VACs in a SQLite store written by extract --output-format sqlite.")
+    query_parser.add_argument("store", help="SQLite store path.")
+    query_parser.add_argument("--label", help="VAC label, e.g. V_n_into_ing.")
+    query_parser.add_argument("--lemma", help="Verb lemma.")
+    query_parser.add_argument("--doc-id", help="Document id.")
+    query_parser.add_argument("--limit", type=int, default=None)
+
+    bench_tags_parser = subparsers.add_parser("benchmark-tags", help="Compare matcher time of REGEX and compiled TAG constraints.")
+    bench_tags_parser.add_argument("input", help="Reference corpus (text file or directory of .txt files).")
+    bench_tags_parser.add_argument("--model", default="en_core_web_trf")
+    bench_tags_parser.add_argument("--limit", type=int, default=1000, help="Maximum number of documents to parse.")
+    bench_tags_parser.add_argument("--repeat", type=int, default=3)
+    return parser
+
+
+def _label_list(value):
+    return [label.strip() for label in value.split(",") if label.strip()]
+
+
+def _megabytes(value):
+    if value is None:
+        return None
+    return int(value * 2**20)
+
+
+def main(argv=None):
+    parser = build_arg_parser()
+    args = parser.parse_args(argv)
+
+    if args.command == "extract":
+        preparsed = args.input_format == "conllu"
+        if args.prefork and (preparsed or args.parse_cache or args.slow_log):
+            parser.error("--prefork cannot be combined with --input-format conllu, --parse-cache or --slow-log")
+        if args.model is None and preparsed:
+            spacy_nlp = spacy.blank("en")
+        else:
+            spacy_nlp = spacy.load(args.model or "en_core_web_trf")
+        selection = VACLabelSelection(args.labels) if args.labels else None
+        lexicon = VACFrameLexicon.load(args.lexicon) if args.lexicon else None
+        budget = None
+        if args.max_sentence_tokens is not None or args.max_matches is not None or args.max_doc_seconds is not None or args.slow_log:
+            budget = VACBudget(
+                max_sentence_tokens=args.max_sentence_tokens,
+                max_matches=args.max_matches,
+                max_seconds=args.max_doc_seconds,
+                long_sentences=args.long_sentences,
+                slow_seconds=args.slow_seconds,
+            )
+        if args.matcher_cache:
+            matcher = load_dependency_matcher(spacy_nlp, args.matcher_cache, engine=args.engine, prescreen=args.prescreen, selection=selection, lexicon=lexicon)
+        else:
+            matcher = create_dependency_matcher(spacy_nlp, engine=args.engine, prescreen=args.prescreen, selection=selection, lexicon=lexicon)
+        parse_cache = None
+        if args.parse_cache:
+            parse_cache = ParseCache(args.parse_cache, spacy_nlp, max_bytes=_megabytes(args.parse_cache_max_mb))
+        if preparsed:
+            records = read_conllu(args.input, spacy_nlp.vocab, scheme=args.conllu_scheme, group_docs=args.group_docs)
+        elif args.input_format in CORPUS_INPUT_FORMATS:
+            records = iter_corpus_chunks(args.input, args.input_format, max_chars=args.max_chars, text_field=args.text_field, id_field=args.id_field)
+        else:
+            records = read_corpus_texts(args.input)
+        with_tokens = args.output_format in ("parquet", "sqlite")
+        if args.output_format == "parquet":
+            writer = ParquetVACWriter(args.output, row_group_size=args.row_group_size)
+        elif args.output_format == "sqlite":
+            writer = SqliteVACWriter(args.output)
+        else:
+            writer = JsonlVACWriter(args.output)
+        slow_log = JsonlVACWriter(args.slow_log) if args.slow_log else None
+        try:
+            if args.prefork:
+                summary = extract_VAC_prefork(
+                    records,
+                    spacy_nlp,
+                    writer,
+                    matcher=matcher,
+                    n_workers=args.prefork,
+                    batch_size=args.batch_size,
+                    selection=selection,
+                    lexicon=lexicon,
+                    by_sentence=args.by_sentence,
+                    budget=budget,
+                    with_tokens=with_tokens,
+                )
+            else:
+                summary = extract_VAC_corpus(
+                    records,
+                    spacy_nlp,
+                    writer,
+                    matcher=matcher,
+                    n_process=args.n_process,
+                    batch_size=args.batch_size,
+                    queue_size=args.queue_size,
+                    parse_cache=parse_cache,
+                    selection=selection,
+                    lexicon=lexicon,
+                    by_sentence=args.by_sentence,
+                    budget=budget,
+                    slow_log=slow_log,
+                    preparsed=preparsed,
+                    with_tokens=with_tokens,
+                )
+        finally:
+            writer.close()
+            if slow_log is not None:
+                slow_log.close()
+        print(f"Documents: {summary['docs']}, VACs: {summary['vacs']} -> {args.output}")
+        if args.prefork:
+            # PSS は共有ページをプロセス数で割った値（先に終了したワーカーの分は残りのプロセスに配分される）
+            memory = summary["parent"]
+            print("Parent before fork: " + ", ".join(f"{name[:-3]} {value:.0f} MB" for name, value in memory.items()))
+            for report in summary["workers"]:
+                memory = {name: value for name, value in report.items() if name.endswith("_mb")}
+                print(f"Worker {report['pid']} ({report['docs']} documents): " + ", ".join(f"{name[:-3]} {value:.0f} MB" for name, value in memory.items()))
+        if budget is not None:
+            print(f"Budget: {summary['skipped_docs']} documents with skipped sentences, {summary['slow_docs']} slow documents" + (f" -> {args.slow_log}" if args.slow_log else ""))
+        if selection is not None:
+            stats = matcher.stats
+            print(f"Labels: {', '.join(selection.requested)}; {len(selection.labels) - len(selection.targets)} competing labels matched on {stats['competitor_docs']} of {stats['docs']} documents")
+        if parse_cache is not None:
+            print(f"Parse cache: {parse_cache.hits} hits, {parse_cache.misses} parsed")
+        if lexicon is not None and selection is None:
+            stats = matcher.stats
+            print(f"Lexicon: {stats['labels_run'] / max(stats['docs'], 1):.1f} of {len(matcher.labels)} labels per document, {stats['fallback_docs']} documents matched with all labels")
+        elif args.prescreen and selection is None:
+            stats = matcher.stats
+            print(f"Prescreen: {stats['labels_run'] / max(stats['docs'], 1):.1f} of {len(matcher.labels)} labels per document, {stats['fallback_docs']} documents with interleaved sentences matched with all labels")
+
+    elif args.command == "benchmark-engine":
+        spacy_nlp = spacy.load(args.model)
+        texts = [text for _, text in itertools.islice(read_corpus_texts(args.input), args.limit)]
+        docs = list(spacy_nlp.pipe(texts))
+        report = benchmark_matcher_engines(docs, spacy_nlp, repeat=args.repeat, batch_size=args.batch_size)
+        print(f"Documents: {report['docs']}, Tokens: {report['tokens']}, Matches: {report['matches']} (identical)")
+        print(f"DependencyMatcher: {report['spacy_seconds']:.3f}s")
+        print(f"Array engine: {report['array_seconds']:.3f}s ({report['speedup']:.1f}x)")
+
+    elif args.command == "report-pushdown":
+        spacy_nlp = spacy.load(args.model)
+        texts = [text for _, text in itertools.islice(read_corpus_texts(args.input), args.limit)]
+        docs = list(spacy_nlp.pipe(texts))
+        report = report_pushdown_match_counts(docs, spacy_nlp)
+        print(f"Documents: {report['docs']}, VACs identical")
+        for label, counts in report["labels"].items():
+            if counts["before"]:
+                print(f"  {label}: {counts['before']} -> {counts['after']}")
+        print(f"Raw matches: {report['before']} -> {report['after']}")
+
+    elif args.command == "extract-incremental":
+        spacy_nlp = spacy.load(args.model)
+        parse_cache = None
+        if args.parse_cache:
+            parse_cache = ParseCache(args.parse_cache, spacy_nlp)
+        writer = JsonlVACWriter(args.output)
+        try:
+            summary = extract_VAC_incremental(
+                read_corpus_texts(args.input),
+                spacy_nlp,
+                args.state,
+                writer=writer,
+                parse_cache=parse_cache,
+                n_process=args.n_process,
+                batch_size=args.batch_size,
+            )
+        finally:
+            writer.close()
+        print(f"Changed labels: {', '.join(summary['changed_labels']) or '-'}")
+        print(f"Documents: {summary['docs']} (re-matched {summary['reparsed']}), VACs: {summary['vacs']} -> {args.output}")
+        print(f"Changed VAC labels: {len(summary['diff'])}")
+        if args.diff:
+            diff_writer = JsonlVACWriter(args.diff)
+            try:
+                for change in summary["diff"]:
+                    diff_writer.write(change)
+            finally:
+                diff_writer.close()
+        else:
+            for change in summary["diff"][:20]:
+                print(f"  {change['doc_id']} [{change['i']}] {change['verb']}: {change['old']} -> {change['new']}")
+
+    elif args.command == "warm-cache":
+        spacy_nlp = spacy.load(args.model)
+        parse_cache = ParseCache(args.cache, spacy_nlp, max_bytes=_megabytes(args.max_mb))
+        report = warm_parse_cache(read_corpus_texts(args.input), spacy_nlp, parse_cache, n_process=args.n_process, batch_size=args.batch_size)
+        print(f"Texts: {report['texts']}, already cached: {report['cached']}, parsed: {report['parsed']}")
+        print(f"Cache size: {parse_cache.total_bytes / 2**20:.1f} MB in {args.cache}")
+
+    elif args.command == "build-lexicon":
+        spacy_nlp = spacy.load(args.model)
+        parse_cache = ParseCache(args.parse_cache, spacy_nlp) if args.parse_cache else None
+        lexicon = build_frame_lexicon(read_corpus_texts(args.input), spacy_nlp, n_process=args.n_process, batch_size=args.batch_size, parse_cache=parse_cache)
+        lexicon.save(args.output)
+        print(f"Verb lemmas: {len(lexicon)}, labels per lemma: {sum(map(len, lexicon.label_ids.values())) / max(len(lexicon), 1):.1f} -> {args.output}")
+
+    elif args.command == "benchmark-lexicon":
+        spacy_nlp = spacy.load(args.model)
+        lexicon = VACFrameLexicon.load(args.lexicon, min_count=args.min_count, min_lemma_count=args.min_lemma_count)
+        gold_docs = list(DocBin().from_disk(args.gold).get_docs(spacy_nlp.vocab))
+        report = benchmark_frame_lexicon(gold_docs, spacy_nlp, lexicon, repeat=args.repeat)
+        print(f"Documents: {report['docs']}, lexicon lemmas: {report['lemmas']}, verbs with unseen lemmas: {report['unseen_verbs']}")
+        for name in ("full", "lexicon"):
+            run = report[name]
+            print(f"{name}: {run['seconds']:.3f}s, VACs: {run['predicted']}, P={run['precision']:.3f} R={run['recall']:.3f} F1={run['f1']:.3f}")
+        print(f"Speedup: {report['speedup']:.2f}x, changed VACs: {report['changed']}, recall change: {report['lexicon']['recall'] - report['full']['recall']:+.3f}")
+
+    elif args.command == "plan-shards":
+        manifest = create_shard_manifest(args.manifest, args.input, args.shards, output_dir=args.output_dir, input_format=args.input_format, max_chars=args.max_chars)
+        print(f"Shards: {manifest['n_shards']} -> {args.manifest}")
+
+    elif args.command == "extract-shard":
+        spacy_nlp = spacy.load(args.model)
+        if args.matcher_cache:
+            matcher = load_dependency_matcher(spacy_nlp, args.matcher_cache)
+        else:
+            matcher = create_dependency_matcher(spacy_nlp)
+        parse_cache = ParseCache(args.parse_cache, spacy_nlp) if args.parse_cache else None
+        report = extract_VAC_shard(
+            args.manifest,
+            args.shard,
+            spacy_nlp,
+            checkpoint_every=args.checkpoint_every,
+            matcher=matcher,
+            n_process=args.n_process,
+            batch_size=args.batch_size,
+            parse_cache=parse_cache,
+            by_sentence=args.by_sentence,
+        )
+        print(f"Shard {report['shard']}: resumed after {report['resumed_docs']} documents, Documents: {report['docs']}, VACs: {report['vacs']}")
+
+    elif args.command == "merge-shards":
+        counts = merge_VAC_shards(args.manifest, args.output, counts_path=args.counts, allow_partial=args.allow_partial)
+        print(f"Shards: {counts['shards']}, Documents: {counts['docs']}, VACs: {counts['vacs']} -> {args.output}")
+        if counts["unfinished"]:
+            print(f"Unfinished shards (partial output): {', '.join(map(str, counts['unfinished']))}")
+
+    elif args.command == "query":
+        for row in query_VAC_store(args.store, label=args.label, lemma=args.lemma, doc_id=args.doc_id, limit=args.limit):
+            print(json.dumps(dict(zip(("doc_id", "i", "verb", "lemma", "label", "char", "sent", "tokens"), row)), ensure_ascii=False))
+
+    elif args.command == "benchmark-tags":
+        spacy_nlp = spacy.load(args.model)
+        texts = [text for _, text in itertools.islice(read_corpus_texts(args.input), args.limit)]
+        docs = list(spacy_nlp.pipe(texts))
+        report = benchmark_tag_compilation(docs, spacy_nlp, repeat=args.repeat)
+        print(f"Documents: {report['docs']}, Tokens: {report['tokens']}, REGEX constraints: {report['regex_constraints']}")
+        print(f"REGEX matcher: {report['regex_seconds']:.3f}s")
+        print(f"Compiled matcher: {report['compiled_seconds']:.3f}s")
+        print(f"Saved: {report['saved_seconds']:.3f}s ({report['speedup']:.2f}x)")
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
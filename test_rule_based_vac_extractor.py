@@ -0,0 +1,931 @@
+import concurrent.futures
+import functools
+import importlib.util
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+import spacy
+from spacy.tokens import Doc
+
+SCRIPT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "rule-based_vac_extractor.py")
+
+
+def _load_script():
+    # The script name contains a hyphen, so it cannot be imported by name
+    spec = importlib.util.spec_from_file_location("rule_based_vac_extractor", SCRIPT_PATH)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+vac = _load_script()
+
+# (word, tag, pos, lemma, head, dep) of hand-parsed sentences with their expected VAC
+SENTENCES = {
+    "V_n_n-obj": [("She", "PRP", "PRON", "she", 1, "nsubj"), ("gave", "VBD", "VERB", "give", 1, "ROOT"), ("him", "PRP", "PRON", "he", 1, "dative"), ("a", "DT", "DET", "a", 4, "det"), ("book", "NN", "NOUN", "book", 1, "dobj"), (".", ".", "PUNCT", ".", 1, "punct")],
+    "V_that": [("He", "PRP", "PRON", "he", 1, "nsubj"), ("believes", "VBZ", "VERB", "believe", 1, "ROOT"), ("that", "IN", "SCONJ", "that", 4, "mark"), ("she", "PRP", "PRON", "she", 4, "nsubj"), ("left", "VBD", "VERB", "leave", 1, "ccomp"), (".", ".", "PUNCT", ".", 1, "punct")],
+    "V_to_n": [("They", "PRP", "PRON", "they", 1, "nsubj"), ("went", "VBD", "VERB", "go", 1, "ROOT"), ("to", "IN", "ADP", "to", 1, "prep"), ("the", "DT", "DET", "the", 4, "det"), ("park", "NN", "NOUN", "park", 2, "pobj"), (".", ".", "PUNCT", ".", 1, "punct")],
+    "V_to-inf": [("I", "PRP", "PRON", "I", 1, "nsubj"), ("want", "VBP", "VERB", "want", 1, "ROOT"), ("to", "TO", "PART", "to", 3, "aux"), ("sleep", "VB", "VERB", "sleep", 1, "xcomp"), (".", ".", "PUNCT", ".", 1, "punct")],
+    "V_n_to-inf": [("She", "PRP", "PRON", "she", 1, "nsubj"), ("told", "VBD", "VERB", "tell", 1, "ROOT"), ("him", "PRP", "PRON", "he", 4, "nsubj"), ("to", "TO", "PART", "to", 4, "aux"), ("wait", "VB", "VERB", "wait", 1, "ccomp"), (".", ".", "PUNCT", ".", 1, "punct")],
+    "V_n_on_n": [("He", "PRP", "PRON", "he", 1, "nsubj"), ("put", "VBD", "VERB", "put", 1, "ROOT"), ("the", "DT", "DET", "the", 3, "det"), ("box", "NN", "NOUN", "box", 1, "dobj"), ("on", "IN", "ADP", "on", 1, "prep"), ("the", "DT", "DET", "the", 6, "det"), ("table", "NN", "NOUN", "table", 4, "pobj"), (".", ".", "PUNCT", ".", 1, "punct")],
+    "V_adj": [("She", "PRP", "PRON", "she", 1, "nsubj"), ("seems", "VBZ", "VERB", "seem", 1, "ROOT"), ("happy", "JJ", "ADJ", "happy", 1, "acomp"), (".", ".", "PUNCT", ".", 1, "punct")],
+    None: [("We", "PRP", "PRON", "we", 1, "nsubj"), ("ate", "VBD", "VERB", "eat", 1, "ROOT"), ("the", "DT", "DET", "the", 3, "det"), ("cake", "NN", "NOUN", "cake", 1, "dobj"), (".", ".", "PUNCT", ".", 1, "punct")],
+}
+
+
+def make_doc(vocab, *sentences):
+    words, tags, pos, lemmas, heads, deps, sent_starts = [], [], [], [], [], [], []
+    for tokens in sentences:
+        offset = len(words)
+        for k, (word, tag, upos, lemma, head, dep) in enumerate(tokens):
+            words.append(word)
+            tags.append(tag)
+            pos.append(upos)
+            lemmas.append(lemma)
+            heads.append(offset + head)
+            deps.append(dep)
+            sent_starts.append(k == 0)
+    return Doc(vocab, words=words, tags=tags, pos=pos, lemmas=lemmas, heads=heads, deps=deps, sent_starts=sent_starts)
+
+
+def make_corpus(vocab):
+    # Single sentences, then multi-sentence documents with every ordering of a few sentences
+    labels = list(SENTENCES)
+    docs = [make_doc(vocab, SENTENCES[label]) for label in labels]
+    for k in range(len(labels)):
+        picked = [SENTENCES[labels[(k + j) % len(labels)]] for j in range(1 + k % 4)]
+        docs.append(make_doc(vocab, *picked))
+    docs.append(make_doc(vocab, *SENTENCES.values()))
+    return docs
+
+
+@pytest.fixture(scope="module")
+def nlp():
+    return spacy.blank("en")
+
+
+@pytest.fixture(scope="module")
+def matcher(nlp):
+    return vac.create_dependency_matcher(nlp)
+
+
+@pytest.fixture(scope="module")
+def corpus(nlp):
+    return make_corpus(nlp.vocab)
+
+
+@pytest.fixture(scope="module")
+def token_records(nlp, matcher, corpus):
+    # Output records with sentence numbers, token ids and file offsets, as extract_VAC_corpus(..., with_tokens=True) builds them
+    return [vac.build_VAC_record(f"doc{k}", doc, vac.extract_VAC(doc, matcher, nlp, with_tokens=True), offset=100 * k) for k, doc in enumerate(corpus)]
+
+
+def test_hand_parsed_sentences(nlp, matcher):
+    for label, tokens in SENTENCES.items():
+        results = vac.extract_VAC(make_doc(nlp.vocab, tokens), matcher, nlp)
+        assert [result_label for _, result_label in results] == ([label] if label else [])
+
+
+def test_compile_tag_regex_to_in_sets(nlp, corpus):
+    patterns = {"test": [[
+        {"RIGHT_ID": "verb", "RIGHT_ATTRS": {"TAG": {"REGEX": "^VB"}, "DEP": "ROOT"}},
+        {"LEFT_ID": "verb", "REL_OP": ">", "RIGHT_ID": "complement", "RIGHT_ATTRS": {"TAG": {"REGEX": "^[JN]"}}},
+    ]]}
+    compiled = vac.compile_tag_regex(patterns, vac.get_tag_inventory(nlp))
+    verb, complement = compiled["test"][0]
+    assert verb["RIGHT_ATTRS"] == {"TAG": {"IN": ["VB", "VBD", "VBG", "VBN", "VBP", "VBZ"]}, "DEP": "ROOT"}
+    assert complement["RIGHT_ATTRS"] == {"TAG": {"IN": ["JJ", "JJR", "JJS", "NFP", "NN", "NNP", "NNPS", "NNS"]}}
+    assert patterns["test"][0][0]["RIGHT_ATTRS"]["TAG"] == {"REGEX": "^VB"}
+    assert vac.count_regex_constraints(patterns) == 2 and vac.count_regex_constraints(compiled) == 0
+    # The compiled VAC patterns match exactly like the REGEX ones
+    regex_matcher = vac.create_dependency_matcher(nlp, compile_tags=False)
+    compiled_matcher = vac.create_dependency_matcher(nlp)
+    assert [compiled_matcher(doc) for doc in corpus] == [regex_matcher(doc) for doc in corpus]
+
+
+def test_lazy_resolution_matches_eager(nlp, matcher, corpus, monkeypatch):
+    # V_n_inf outranks V_that for "believes" but fails its filter, so the lazy path must fall through to V_that
+    doc = make_doc(nlp.vocab, SENTENCES["V_that"])
+    labels = [nlp.vocab.strings[match_id] for match_id, _ in matcher(doc)]
+    assert labels.index("V_n_inf") > labels.index("V_that")
+    assert vac.pattern_priority_dict["V_n_inf"] > vac.pattern_priority_dict["V_that"]
+    assert vac.extract_VAC(doc, matcher, nlp) == vac.extract_VAC(doc, matcher, nlp, lazy=False) == [(1, "V_that")]
+
+    docs = list(corpus) + [make_doc(nlp.vocab, tokens) for tokens in SELECTION_SENTENCES + OPERATOR_SENTENCES]
+    calls = []
+    apply_filter = vac.apply_filter
+    monkeypatch.setattr(vac, "apply_filter", lambda *args: calls.append(args[0]) or apply_filter(*args))
+    eager = [vac.extract_VAC(doc, matcher, nlp, lazy=False) for doc in docs]
+    n_eager = len(calls)
+    calls.clear()
+    assert [vac.extract_VAC(doc, matcher, nlp) for doc in docs] == eager
+    assert len(calls) < n_eager
+
+
+def test_doc_features_are_scoped_to_the_extraction(nlp, matcher, corpus):
+    expected = [vac.extract_VAC(doc, matcher, nlp) for doc in corpus]
+    assert all(vac.DOC_FEATURES_KEY not in doc.user_data for doc in corpus)
+    # Threads extracting different documents do not share a feature table
+    with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+        for _ in range(3):
+            assert list(executor.map(lambda doc: vac.extract_VAC(doc, matcher, nlp), corpus)) == expected
+
+    # A retokenized document gets a fresh table, and nothing of the extraction is serialized with the Doc
+    doc = make_doc(nlp.vocab, SENTENCES["V_n_on_n"])
+    assert vac.extract_VAC(doc, matcher, nlp) == [(1, "V_n_on_n")]
+    with doc.retokenize() as retokenizer:
+        retokenizer.merge(doc[2:4])
+    copy = Doc(nlp.vocab).from_bytes(doc.to_bytes())
+    assert copy.user_data == {}
+    assert vac.extract_VAC(doc, matcher, nlp) == vac.extract_VAC(copy, matcher, nlp)
+
+
+def test_label_fingerprints_are_stable_across_interpreters():
+    # The fingerprints must not contain object addresses or hash-seed dependent orderings,
+    # otherwise a saved incremental state is never reused by the next process
+    script = (
+        "import importlib.util, json, sys\n"
+        f"spec = importlib.util.spec_from_file_location('rule_based_vac_extractor', {SCRIPT_PATH!r})\n"
+        "module = importlib.util.module_from_spec(spec)\n"
+        "sys.modules[spec.name] = module\n"
+        "spec.loader.exec_module(module)\n"
+        "print(json.dumps(module.get_label_fingerprints(module.create_vac_patterns()), sort_keys=True))\n"
+    )
+    outputs = []
+    for seed in ("1", "2"):
+        env = dict(os.environ, PYTHONHASHSEED=seed)
+        completed = subprocess.run([sys.executable, "-c", script], env=env, capture_output=True, text=True, check=True)
+        outputs.append(json.loads(completed.stdout))
+    assert outputs[0] == outputs[1]
+    assert outputs[0] == vac.get_label_fingerprints(vac.create_vac_patterns())
+
+
+def test_source_closure_follows_functions_in_tables():
+    sources = vac.get_source_closure([vac.get_VAC_label])
+    assert "label_expander_dict" in sources
+    assert "get_V_prep_n_label" in sources
+    assert " at 0x" not in json.dumps(sources)
+
+
+def test_matcher_cache_round_trip(nlp, corpus, tmp_path, monkeypatch):
+    path = str(tmp_path / "matcher.json")
+    expected = [vac.extract_VAC(doc, vac.create_dependency_matcher(nlp), nlp) for doc in corpus]
+    built = vac.load_dependency_matcher(nlp, path)
+    assert [vac.extract_VAC(doc, built, nlp) for doc in corpus] == expected
+
+    # A matching stamp is registered without validation
+    validated = []
+    build = vac._build_matcher_from_patterns
+    monkeypatch.setattr(vac, "_build_matcher_from_patterns", lambda *args, validate=True, **kwargs: validated.append(validate) or build(*args, validate=validate, **kwargs))
+    loaded = vac.load_dependency_matcher(nlp, path)
+    assert validated == [False]
+    assert [vac.extract_VAC(doc, loaded, nlp) for doc in corpus] == expected
+
+    # The stamp holds only the version and the fingerprint
+    with open(path, encoding="utf-8") as f:
+        stamp = vac.json.load(f)
+    assert set(stamp) == {"version", "fingerprint"}
+
+    # A stale or unreadable stamp is revalidated and rewritten
+    vac.save_matcher_stamp(path, "stale")
+    vac.load_dependency_matcher(nlp, path)
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("not json")
+    vac.load_dependency_matcher(nlp, path)
+    assert validated == [False, True, True]
+    assert vac._read_matcher_stamp(path) == stamp
+
+
+def _doc_attrs(doc):
+    return [(t.text, t.tag_, t.lemma_, t.dep_, t.head.i, t.is_sent_start) for t in doc]
+
+
+def test_parse_cache_round_trip(nlp, corpus, tmp_path, monkeypatch):
+    texts = [doc.text for doc in corpus]
+    parsed = {doc.text: doc for doc in corpus}
+    parse_calls = []
+
+    def fake_pipe(stream, as_tuples=False, n_process=1, batch_size=64):
+        parse_calls.append(0)
+        for text, context in stream:
+            parse_calls[-1] += 1
+            yield parsed[text], context
+
+    monkeypatch.setattr(nlp, "pipe", fake_pipe)
+    cache = vac.ParseCache(str(tmp_path), nlp, shard_size=4)
+    first = list(vac.iter_parsed_with_cache(((text, k) for k, text in enumerate(texts)), nlp, cache))
+    cache.close()
+    assert [context for _, context in first] == list(range(len(texts)))
+    assert sum(parse_calls) == len(set(texts))
+
+    # A new process reads the shards back, and a warm cache is never parsed
+    del parse_calls[:]
+    cache = vac.ParseCache(str(tmp_path), nlp)
+    second = list(vac.iter_parsed_with_cache(((text, k) for k, text in enumerate(texts)), nlp, cache))
+    assert parse_calls == []
+    assert [context for _, context in second] == list(range(len(texts)))
+    assert [_doc_attrs(doc) for doc, _ in second] == [_doc_attrs(doc) for doc in corpus]
+
+
+def test_parse_cache_streams_hits(nlp, corpus, tmp_path, monkeypatch):
+    parsed = {doc.text: doc for doc in corpus}
+
+    def buffered_pipe(stream, as_tuples=False, n_process=1, batch_size=64):
+        # Like nlp.pipe, reads a whole batch before returning the first parse
+        for text, context in list(stream):
+            yield parsed[text], context
+
+    monkeypatch.setattr(nlp, "pipe", buffered_pipe)
+    cache = vac.ParseCache(str(tmp_path), nlp)
+    warm = [doc.text for doc in corpus[:6]]
+    for text in warm:
+        cache.put(cache.key(text), parsed[text])
+
+    consumed = []
+
+    def items(texts):
+        for k, text in enumerate(texts):
+            consumed.append(k)
+            yield text, k
+
+    # Hits with no parse in flight are released before the rest of the input is read
+    stream = vac.iter_parsed_with_cache(items(warm), nlp, cache)
+    assert next(stream)[1] == 0
+    assert consumed == [0]
+    assert [context for _, context in stream] == list(range(1, len(warm)))
+
+    # A run of hits behind a miss is bounded by max_pending
+    del consumed[:]
+    texts = [corpus[-1].text] + warm * 3
+    stream = vac.iter_parsed_with_cache(items(texts), nlp, cache, max_pending=4)
+    assert [next(stream)[1], next(stream)[1]] == [0, 1]
+    assert len(consumed) == 1 + 4
+    assert [context for _, context in stream] == list(range(2, len(texts)))
+
+
+def test_parser_fingerprint_follows_the_weights():
+    def tagger_pipeline():
+        nlp = spacy.blank("en")
+        nlp.add_pipe("tagger").add_label("NN")
+        nlp.initialize()
+        return nlp
+
+    retrained = tagger_pipeline()
+    fingerprint = vac.get_parser_fingerprint(retrained)
+    assert vac.get_pipeline_signature(retrained) == vac.get_pipeline_signature(tagger_pipeline())
+    # Same name, version and components, different weights
+    node = next(node for node in retrained.get_pipe("tagger").model.walk() if node.has_param("W"))
+    node.set_param("W", node.get_param("W") + 1)
+    assert vac.get_parser_fingerprint(retrained) != fingerprint
+    assert vac.get_parser_fingerprint(spacy.blank("en")) == vac.get_parser_fingerprint(spacy.blank("en"))
+
+
+def _shard_bytes(path):
+    return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path) if name.endswith(".spacy"))
+
+
+def test_parse_cache_evicts_during_a_run(nlp, corpus, tmp_path, monkeypatch):
+    _patch_pipe(monkeypatch, nlp, corpus)
+    path = str(tmp_path)
+    shard = vac.DocBin(store_user_data=False, docs=corpus[:2]).to_bytes()
+    cache = vac.ParseCache(path, nlp, max_bytes=3 * len(shard), shard_size=2)
+    texts = list(dict.fromkeys(doc.text for doc in corpus))
+    contexts = []
+    for _, context in vac.iter_parsed_with_cache(((text, k) for k, text in enumerate(texts)), nlp, cache):
+        contexts.append(context)
+        # The limit holds before close(), whenever a shard has been written
+        assert _shard_bytes(path) <= cache.max_bytes
+    assert contexts == list(range(len(texts)))
+    assert len(cache) < len(texts)
+
+    # Hits are taken out when they are queued, so a later eviction cannot lose them
+    cache = vac.ParseCache(path, nlp, max_bytes=cache.max_bytes, shard_size=2)
+    docs = [doc for doc, _ in vac.iter_parsed_with_cache(((text, k) for k, text in enumerate(texts)), nlp, cache)]
+    assert [doc.text for doc in docs] == texts
+
+
+def test_parse_cache_index_keeps_other_processes_shards(nlp, corpus, tmp_path):
+    path = str(tmp_path)
+    first = vac.ParseCache(path, nlp)
+    second = vac.ParseCache(path, nlp)
+    first.put(first.key(corpus[0].text), corpus[0])
+    first.flush()
+    second.put(second.key(corpus[1].text), corpus[1])
+    second.flush()
+    reopened = vac.ParseCache(path, nlp)
+    assert first.key(corpus[0].text) in reopened and first.key(corpus[1].text) in reopened
+
+    # A shard evicted by one process is not written back by another
+    first.max_bytes = 0
+    first.flush()
+    second.flush()
+    assert len(vac.ParseCache(path, nlp)) == 0
+    assert second.get(second.key(corpus[0].text)) is None
+
+
+class ListWriter:
+    def __init__(self):
+        self.records = []
+
+    def write(self, record):
+        self.records.append(record)
+
+
+def _patch_pipe(monkeypatch, nlp, docs):
+    parsed = {doc.text: doc for doc in docs}
+    monkeypatch.setattr(nlp, "pipe", lambda stream, **kwargs: ((parsed[text], context) for text, context in stream))
+
+
+def test_incremental_runs_match_full_extraction(nlp, matcher, corpus, tmp_path, monkeypatch):
+    _patch_pipe(monkeypatch, nlp, corpus)
+    parsed_texts = []
+    pipe = nlp.pipe
+    monkeypatch.setattr(nlp, "pipe", lambda stream, **kwargs: pipe(((parsed_texts.append(text) or text, context) for text, context in stream), **kwargs))
+    state_path = str(tmp_path / "state")
+
+    def run(docs):
+        writer = ListWriter()
+        records = [(f"doc{k}", doc.text) for k, doc in enumerate(docs)]
+        report = vac.extract_VAC_incremental(records, nlp, state_path, writer=writer)
+        assert [[(v["i"], v["label"]) for v in record["vacs"]] for record in writer.records] == [vac.extract_VAC(doc, matcher, nlp) for doc in docs]
+        return report
+
+    assert run(corpus)["reparsed"] == len(corpus)
+    report = run(corpus)
+    assert report["reparsed"] == 0
+    assert report["diff"] == []
+
+    # Changing one document re-parses only that document, and the diff carries the sentence text
+    changed = list(corpus)
+    changed[-1], changed[0] = changed[0], changed[-1]
+    report = run(changed)
+    assert report["reparsed"] == 2
+    assert report["diff"]
+    assert all(change["sentence"] in changed[int(change["doc_id"][3:])].text for change in report["diff"] if change["new"])
+
+    # A label whose fingerprint changed is re-matched in every document
+    with open(os.path.join(state_path, "state.json"), encoding="utf-8") as f:
+        state = json.load(f)
+    state["label_fingerprints"]["V_that"] = "stale"
+    with open(os.path.join(state_path, "state.json"), "w", encoding="utf-8") as f:
+        json.dump(state, f)
+    del parsed_texts[:]
+    report = run(changed)
+    assert report["changed_labels"] == ["V_that"]
+    assert report["reparsed"] == len(changed)
+    assert report["diff"] == []
+    # ... without re-parsing it: the parses are cached under the state directory by default
+    assert parsed_texts == []
+
+
+# Sentences for the ">>" (V_wh) and "." (V_out_of_n) patterns
+OPERATOR_SENTENCES = [
+    [("I", "PRP", "PRON", "I", 1, "nsubj"), ("know", "VBP", "VERB", "know", 1, "ROOT"), ("what", "WP", "PRON", "what", 4, "dobj"), ("he", "PRP", "PRON", "he", 4, "nsubj"), ("wants", "VBZ", "VERB", "want", 1, "ccomp"), (".", ".", "PUNCT", ".", 1, "punct")],
+    [("She", "PRP", "PRON", "she", 1, "nsubj"), ("ran", "VBD", "VERB", "run", 1, "ROOT"), ("out", "RP", "ADP", "out", 1, "prep"), ("of", "IN", "ADP", "of", 2, "prep"), ("time", "NN", "NOUN", "time", 3, "pobj"), (".", ".", "PUNCT", ".", 1, "punct")],
+]
+
+# Patterns with ";", "." and ">>" whose nodes also match across sentence boundaries
+OPERATOR_PATTERNS = {
+    "noun_after_det": [[
+        {"RIGHT_ID": "noun", "RIGHT_ATTRS": {"POS": "NOUN"}},
+        {"LEFT_ID": "noun", "REL_OP": ";", "RIGHT_ID": "det", "RIGHT_ATTRS": {"TAG": "DT"}},
+    ]],
+    "word_after_subject": [[
+        {"RIGHT_ID": "word", "RIGHT_ATTRS": {}},
+        {"LEFT_ID": "word", "REL_OP": ";", "RIGHT_ID": "subject", "RIGHT_ATTRS": {"DEP": "nsubj"}},
+    ]],
+    # Never matches: the final punctuation of the previous sentence is outside the word's sentence
+    "first_word_after_punct": [[
+        {"RIGHT_ID": "word", "RIGHT_ATTRS": {}},
+        {"LEFT_ID": "word", "REL_OP": ";", "RIGHT_ID": "punct", "RIGHT_ATTRS": {"DEP": "punct"}},
+    ]],
+    "verb_descendant_neighbours": [[
+        {"RIGHT_ID": "verb", "RIGHT_ATTRS": {"POS": "VERB"}},
+        {"LEFT_ID": "verb", "REL_OP": ">>", "RIGHT_ID": "below", "RIGHT_ATTRS": {"POS": {"IN": ["NOUN", "PRON"]}}},
+        {"LEFT_ID": "below", "REL_OP": ".", "RIGHT_ID": "next", "RIGHT_ATTRS": {}},
+        {"LEFT_ID": "below", "REL_OP": ";", "RIGHT_ID": "previous", "RIGHT_ATTRS": {}},
+    ]],
+}
+
+
+def test_array_engine_matches_dependency_matcher(nlp, corpus):
+    docs = list(corpus)
+    docs += [make_doc(nlp.vocab, tokens) for tokens in OPERATOR_SENTENCES]
+    docs.append(make_doc(nlp.vocab, *OPERATOR_SENTENCES, SENTENCES["V_n_on_n"], *OPERATOR_SENTENCES))
+    docs.append(make_doc(nlp.vocab))
+    reference = vac.create_dependency_matcher(nlp)
+    array = vac.create_dependency_matcher(nlp, engine="array")
+    expected = [reference(doc) for doc in docs]
+    assert array.match_docs(docs) == expected
+    assert [array(doc) for doc in docs] == expected
+    # The pushed-down patterns use ">++"
+    assert any(node.get("REL_OP") == ">++" for patterns in vac.push_down_filter_constraints(vac.create_vac_patterns()).values() for pattern in patterns for node in pattern)
+    matched = {nlp.vocab.strings[match_id] for matches in expected for match_id, _ in matches}
+    assert {"V_wh", "V_out_of_n", "V_n_prep_n", "V_that"} <= matched
+
+    reference = vac._build_matcher_from_patterns(nlp, OPERATOR_PATTERNS)
+    array = vac._build_matcher_from_patterns(nlp, OPERATOR_PATTERNS, engine="array")
+    expected = [reference(doc) for doc in docs]
+    assert array.match_docs(docs) == expected
+    assert {nlp.vocab.strings[match_id] for matches in expected for match_id, _ in matches} == set(OPERATOR_PATTERNS) - {"first_word_after_punct"}
+
+
+# Complements before the verb and a "be" verb. All but "Happy she seems" (V_adj has no word-order constraint)
+# are no longer matched by the pushed-down patterns
+PUSHDOWN_SENTENCES = [
+    [("That", "IN", "SCONJ", "that", 2, "mark"), ("she", "PRP", "PRON", "she", 2, "nsubj"), ("left", "VBD", "VERB", "leave", 5, "ccomp"), (",", ",", "PUNCT", ",", 5, "punct"), ("he", "PRP", "PRON", "he", 5, "nsubj"), ("believes", "VBZ", "VERB", "believe", 5, "ROOT"), (".", ".", "PUNCT", ".", 5, "punct")],
+    [("Happy", "JJ", "ADJ", "happy", 2, "acomp"), ("she", "PRP", "PRON", "she", 2, "nsubj"), ("seems", "VBZ", "VERB", "seem", 2, "ROOT"), (".", ".", "PUNCT", ".", 2, "punct")],
+    [("To", "IN", "ADP", "to", 4, "prep"), ("the", "DT", "DET", "the", 2, "det"), ("park", "NN", "NOUN", "park", 0, "pobj"), ("they", "PRP", "PRON", "they", 4, "nsubj"), ("went", "VBD", "VERB", "go", 4, "ROOT"), (".", ".", "PUNCT", ".", 4, "punct")],
+    [("The", "DT", "DET", "the", 1, "det"), ("truth", "NN", "NOUN", "truth", 2, "nsubj"), ("is", "VBZ", "AUX", "be", 2, "ROOT"), ("that", "IN", "SCONJ", "that", 5, "mark"), ("she", "PRP", "PRON", "she", 5, "nsubj"), ("left", "VBD", "VERB", "leave", 2, "ccomp"), (".", ".", "PUNCT", ".", 2, "punct")],
+]
+
+
+def test_pushed_down_constraints_keep_the_output(nlp, matcher, corpus):
+    docs = list(corpus) + [make_doc(nlp.vocab, tokens) for tokens in PUSHDOWN_SENTENCES]
+    docs.append(make_doc(nlp.vocab, *PUSHDOWN_SENTENCES, *SENTENCES.values()))
+    plain = vac.create_dependency_matcher(nlp, push_down=False)
+    for doc in docs:
+        assert vac.extract_VAC(doc, matcher, nlp) == vac.extract_VAC(doc, plain, nlp)
+        assert vac.extract_VAC(doc, matcher, nlp, lazy=False) == vac.extract_VAC(doc, plain, nlp, lazy=False)
+    # The complements before the verb and the "be" verb are no longer matched at all
+    for k in (0, 2, 3):
+        doc = make_doc(nlp.vocab, PUSHDOWN_SENTENCES[k])
+        assert len(matcher(doc)) < len(plain(doc))
+        assert vac.extract_VAC(doc, matcher, nlp) == []
+
+
+def test_prescreen_matches_full_matcher_per_sentence(nlp, matcher, corpus):
+    prescreen = vac.create_dependency_matcher(nlp, prescreen=True)
+    assert [prescreen(doc) for doc in corpus] == [matcher(doc) for doc in corpus]
+    assert prescreen.match_docs(corpus) == [matcher(doc) for doc in corpus]
+    # Multi-sentence documents are screened sentence by sentence, without the full matcher
+    assert prescreen.stats["fallback_docs"] == 0
+    assert prescreen.stats["labels_run"] < len(prescreen.labels) * len(corpus)
+    assert prescreen._full_matcher is None
+
+    # Trees that interleave in the token order fall back to the full matcher
+    sentences = [SENTENCES["V_that"], SENTENCES["V_adj"]]
+    doc = make_doc(nlp.vocab, *sentences)
+    words = [token.text for token in doc]
+    order = sorted(range(len(words)), key=lambda i: (i % 2, i))
+    position = {old: new for new, old in enumerate(order)}
+    interleaved = Doc(
+        nlp.vocab,
+        words=[words[i] for i in order],
+        tags=[doc[i].tag_ for i in order],
+        pos=[doc[i].pos_ for i in order],
+        lemmas=[doc[i].lemma_ for i in order],
+        heads=[position[doc[i].head.i] for i in order],
+        deps=[doc[i].dep_ for i in order],
+    )
+    assert vac.get_sentence_blocks(interleaved.to_array([vac.HEAD])) is None
+    assert prescreen(interleaved) == matcher(interleaved)
+    assert prescreen.stats["fallback_docs"] == 1
+
+
+# V_on_n (expanded from V_prep_n), and a that-clause where the competing V_n_that wins over V_that
+SELECTION_SENTENCES = [
+    [("He", "PRP", "PRON", "he", 1, "nsubj"), ("relied", "VBD", "VERB", "rely", 1, "ROOT"), ("on", "IN", "ADP", "on", 1, "prep"), ("her", "PRP", "PRON", "she", 2, "pobj"), (".", ".", "PUNCT", ".", 1, "punct")],
+    [("She", "PRP", "PRON", "she", 1, "nsubj"), ("told", "VBD", "VERB", "tell", 1, "ROOT"), ("him", "PRP", "PRON", "he", 1, "dobj"), ("that", "IN", "SCONJ", "that", 5, "mark"), ("she", "PRP", "PRON", "she", 5, "nsubj"), ("left", "VBD", "VERB", "leave", 1, "ccomp"), (".", ".", "PUNCT", ".", 1, "punct")],
+]
+
+
+def test_label_selection_matches_filtered_full_run(nlp, matcher, corpus):
+    docs = list(corpus) + [make_doc(nlp.vocab, tokens) for tokens in SELECTION_SENTENCES]
+    docs.append(make_doc(nlp.vocab, *SELECTION_SENTENCES, *SENTENCES.values()))
+    requested = {"V_on_n", "V_that"}
+    selection = vac.VACLabelSelection(sorted(requested))
+    assert selection.targets == {"V_prep_n": {"V_on_n"}, "V_that": None}
+    # Only labels that can outrank a requested label are kept as competitors
+    assert {"V_prep_n", "V_that", "V_n_that"} <= set(selection.labels)
+    assert len(selection.labels) < len(vac.create_vac_patterns())
+
+    selection_matcher = vac.create_dependency_matcher(nlp, selection=selection)
+    expected = [[(i, label) for i, label in vac.extract_VAC(doc, matcher, nlp) if label in requested] for doc in docs]
+    assert [vac.extract_VAC(doc, selection_matcher, nlp, selection=selection) for doc in docs] == expected
+    assert [vac.extract_VAC(doc, matcher, nlp, selection=selection) for doc in docs] == expected
+    assert [vac.extract_VAC(doc, selection_matcher, nlp, lazy=False, selection=selection) for doc in docs] == expected
+    batch = selection_matcher.match_docs(docs)
+    assert [vac.extract_VAC(doc, selection_matcher, nlp, matches=matches, selection=selection) for doc, matches in zip(docs, batch)] == expected
+    assert expected[len(corpus)] == [(1, "V_on_n")]
+    assert vac.extract_VAC(docs[len(corpus) + 1], matcher, nlp) == [(1, "V_n_that")] and expected[len(corpus) + 1] == []
+    assert any(label == "V_to_n" for doc in docs for _, label in vac.extract_VAC(doc, matcher, nlp))
+    assert 0 < selection_matcher.stats["competitor_docs"] < selection_matcher.stats["docs"]
+
+    with pytest.raises(ValueError):
+        vac.VACLabelSelection(["V_on_n", "V_unknown"])
+
+
+def test_frame_lexicon_round_trip_and_pruning(nlp, matcher, corpus, tmp_path):
+    # "tell" is left out of the lexicon, so the V_n_to-inf sentence has an unseen verb
+    counter = vac.FrameCountWriter()
+    for label, tokens in SENTENCES.items():
+        if label == "V_n_to-inf":
+            continue
+        doc = make_doc(nlp.vocab, tokens)
+        counter.write({"vacs": [{"lemma": doc[i].lemma_, "label": vac_label} for i, vac_label in vac.extract_VAC(doc, matcher, nlp)]})
+    lexicon = counter.lexicon()
+    path = str(tmp_path / "lexicon.npz")
+    lexicon.save(path)
+    loaded = vac.VACFrameLexicon.load(path)
+    assert loaded.lemmas == lexicon.lemmas
+    assert (loaded.counts == lexicon.counts).all()
+    assert loaded.matcher_labels == lexicon.matcher_labels
+
+    expected = [vac.extract_VAC(doc, matcher, nlp, lexicon=loaded) for doc in corpus]
+    assert any(results for results in expected)
+    for prescreen in (False, True):
+        pruned = vac.create_dependency_matcher(nlp, prescreen=prescreen, lexicon=loaded)
+        assert [vac.extract_VAC(doc, pruned, nlp, lexicon=loaded) for doc in corpus] == expected
+        assert pruned.stats["fallback_docs"] == 0
+        assert pruned._full_matcher is None
+
+    # An unseen verb widens only its own sentence
+    doc = make_doc(nlp.vocab, SENTENCES["V_n_to-inf"], SENTENCES["V_adj"])
+    pruned = vac.create_dependency_matcher(nlp, prescreen=True, lexicon=loaded)
+    alone = vac.create_dependency_matcher(nlp, prescreen=True)
+    assert set(pruned.select_labels(doc)) == set(alone.select_labels(make_doc(nlp.vocab, SENTENCES["V_n_to-inf"]))) | set(pruned.select_labels(make_doc(nlp.vocab, SENTENCES["V_adj"])))
+    assert len(pruned.select_labels(doc)) < len(pruned.labels)
+
+
+def test_array_output_matches_extract_VAC(nlp, matcher, corpus, token_records):
+    array = vac.extract_VAC_array(corpus, matcher, nlp, doc_offset=10)
+    assert array.dtype == vac.VAC_ARRAY_DTYPE
+    labels = vac.get_VAC_array_labels(array)
+    rows = [
+        (int(row["doc"]), int(row["i"]), int(row["sent"]), label, [int(t) for t in row["tokens"] if t >= 0])
+        for row, label in zip(array, labels)
+    ]
+    expected = [
+        (10 + k, v["i"], v["sent"], v["label"], v["tokens"][1:])
+        for k, record in enumerate(token_records) for v in record["vacs"]
+    ]
+    assert len(expected) > 8
+    assert rows == expected
+    assert len(vac.extract_VAC_array([], matcher, nlp)) == 0
+
+
+def test_corpus_reader_offsets(tmp_path):
+    texts = ["She gave him a book.", "", "Ils ont dîné à l'hôtel.", "He believes that she left."]
+    lines_path = tmp_path / "corpus.txt"
+    lines_path.write_text("\n".join(texts) + "\n", encoding="utf-8")
+    content = lines_path.read_text(encoding="utf-8")
+    records = list(vac.iter_corpus_chunks(str(lines_path), "lines"))
+    assert [text for _, _, text in records] == [text for text in texts if text]
+    assert all(content[offset:offset + len(text)] == text for _, offset, text in records)
+    assert [doc_id for doc_id, _, _ in records] == ["corpus.txt:1", "corpus.txt:3", "corpus.txt:4"]
+
+    # Compressed input gives the same records as the plain file
+    gz_path = tmp_path / "corpus.txt.gz"
+    with vac.gzip.open(gz_path, "wt", encoding="utf-8") as f:
+        f.write(content)
+    assert list(vac.iter_corpus_chunks(str(gz_path), "lines")) == records
+
+    # jsonl offsets point at the start of each record's line
+    jsonl_path = tmp_path / "corpus.jsonl"
+    rows = [{"id": "a", "text": "Ça \"marche\"\nbien."}, {"text": "She seems happy."}]
+    jsonl_path.write_text("".join(json.dumps(row, ensure_ascii=False) + "\n" for row in rows), encoding="utf-8")
+    content = jsonl_path.read_text(encoding="utf-8")
+    records = list(vac.iter_corpus_chunks(str(jsonl_path), "jsonl"))
+    assert [(doc_id, text) for doc_id, _, text in records] == [("a", rows[0]["text"]), ("corpus.jsonl:2", rows[1]["text"])]
+    assert [json.loads(content[offset:].split("\n", 1)[0]) for _, offset, _ in records] == rows
+
+    # Chunks cover the whole file, each at its own offset
+    chunks_path = tmp_path / "book.txt"
+    book = "".join(f"Sentence number {k} is here. " for k in range(200))
+    chunks_path.write_text(book, encoding="utf-8")
+    chunks = list(vac.iter_corpus_chunks(str(chunks_path), "chunks", max_chars=300))
+    assert all(len(text) <= 300 for _, _, text in chunks)
+    assert "".join(text for _, _, text in chunks) == book
+    assert all(book[offset:offset + len(text)] == text for _, offset, text in chunks)
+
+
+def test_budget_skips_and_reports(nlp, matcher, corpus):
+    unlimited = vac.VACBudget()
+    for doc in corpus:
+        results, report = vac.extract_VAC_with_budget(doc, matcher, nlp, unlimited)
+        assert results == vac.extract_VAC_by_sentence(doc, matcher, nlp)
+        assert sorted(results) == sorted(vac.extract_VAC(doc, matcher, nlp))
+        assert report["skipped"] == []
+        assert report["tokens"] == len(doc)
+
+    # The 8-token V_n_on_n sentence is over the limit, the V_adj sentence after it is not
+    doc = make_doc(nlp.vocab, SENTENCES["V_n_on_n"], SENTENCES["V_adj"])
+    results, report = vac.extract_VAC_with_budget(doc, matcher, nlp, vac.VACBudget(max_sentence_tokens=6))
+    assert results == [(9, "V_adj")]
+    assert report["skipped"] == [{"start": 0, "end": 8, "reason": "sentence_length"}]
+    results, report = vac.extract_VAC_with_budget(doc, matcher, nlp, vac.VACBudget(max_sentence_tokens=6, long_sentences="truncate"))
+    assert (9, "V_adj") in results
+    assert report["skipped"] == [{"start": 6, "end": 8, "reason": "sentence_length"}]
+
+    results, report = vac.extract_VAC_with_budget(doc, matcher, nlp, vac.VACBudget(max_matches=0))
+    assert results == []
+    assert [record["reason"] for record in report["skipped"]] == ["matches", "matches"]
+    results, report = vac.extract_VAC_with_budget(doc, matcher, nlp, vac.VACBudget(max_seconds=-1))
+    assert results == []
+    assert report["skipped"] == [{"start": 0, "end": 8, "reason": "time"}, {"start": 8, "end": 12, "reason": "time"}]
+
+
+def test_budget_in_corpus_records_and_component(nlp, matcher, corpus):
+    writer = ListWriter()
+    slow_log = ListWriter()
+    budget = vac.VACBudget(max_sentence_tokens=6, slow_seconds=0)
+    records = [(f"doc{k}", doc) for k, doc in enumerate(corpus)]
+    vac.extract_VAC_corpus(records, nlp, writer, matcher=matcher, budget=budget, slow_log=slow_log, preparsed=True)
+    assert [record["doc_id"] for record in writer.records] == [doc_id for doc_id, _ in records]
+    for record, doc in zip(writer.records, corpus):
+        results, report = vac.extract_VAC_with_budget(doc, matcher, nlp, budget)
+        assert [(v["i"], v["label"]) for v in record["vacs"]] == results
+        assert record.get("skipped", []) == report["skipped"]
+    assert any("skipped" in record for record in writer.records)
+    assert [entry["doc_id"] for entry in slow_log.records] == [doc_id for doc_id, _ in records]
+
+    pipeline = spacy.blank("en")
+    component = pipeline.add_pipe("vac_extractor", config={"budget": {"max_sentence_tokens": 6}})
+    doc = component(make_doc(pipeline.vocab, SENTENCES["V_n_on_n"], SENTENCES["V_adj"]))
+    assert [(span.start, span.label_) for span in doc.spans["vac"]] == [(9, "V_adj")]
+    assert [(span.start, span.end, span.label_) for span in doc.spans["vac_skipped"]] == [(0, 8, "sentence_length")]
+
+
+def test_component_serializes_settings_and_lexicon(nlp, matcher, corpus, tmp_path):
+    counter = vac.FrameCountWriter()
+    for doc in corpus:
+        counter.write({"vacs": [{"lemma": doc[i].lemma_, "label": label} for i, label in vac.extract_VAC(doc, matcher, nlp)]})
+    lexicon_path = str(tmp_path / "lexicon.npz")
+    counter.lexicon().save(lexicon_path)
+    config = {"spans_key": "frames", "lazy": False, "labels": ["V_that", "V_adj"], "lexicon": lexicon_path, "by_sentence": True, "budget": {"max_sentence_tokens": 6}}
+
+    def run(component):
+        return [vac.get_VAC_spans(component(make_doc(component.nlp.vocab, *sentences)), "frames") for sentences in (list(SENTENCES.values()), [SENTENCES["V_that"]])]
+
+    component = spacy.blank("en").add_pipe("vac_extractor", config=config)
+    expected = run(component)
+    assert all(expected)
+    data = component.to_bytes()
+    component.to_disk(tmp_path / "component")
+    # The lexicon is stored by content, not by path
+    os.remove(lexicon_path)
+
+    for load in (lambda loaded: loaded.from_bytes(data), lambda loaded: loaded.from_disk(tmp_path / "component")):
+        loaded = load(spacy.blank("en").add_pipe("vac_extractor"))
+        assert loaded._get_cfg() == component._get_cfg()
+        assert loaded.lexicon.lemmas == component.lexicon.lemmas
+        assert run(loaded) == expected
+
+    # Without a lexicon, nothing but the settings is written
+    plain = spacy.blank("en").add_pipe("vac_extractor", config={"labels": ["V_that"]})
+    plain.to_disk(tmp_path / "plain")
+    assert os.listdir(tmp_path / "plain") == ["cfg"]
+    assert spacy.blank("en").add_pipe("vac_extractor").from_bytes(plain.to_bytes()).selection.requested == ["V_that"]
+
+
+# UD sentences without XPOS, one document per "# newdoc", with the VAC each sentence should get
+UD_CONLLU = """# newdoc id = d1
+# sent_id = s1
+1	They	they	PRON	_	_	2	nsubj	_	_
+2	went	go	VERB	_	Mood=Ind|Tense=Past|VerbForm=Fin	0	root	_	_
+3	to	to	ADP	_	_	5	case	_	_
+4	the	the	DET	_	_	5	det	_	_
+5	park	park	NOUN	_	Number=Sing	2	obl	_	SpaceAfter=No
+6	.	.	PUNCT	_	_	2	punct	_	_
+
+# sent_id = s2
+1	I	I	PRON	_	_	2	nsubj	_	_
+2	want	want	VERB	_	Mood=Ind|Tense=Pres|VerbForm=Fin	0	root	_	_
+3	to	to	PART	_	_	4	mark	_	_
+4	sleep	sleep	VERB	_	VerbForm=Inf	2	xcomp	_	SpaceAfter=No
+5	.	.	PUNCT	_	_	2	punct	_	_
+
+# newdoc id = d2
+# sent_id = s3
+1	He	he	PRON	_	_	2	nsubj	_	_
+2	believes	believe	VERB	_	Mood=Ind|Number=Sing|Person=3|Tense=Pres|VerbForm=Fin	0	root	_	_
+3	that	that	SCONJ	_	_	5	mark	_	_
+4	she	she	PRON	_	_	5	nsubj	_	_
+5	left	leave	VERB	_	Mood=Ind|Tense=Past|VerbForm=Fin	2	ccomp	_	SpaceAfter=No
+6	.	.	PUNCT	_	_	2	punct	_	_
+
+# sent_id = s4
+1	She	she	PRON	_	_	2	nsubj	_	_
+2	gave	give	VERB	_	Mood=Ind|Tense=Past|VerbForm=Fin	0	root	_	_
+3	him	he	PRON	_	_	2	iobj	_	_
+4	a	a	DET	_	_	5	det	_	_
+5	book	book	NOUN	_	Number=Sing	2	obj	_	SpaceAfter=No
+6	.	.	PUNCT	_	_	2	punct	_	_
+
+# sent_id = s5
+1	It	it	PRON	_	_	4	expl	_	_
+2	is	be	AUX	_	Mood=Ind|Tense=Pres|VerbForm=Fin	4	cop	_	_
+3	not	not	PART	_	_	4	advmod	_	_
+4	easy	easy	ADJ	_	Degree=Pos	0	root	_	_
+5	to	to	PART	_	_	6	mark	_	_
+6	win	win	VERB	_	VerbForm=Inf	4	csubj	_	SpaceAfter=No
+7	.	.	PUNCT	_	_	4	punct	_	_
+
+# sent_id = s6
+1	She	she	PRON	_	_	2	nsubj	_	_
+2	talked	talk	VERB	_	Mood=Ind|Tense=Past|VerbForm=Fin	0	root	_	_
+3	about	about	ADP	_	_	4	mark	_	_
+4	swimming	swim	VERB	_	VerbForm=Ger	2	advcl	_	SpaceAfter=No
+5	.	.	PUNCT	_	_	2	punct	_	_
+"""
+UD_EXPECTED = {"s1": [(1, "V_to_n")], "s2": [(1, "V_to-inf")], "s3": [(1, "V_that")], "s4": [(1, "V_n_n-obj")], "s5": [(1, "it_V_n/adj_to-inf")], "s6": [(1, "V_about_n")]}
+
+
+def test_read_conllu_converts_ud(nlp, matcher, tmp_path):
+    path = tmp_path / "ud.conllu"
+    path.write_text(UD_CONLLU, encoding="utf-8")
+    docs = dict(vac.read_conllu(str(path), nlp.vocab))
+    assert {doc_id: vac.extract_VAC(doc, matcher, nlp) for doc_id, doc in docs.items()} == UD_EXPECTED
+    # PTB tags are derived from UPOS and FEATS, and UD relations are renamed
+    assert [(token.tag_, token.dep_) for token in docs["s1"]] == [("PRP", "nsubj"), ("VBD", "ROOT"), ("IN", "prep"), ("DT", "det"), ("NN", "pobj"), (".", "punct")]
+    assert docs["s1"].text == "They went to the park. "
+
+    grouped = list(vac.read_conllu(str(path), nlp.vocab, group_docs=True))
+    assert [doc_id for doc_id, _ in grouped] == ["d1", "d2"]
+    assert [[sent.text.strip() for sent in doc.sents] for _, doc in grouped] == [
+        [docs["s1"].text.strip(), docs["s2"].text.strip()],
+        [docs[sent_id].text.strip() for sent_id in ("s3", "s4", "s5", "s6")],
+    ]
+    assert sorted(vac.extract_VAC(grouped[0][1], matcher, nlp)) == [(1, "V_to_n"), (7, "V_to-inf")]
+
+
+def test_read_conllu_round_trips_clearnlp_parses(nlp, matcher, tmp_path):
+    lines = []
+    for k, tokens in enumerate(SENTENCES.values()):
+        lines.append(f"# sent_id = hand{k}")
+        for i, (word, tag, pos, lemma, head, dep) in enumerate(tokens):
+            lines.append("\t".join([str(i + 1), word, lemma, pos, tag, "_", "0" if head == i else str(head + 1), dep, "_", "_"]))
+        lines.append("")
+    path = tmp_path / "hand.conllu"
+    path.write_text("\n".join(lines) + "\n", encoding="utf-8")
+    docs = [doc for _, doc in vac.read_conllu(str(path), nlp.vocab, scheme="clearnlp")]
+    expected = [make_doc(nlp.vocab, tokens) for tokens in SENTENCES.values()]
+    assert [_doc_attrs(doc) for doc in docs] == [_doc_attrs(doc) for doc in expected]
+    assert [vac.extract_VAC(doc, matcher, nlp) for doc in docs] == [vac.extract_VAC(doc, matcher, nlp) for doc in expected]
+
+
+def test_parquet_writer_round_trip(token_records, tmp_path):
+    pq = pytest.importorskip("pyarrow.parquet", exc_type=ImportError)
+    path = str(tmp_path / "vac.parquet")
+    writer = vac.ParquetVACWriter(path, row_group_size=4)
+    for record in token_records:
+        writer.write(record)
+    writer.close()
+
+    expected = [
+        {"doc_id": record["doc_id"], "sent": v["sent"], "char_start": v["char"], "char_end": v["char"] + len(v["verb"]), "i": v["i"], "lemma": v["lemma"], "label": v["label"], "tokens": v["tokens"]}
+        for record in token_records for v in record["vacs"]
+    ]
+    assert len(expected) > 8
+    assert pq.read_table(path).to_pylist() == expected
+    assert pq.ParquetFile(path).num_row_groups > 1
+    # Labels are dictionary-encoded (Parquet reads the indices back as int32)
+    label_type = pq.read_schema(path).field("label").type
+    assert vac.pa.types.is_dictionary(label_type) and label_type.value_type == vac.pa.string()
+
+    writer = vac.ParquetVACWriter(str(tmp_path / "plain.parquet"))
+    with pytest.raises(ValueError):
+        writer.write({"doc_id": "x", "vacs": [{"i": 1, "verb": "gave", "lemma": "give", "label": "V_n_n-obj"}]})
+    writer.close()
+
+
+def _store_rows(records):
+    # The rows query_VAC_store returns, in document then token order
+    return [
+        (record["doc_id"], v["i"], v["verb"], v["lemma"], v["label"], v.get("char"), v.get("sent"), v.get("tokens"))
+        for record in records for v in sorted(record["vacs"], key=lambda v: v["i"])
+    ]
+
+
+def test_sqlite_store_round_trip(token_records, tmp_path):
+    path = str(tmp_path / "vac.sqlite")
+    writer = vac.SqliteVACWriter(path, batch_size=5)
+    skipped = [{"start": 0, "end": 8, "reason": "sentence_length"}]
+    for record in token_records:
+        writer.write(dict(record, skipped=skipped) if record["doc_id"] == "doc0" else record)
+    writer.close()
+
+    expected = _store_rows(token_records)
+    assert vac.query_VAC_store(path) == expected
+    assert vac.query_VAC_store(path, label="V_that") == [row for row in expected if row[4] == "V_that"]
+    assert vac.query_VAC_store(path, label="V_that", lemma="believe", doc_id="doc1") == [row for row in expected if row[4] == "V_that" and row[0] == "doc1"]
+    assert vac.query_VAC_store(path, limit=3) == expected[:3]
+    conn = vac.sqlite3.connect(path)
+    try:
+        assert conn.execute("SELECT doc_id, char_offset, skipped FROM docs WHERE id = 1").fetchone() == ("doc0", 0, json.dumps(skipped))
+        assert {name for (name,) in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")} >= {"vacs_label_lemma", "vacs_doc", "docs_doc_id"}
+    finally:
+        conn.close()
+
+    # Appending keeps the existing rows and lemma ids; without append the store is recreated
+    writer = vac.SqliteVACWriter(path, append=True)
+    writer.write(dict(token_records[1], doc_id="extra"))
+    writer.close()
+    assert vac.query_VAC_store(path) == expected + _store_rows([dict(token_records[1], doc_id="extra")])
+    writer = vac.SqliteVACWriter(path)
+    writer.write(token_records[1])
+    writer.close()
+    assert vac.query_VAC_store(path) == _store_rows([token_records[1]])
+
+
+def test_writer_process_serialises_writes(token_records, tmp_path):
+    context = vac.multiprocessing.get_context("fork")
+    path = str(tmp_path / "vac.sqlite")
+    process = vac.WriterProcess(functools.partial(vac.SqliteVACWriter, path, batch_size=3), queue_size=4, context=context)
+    client = process.client()
+    for record in token_records:
+        client.write(record)
+    client.close()
+    process.close()
+    assert vac.query_VAC_store(path) == _store_rows(token_records)
+
+    # A writer that cannot be created fails the close, after the queue has been drained
+    process = vac.WriterProcess(functools.partial(vac.SqliteVACWriter, str(tmp_path / "missing" / "dir" / "\0")), context=context)
+    process.client().write(token_records[0])
+    with pytest.raises(RuntimeError):
+        process.close()
+
+
+def _read_jsonl(path):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+
+def test_shards_resume_after_a_crash_and_merge(nlp, matcher, corpus, tmp_path, monkeypatch):
+    corpus_path = tmp_path / "corpus.txt"
+    corpus_path.write_text("".join(doc.text + "\n" for doc in corpus), encoding="utf-8")
+    parsed = {doc.text: doc for doc in corpus}
+    monkeypatch.setattr(nlp, "pipe", lambda stream, **kwargs: ((parsed[text], context) for text, context in stream))
+    reference = ListWriter()
+    vac.extract_VAC_corpus(vac.iter_corpus_chunks(str(corpus_path), "lines"), nlp, reference, matcher=matcher)
+
+    manifest_path = str(tmp_path / "shards" / "manifest.json")
+    manifest = vac.create_shard_manifest(manifest_path, str(corpus_path), 3, input_format="lines")
+    assert vac.load_shard_manifest(manifest_path) == manifest
+    shard_ids = [[record["doc_id"] for record in reference.records if spec["hash_start"] <= vac.get_shard_hash(record["doc_id"]) < spec["hash_end"]] for spec in manifest["shards"]]
+    assert sorted(sum(shard_ids, [])) == sorted(record["doc_id"] for record in reference.records)
+    crashed = max(range(3), key=lambda shard: len(shard_ids[shard]))
+    assert len(shard_ids[crashed]) >= 5
+
+    # The parser fails on the 6th document of a shard; the checkpoint only ever covers whole commits
+    def crashing_pipe(stream, **kwargs):
+        for k, (text, context) in enumerate(stream):
+            if k == 5:
+                raise RuntimeError("parser crashed")
+            yield parsed[text], context
+
+    monkeypatch.setattr(nlp, "pipe", crashing_pipe)
+    with pytest.raises(RuntimeError):
+        vac.extract_VAC_shard(manifest_path, crashed, nlp, checkpoint_every=2, matcher=matcher)
+    committed = vac._read_checkpoint(manifest["shards"][crashed]["checkpoint"])["docs"]
+    assert committed % 2 == 0 and committed <= 5
+    # A line torn by the crash is cut off on resume
+    with open(manifest["shards"][crashed]["output"], "a", encoding="utf-8") as f:
+        f.write('{"doc_id": "torn')
+    with pytest.raises(RuntimeError):
+        vac.merge_VAC_shards(manifest_path, str(tmp_path / "merged.jsonl"))
+    partial = vac.merge_VAC_shards(manifest_path, str(tmp_path / "partial.jsonl"), allow_partial=True)
+    assert partial["docs"] == committed
+    assert sorted(partial["unfinished"]) == [0, 1, 2]
+
+    monkeypatch.setattr(nlp, "pipe", lambda stream, **kwargs: ((parsed[text], context) for text, context in stream))
+    reports = [vac.extract_VAC_shard(manifest_path, shard, nlp, checkpoint_every=2, matcher=matcher) for shard in range(3)]
+    assert reports[crashed]["resumed_docs"] == committed
+    assert vac.extract_VAC_shard(manifest_path, crashed, nlp, matcher=matcher)["docs"] == 0
+
+    for spec, ids in zip(manifest["shards"], shard_ids):
+        assert [record["doc_id"] for record in _read_jsonl(spec["output"])] == ids
+    counts_path = str(tmp_path / "counts.json")
+    counts = vac.merge_VAC_shards(manifest_path, str(tmp_path / "merged.jsonl"), counts_path=counts_path)
+    by_id = {record["doc_id"]: record for record in reference.records}
+    assert _read_jsonl(str(tmp_path / "merged.jsonl")) == [by_id[doc_id] for ids in shard_ids for doc_id in ids]
+    assert counts["docs"] == len(reference.records)
+    assert counts["vacs"] == sum(len(record["vacs"]) for record in reference.records)
+    assert counts["labels"] == dict(vac.Counter(v["label"] for record in reference.records for v in record["vacs"]).most_common())
+    with open(counts_path, encoding="utf-8") as f:
+        assert json.load(f) == counts
+
+
+def test_prefork_matches_corpus_extraction(nlp, corpus, monkeypatch):
+    _patch_pipe(monkeypatch, nlp, corpus)
+    records = [(f"doc{k:02d}", doc.text) for k, doc in enumerate(corpus)]
+    budget = vac.VACBudget(slow_seconds=0)
+    reference = ListWriter()
+    reference_matcher = vac.create_dependency_matcher(nlp, prescreen=True)
+    expected = vac.extract_VAC_corpus(records, nlp, reference, matcher=reference_matcher, budget=budget, slow_log=ListWriter())
+
+    writer = ListWriter()
+    matcher = vac.create_dependency_matcher(nlp, prescreen=True)
+    summary = vac.extract_VAC_prefork(records, nlp, writer, matcher=matcher, n_workers=2, batch_size=4, budget=budget)
+    assert sorted(writer.records, key=lambda record: record["doc_id"]) == reference.records
+    assert {name: summary[name] for name in expected} == expected
+    assert expected["slow_docs"] == len(corpus)
+    # The workers' matcher counters are added to the parent's matcher
+    assert matcher.stats == reference_matcher.stats
+    assert matcher.stats["docs"] >= len(corpus)
+    assert sum(report["docs"] for report in summary["workers"]) == len(corpus)